@@ -0,0 +1,290 @@
+"""Asynchronous engine loop.
+
+The AMQP connection is served by pika's SelectConnection in the main
+thread while deliveries are handled in a separate handler thread. Storage
+I/O done by the handlers doesn't stop intake of new deliveries, publishing
+of emitted messages and broker heartbeats. There is only one handler
+thread, so deliveries are handled in the order they have been received.
+
+With publisher confirms a delivery is acknowledged only after the broker
+has confirmed all messages published before the acknowledgement. The
+confirmations come asynchronously, often many at once.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import Queue
+
+from collections import deque
+
+import pika
+
+from bureaucrat.configs import Configs
+from bureaucrat.channelwrapper import ChannelWrapper
+from bureaucrat.schedule import Schedule
+from bureaucrat.workflow import republish_outboxes
+
+LOG = logging.getLogger(__name__)
+
+ALARM_INTERVAL = 60
+
+
+class AsyncLoopError(Exception):
+    """Asynchronous loop error."""
+
+
+class ThreadsafeChannel(object):
+    """Channel used by the handler thread.
+
+    The calls are passed over to the I/O loop which owns the channel.
+    """
+
+    def __init__(self, loop):
+        """Initialize channel."""
+
+        self._loop = loop
+
+    def basic_publish(self, *args, **kwargs):
+        """Publish message."""
+        self._loop.call_in_io(self._loop.publish, *args, **kwargs)
+
+    def basic_ack(self, *args, **kwargs):
+        """Acknowledge delivery."""
+        self._loop.call_in_io(self._loop.ack, *args, **kwargs)
+
+    def basic_nack(self, *args, **kwargs):
+        """Reject and requeue delivery."""
+        self._loop.call_in_io(self._loop.channel.basic_nack, *args, **kwargs)
+
+
+class Timer(object):
+    """Timeout fired in the handler thread."""
+
+    def __init__(self, callback):
+        """Initialize timer."""
+
+        self.callback = callback
+        self.canceled = False
+
+    def fire(self):
+        """Run callback unless the timer has been removed."""
+
+        if not self.canceled:
+            self.callback()
+
+
+class AsyncLoop(object):
+    """Engine loop on a non-blocking AMQP connection.
+
+    The loop stands in for the connection and the channel of the engine,
+    the engine's handlers and timers run in the handler thread.
+    """
+
+    def __init__(self, app):
+        """Initialize loop.
+
+        :param app: engine handling deliveries
+        :type app: bureaucrat.bureaucrat.Bureaucrat
+        """
+
+        self.app = app
+        self.connection = None
+        self.channel = None
+        self.consumer_tags = []
+        self.failed = False
+        # publisher confirms state, used by the I/O loop only
+        self.confirms = False
+        self.published = 0
+        self.unconfirmed = set()
+        self.waiting_acks = deque()
+        self.tasks = Queue.Queue()
+        self.handler = threading.Thread(target=self._handle,
+                                        name="bureaucrat-handler")
+        self.handler.daemon = True
+
+    def run(self):
+        """Serve the connection until it's closed."""
+
+        self.app.channel = ThreadsafeChannel(self)
+        self.app.connection = self
+        self.app.schedule = Schedule(ChannelWrapper(self.app.channel))
+        self.connection = pika.SelectConnection(
+            Configs.instance().amqp_params,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_error,
+            on_close_callback=self._on_connection_closed)
+        self.handler.start()
+        self.connection.ioloop.start()
+        if self.failed:
+            raise AsyncLoopError("Engine stopped after handler failure")
+
+    def stop(self):
+        """Stop consuming and close the connection once handlers are done.
+
+        Safe to call from signal handlers.
+        """
+
+        self.connection.add_callback_threadsafe(self._stop_consuming)
+
+    def call_in_io(self, func, *args, **kwargs):
+        """Call the function in the I/O loop."""
+
+        self.connection.add_callback_threadsafe(
+            lambda: func(*args, **kwargs))
+
+    def call_in_handler(self, func, *args):
+        """Call the function in the handler thread."""
+
+        self.tasks.put((func, args))
+
+    def publish(self, *args, **kwargs):
+        """Publish message and track its confirmation in confirm mode."""
+
+        self.channel.basic_publish(*args, **kwargs)
+        if self.confirms:
+            self.published += 1
+            self.unconfirmed.add(self.published)
+
+    def ack(self, *args, **kwargs):
+        """Acknowledge delivery once earlier messages are confirmed."""
+
+        if self.unconfirmed:
+            self.waiting_acks.append((self.published, args, kwargs))
+        else:
+            self.channel.basic_ack(*args, **kwargs)
+
+    def add_timeout(self, deadline, callback):
+        """Call the callback in the handler thread after the deadline."""
+
+        timer = Timer(callback)
+        self.call_in_io(self.connection.add_timeout, deadline,
+                        lambda: self.call_in_handler(timer.fire))
+        return timer
+
+    def remove_timeout(self, timer):
+        """Remove timer added by the handler thread."""
+
+        timer.canceled = True
+
+    def _on_connection_open(self, connection):
+        """Open channel."""
+
+        LOG.debug("Bureaucrat connected")
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        """Report connection failure."""
+
+        raise AsyncLoopError("Can't connect to broker: %s" % error)
+
+    def _on_connection_closed(self, connection, reply_code, reply_text):
+        """Stop the handler thread."""
+
+        LOG.debug("Connection closed: (%s) %s", reply_code, reply_text)
+        self.tasks.put(None)
+
+    def _on_channel_open(self, channel):
+        """Declare queues and start consuming when outboxes are sent."""
+
+        self.channel = channel
+        config = Configs.instance()
+        for queue in ("bureaucrat", config.message_queue, config.event_queue,
+                      "bureaucrat_schedule"):
+            channel.queue_declare(None, queue=queue, durable=True,
+                                  exclusive=False, auto_delete=False)
+        channel.basic_qos(prefetch_count=self.app.prefetch_count(config))
+        if config.publisher_confirms:
+            self.confirms = True
+            channel.confirm_delivery(self._on_confirm)
+        self.call_in_handler(self._republish)
+
+    def _on_confirm(self, frame):
+        """Send acknowledgements waiting for confirmed messages."""
+
+        method = frame.method
+        if isinstance(method, pika.spec.Basic.Nack):
+            # the deliveries are redelivered to the next engine run
+            LOG.error("Broker has rejected message %d, closing connection",
+                      method.delivery_tag)
+            self.failed = True
+            self.connection.close()
+            return
+
+        if method.multiple:
+            self.unconfirmed = set(seqno for seqno in self.unconfirmed
+                                   if seqno > method.delivery_tag)
+        else:
+            self.unconfirmed.discard(method.delivery_tag)
+        oldest = min(self.unconfirmed) if self.unconfirmed else \
+                self.published + 1
+        while self.waiting_acks and self.waiting_acks[0][0] < oldest:
+            _, args, kwargs = self.waiting_acks.popleft()
+            self.channel.basic_ack(*args, **kwargs)
+
+    def _republish(self):
+        """Republish persisted outboxes before new deliveries come."""
+
+        republish_outboxes(ChannelWrapper(self.app.channel))
+        self.call_in_io(self._start_consuming)
+
+    def _start_consuming(self):
+        """Consume engine queues."""
+
+        config = Configs.instance()
+        for handler, queue in ((self.app.launch_process, "bureaucrat"),
+                               (self.app.handle_message,
+                                config.message_queue),
+                               (self.app.handle_event, config.event_queue),
+                               (self.app.add_schedule,
+                                "bureaucrat_schedule")):
+            self.consumer_tags.append(self.channel.basic_consume(
+                self._consumer(handler), queue=queue))
+        self.connection.add_timeout(ALARM_INTERVAL, self._on_alarm)
+
+    def _consumer(self, handler):
+        """Return consumer callback passing deliveries to the handler."""
+
+        def on_delivery(channel, method, header, body):
+            """Queue delivery for handling."""
+            self.call_in_handler(handler, self.app.channel, method, header,
+                                 body)
+        return on_delivery
+
+    def _on_alarm(self):
+        """Handle scheduled events and rearm alarm."""
+
+        self.call_in_handler(self.app.schedule.handle_alarm)
+        self.connection.add_timeout(ALARM_INTERVAL, self._on_alarm)
+
+    def _stop_consuming(self):
+        """Cancel consumers and shut down after queued deliveries."""
+
+        for consumer_tag in self.consumer_tags:
+            self.channel.basic_cancel(consumer_tag=consumer_tag)
+        self.consumer_tags = []
+        self.call_in_handler(self._shutdown)
+
+    def _shutdown(self):
+        """Commit handled deliveries and close the connection."""
+
+        self.app.flush()
+        self.call_in_io(self.connection.close)
+
+    def _handle(self):
+        """Run tasks in the handler thread until the connection is closed."""
+
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                # the handlers have logged the error already
+                LOG.error("Handler failed, closing connection")
+                self.failed = True
+                self.call_in_io(self.connection.close)
+                break
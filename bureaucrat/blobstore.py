@@ -0,0 +1,92 @@
+"""Store of large context values.
+
+Values of context properties exceeding `blob_threshold` are moved out of
+process snapshots to the blob store. The context keeps a reference
+{"inst:blob": <digest>} instead and the value is loaded only when it's
+actually read.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import json
+import hashlib
+
+from bureaucrat.storage import Storage
+from bureaucrat.storage import striped_lock
+
+LOG = logging.getLogger(__name__)
+
+BLOB_REF = 'inst:blob'
+
+
+class BlobStoreError(Exception):
+    """Blob store error."""
+
+
+def is_blob_ref(value):
+    """Return True if the value is a reference to a blob."""
+    return isinstance(value, dict) and len(value) == 1 and BLOB_REF in value
+
+
+def dump_blob(value):
+    """Return document and content hash of the value."""
+
+    doc = json.dumps(value, sort_keys=True)
+    return doc, hashlib.sha1(doc).hexdigest()
+
+
+class BlobStore(object):
+    """Content-addressed values shared by process instances.
+
+    Every value is stored once in the 'blob' bucket under the hash of its
+    JSON representation. The number of instances referring to it is kept
+    in the 'blob_refs' bucket and the value is removed together with the
+    last reference.
+    """
+
+    @staticmethod
+    def acquire(digest, doc=None):
+        """Add a reference to the blob, store it first if needed.
+
+        :param doc: JSON representation of the value, may be omitted if
+                    the blob is known to exist
+        """
+
+        storage = Storage.instance()
+        with striped_lock("blob", digest):
+            refs = 0
+            if storage.exists("blob_refs", digest):
+                refs = int(storage.load("blob_refs", digest))
+            if refs == 0 and doc is not None:
+                storage.save("blob", digest, doc)
+            elif refs == 0 and not storage.exists("blob", digest):
+                raise BlobStoreError("Blob %s doesn't exist" % digest)
+            storage.save("blob_refs", digest, str(refs + 1))
+
+    @staticmethod
+    def release(digest):
+        """Remove a reference to the blob."""
+
+        storage = Storage.instance()
+        with striped_lock("blob", digest):
+            refs = int(storage.load("blob_refs", digest)) - 1
+            if refs > 0:
+                storage.save("blob_refs", digest, str(refs))
+            else:
+                LOG.debug("Removing unused blob %s", digest)
+                storage.delete("blob_refs", digest)
+                storage.delete("blob", digest)
+
+    @staticmethod
+    def load(digest):
+        """Return value of the blob."""
+        return json.loads(Storage.instance().load("blob", digest))
+
+
+def resolve(value):
+    """Return the value itself or the referred value for blob references."""
+
+    if is_blob_ref(value):
+        return BlobStore.load(value[BLOB_REF])
+    return value
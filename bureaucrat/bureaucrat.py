@@ -12,17 +12,32 @@ import fcntl
 import json
 import os
 import os.path
+import socket
 
+from collections import OrderedDict
 from optparse import OptionParser
 from ConfigParser import ConfigParser
 
 from bureaucrat.workflow import Workflow
+from bureaucrat.workflow import UnitOfWork
+from bureaucrat.workflow import WorkflowConflictError
+from bureaucrat.workflow import InstanceCache
+from bureaucrat.workflow import republish_outboxes
 from bureaucrat.schedule import Schedule
 from bureaucrat.configs import Configs
+from bureaucrat.configs import ConfigsError
 from bureaucrat.storage import Storage
 from bureaucrat.storage import lock_storage
 from bureaucrat.message import Message
 from bureaucrat.channelwrapper import ChannelWrapper
+from bureaucrat.channelwrapper import TransactionalChannel
+from bureaucrat.asyncloop import AsyncLoop
+from bureaucrat.workerpool import WorkerPool
+from bureaucrat.workerpool import POLL_INTERVAL
+from bureaucrat.sharding import Membership
+from bureaucrat.sharding import NODES_EXCHANGE
+from bureaucrat.sharding import assigned_shards
+from bureaucrat.sharding import shard_queue
 
 LOG = logging.getLogger(__name__)
 
@@ -106,6 +121,144 @@ class Bureaucrat(object):
         self.channel = None
         self.connection = None
         self.schedule = None
+        self.instances = None
+        self.batch_acks = False
+        self.sync_timer = None
+        self.unsynced = []
+        # deliveries handled by instances not saved yet, by process ID
+        self.hold_unsaved = False
+        self.held = {}
+        self.local_execution = False
+        # deliveries buffered to be handled grouped by target instance
+        self.coalesce = False
+        self.pending = []
+        self.pending_timer = None
+        self.loop = None
+        self.workers = 0
+        self.pool = None
+        self.membership = None
+        # consumer tags of message shards consumed by the node, by shard
+        self.shard_consumers = {}
+        # separate channel for publishing in transactions
+        self.publisher = None
+
+    def ack(self, channel, delivery_tag):
+        """Acknowledge delivery once changes made by it are durable.
+
+        With batched acks the acknowledgements are held back until storage
+        is synced for a batch of deliveries.
+        """
+
+        if not self.batch_acks:
+            if self.publisher is not None:
+                self.publisher.commit()
+            channel.basic_ack(delivery_tag)
+            return
+
+        self.unsynced.append(delivery_tag)
+        self._unsynced_added()
+
+    def _unsynced_added(self):
+        """Commit if the batch is full, start the sync window otherwise."""
+
+        if len(self.unsynced) >= Configs.instance().sync_batch:
+            self.commit()
+        elif self.sync_timer is None:
+            self.sync_timer = self.connection.add_timeout(
+                Configs.instance().sync_window, self._on_sync_timeout)
+
+    def prefetch_count(self, config):
+        """Return number of unacknowledged deliveries the broker may send."""
+
+        prefetch = config.prefetch_count
+        if prefetch > 0:
+            return prefetch
+
+        prefetch = 1
+        if self.batch_acks or self.coalesce:
+            # let enough deliveries in to fill a batch
+            prefetch = config.sync_batch
+        if self.hold_unsaved:
+            # held deliveries must not stop new ones from coming
+            prefetch += config.max_unsaved
+        if self.workers > 0:
+            # keep all workers busy
+            prefetch *= self.workers
+        return prefetch
+
+    def commit(self):
+        """Sync storage and acknowledge deliveries handled since last sync."""
+
+        if self.sync_timer is not None:
+            self.connection.remove_timeout(self.sync_timer)
+            self.sync_timer = None
+        Storage.instance().sync()
+        if self.publisher is not None:
+            # one transaction covers messages sent for the whole batch
+            self.publisher.commit()
+        unsynced = sorted(self.unsynced)
+        self.unsynced = []
+        if not unsynced:
+            return
+        # all deliveries share one channel, so one ack can cover all of
+        # them up to the first one which isn't finished yet
+        unfinished = set(self.unfinished()).difference(unsynced)
+        covered = len(unsynced)
+        if unfinished:
+            bound = min(unfinished)
+            covered = len([tag for tag in unsynced if tag < bound])
+        if covered > 0:
+            self.channel.basic_ack(unsynced[covered - 1], multiple=True)
+        for delivery_tag in unsynced[covered:]:
+            self.channel.basic_ack(delivery_tag)
+
+    def unfinished(self):
+        """Return tags of deliveries not handled yet or held back."""
+
+        tags = [delivery_tag for delivery_tag, _ in self.pending]
+        for held_tags in self.held.values():
+            tags.extend(held_tags)
+        if self.pool is not None:
+            for worker in self.pool.workers:
+                tags.extend(worker.inflight)
+        return tags
+
+    def _on_sync_timeout(self):
+        """Handle end of group sync window."""
+
+        self.sync_timer = None
+        self.commit()
+
+    def hold(self, channel, process_id, delivery_tag):
+        """Hold acknowledgement back until the instance is saved."""
+
+        self.held.setdefault(process_id, []).append(delivery_tag)
+        if sum(len(tags) for tags in self.held.values()) >= \
+           Configs.instance().max_unsaved:
+            LOG.debug("Too many unsaved deliveries, saving all instances")
+            self.instances.flush()
+
+    def release_held(self, channel):
+        """Acknowledge held deliveries of instances saved since."""
+
+        for process_id in self.held.keys():
+            if self.instances.is_unsaved(process_id):
+                continue
+            delivery_tags = self.held.pop(process_id)
+            if self.instances.was_lost(process_id):
+                # let the messages rebuild the lost changes
+                for delivery_tag in delivery_tags:
+                    channel.basic_nack(delivery_tag)
+            else:
+                for delivery_tag in delivery_tags:
+                    self.ack(channel, delivery_tag)
+
+    def requeue(self, channel, process_id, delivery_tag):
+        """Requeue delivery and all deliveries held for the instance."""
+
+        for held_tag in self.held.pop(process_id, []):
+            channel.basic_nack(held_tag)
+        channel.basic_nack(delivery_tag)
 
     @log_trace
     def launch_process(self, channel, method, header, body):
@@ -115,10 +268,10 @@ class Bureaucrat(object):
         LOG.debug("Header: %r", header)
         LOG.debug("Body: %r", body)
         wflow = Workflow.create_from_string(body, "%s" % uuid.uuid4())
-        chwrapper = ChannelWrapper(channel)
+        chwrapper = self.wrap(channel)
         chwrapper.send(Message(name='start', target=wflow.process.id,
                                origin=''))
-        channel.basic_ack(method.delivery_tag)
+        self.ack(channel, method.delivery_tag)
 
     @log_trace
     def handle_message(self, channel, method, header, body):
@@ -132,22 +285,89 @@ class Bureaucrat(object):
         except (ValueError, KeyError) as err:
             # Report error and accept message
             LOG.error("%s", err)
-            channel.basic_ack(method.delivery_tag)
+            self.ack(channel, method.delivery_tag)
             return
 
-        if msg.target != '':
-            wflow = Workflow.load(msg.target_pid)
-            wflow.process.handle_message(ChannelWrapper(channel), msg)
-            wflow.save()
+        if self.pool is not None:
+            self.pool.dispatch(msg.target_pid, method.delivery_tag, body)
+            return
 
-        if msg.origin == msg.origin_pid and msg.name == 'completed':
-            LOG.debug("The process %s has finished", msg.origin)
-            Workflow.load(msg.origin).delete()
-        elif msg.origin == msg.origin_pid and msg.name == 'fault':
-            LOG.error("The process %s has faulted with %s. " + \
-                      "The state is preserved.", msg.origin, msg.payload)
+        if not self.coalesce:
+            self.handle_deliveries(channel, [(method.delivery_tag, msg)])
+            return
 
-        channel.basic_ack(method.delivery_tag)
+        self.pending.append((method.delivery_tag, msg))
+        if len(self.pending) >= Configs.instance().sync_batch:
+            self.handle_pending()
+        elif self.pending_timer is None:
+            self.pending_timer = self.connection.add_timeout(
+                Configs.instance().sync_window, self._on_pending_timeout)
+
+    def handle_pending(self):
+        """Handle buffered deliveries grouped by target instance.
+
+        Deliveries for different instances may be handled out of order,
+        but the order of deliveries for the same instance is preserved.
+        """
+
+        if self.pending_timer is not None:
+            self.connection.remove_timeout(self.pending_timer)
+            self.pending_timer = None
+        groups = OrderedDict()
+        for delivery_tag, msg in self.pending:
+            groups.setdefault(msg.target_pid, []).append((delivery_tag, msg))
+        for deliveries in groups.values():
+            self.handle_deliveries(self.channel, deliveries)
+            # deliveries stay pending until handled, so that acks of other
+            # groups don't cover them
+            handled = set(delivery_tag for delivery_tag, _ in deliveries)
+            self.pending = [(delivery_tag, msg)
+                            for delivery_tag, msg in self.pending
+                            if delivery_tag not in handled]
+
+    def _on_pending_timeout(self):
+        """Handle end of buffering window."""
+
+        self.pending_timer = None
+        self.handle_pending()
+
+    def handle_deliveries(self, channel, deliveries):
+        """Handle deliveries of messages targeted at the same instance.
+
+        :param deliveries: list of (delivery_tag, message) pairs
+        """
+
+        process_id = deliveries[0][1].target_pid
+        if process_id != '':
+            try:
+                UnitOfWork(process_id, self.wrap(channel),
+                           cache=self.instances,
+                           local=self.local_execution).handle_messages(
+                               [msg for _, msg in deliveries])
+            except WorkflowConflictError as err:
+                LOG.warning("%s. Requeueing the messages.", err)
+                for delivery_tag, _ in deliveries:
+                    self.requeue(channel, process_id, delivery_tag)
+                return
+
+        for delivery_tag, msg in deliveries:
+            if msg.origin == msg.origin_pid and msg.name == 'completed':
+                LOG.debug("The process %s has finished", msg.origin)
+                if self.instances is not None:
+                    self.instances.discard(msg.origin)
+                Workflow.load(msg.origin).delete()
+            elif msg.origin == msg.origin_pid and msg.name == 'fault':
+                LOG.error("The process %s has faulted with %s. " + \
+                          "The state is preserved.", msg.origin, msg.payload)
+
+            if self.hold_unsaved and self.instances.is_unsaved(process_id):
+                # the message is redelivered and handled again if the engine
+                # stops before the instance reaches a checkpoint
+                self.hold(channel, process_id, delivery_tag)
+            else:
+                self.ack(channel, delivery_tag)
+        if self.held:
+            self.release_held(channel)
 
     @log_trace
     def add_schedule(self, channel, method, header, body):
@@ -158,7 +378,7 @@ class Bureaucrat(object):
         sch = json.loads(body)
         self.schedule.register(instant=sch["instant"], code=sch["code"],
                                target=sch["target"])
-        channel.basic_ack(method.delivery_tag)
+        self.ack(channel, method.delivery_tag)
 
     def handle_alarm(self, signum, frame):
         """Handle timer signal."""
@@ -166,7 +386,7 @@ class Bureaucrat(object):
         self.schedule.handle_alarm()
 
     @log_trace
-    @lock_storage
+    @lock_storage("subscriptions")
     def handle_event(self, channel, method, header, body):
         """Handle event."""
 
@@ -179,22 +399,179 @@ class Bureaucrat(object):
         if storage.exists("subscriptions", eventname):
             subscriptions = json.loads(storage.load("subscriptions",
                                                     eventname))
+            chwrapper = self.wrap(channel)
             for subscr in subscriptions:
                 wmsg = Message(name='triggered', target=subscr["target"],
                                origin='', payload=msg)
-                ChannelWrapper(channel).send(wmsg)
+                chwrapper.send(wmsg)
             storage.delete("subscriptions", eventname)
-        channel.basic_ack(method.delivery_tag)
+        self.ack(channel, method.delivery_tag)
+
+    def wrap(self, channel):
+        """Return wrapper used to send messages while handling deliveries.
+
+        With publisher confirms messages go to the publisher channel
+        instead of the channel deliveries come from.
+        """
+
+        if self.publisher is not None:
+            return ChannelWrapper(self.publisher)
+        return ChannelWrapper(channel)
+
+    def setup(self, config):
+        """Set up engine state common to all engine loops."""
+
+        if config.engine_loop == 'async' and config.message_shards > 0:
+            # the async loop would neither declare nor consume the shards
+            raise ConfigsError("message_shards can't be used with the "
+                               "async engine loop")
+        if config.engine_loop == 'async' and config.persist_outbox:
+            # the async loop publishes in the background, so outboxes
+            # would be dropped before their messages reach the broker
+            raise ConfigsError("persist_outbox can't be used with the "
+                               "async engine loop")
+        if config.engine_loop == 'async' and config.publisher_transactions:
+            raise ConfigsError("publisher_transactions can't be used with "
+                               "the async engine loop")
+        if config.engine_loop != 'async' and config.publisher_confirms:
+            raise ConfigsError("publisher_confirms can be used with the "
+                               "async engine loop only")
+        self.local_execution = config.local_execution
+        self.coalesce = config.coalesce_messages
+        self.hold_unsaved = config.instance_flush == 'wait_state'
+        cache_size = config.instance_cache_size
+        if self.hold_unsaved:
+            cache_size = max(cache_size, config.max_unsaved)
+        if cache_size > 0:
+            self.instances = InstanceCache(cache_size, config.instance_flush)
+        self.batch_acks = config.storage_sync == 'group' or \
+                config.batch_acks or config.publisher_transactions
+        self.workers = config.workers
+
+    def join_cluster(self, config):
+        """Announce the node and start taking part in shard assignment.
+
+        The node claims its shards on the first heartbeat timeout, when it
+        has heard from the other nodes.
+        """
+
+        node = config.node_id or "%s-%d" % (socket.gethostname(), os.getpid())
+        self.membership = Membership(node, config.heartbeat_interval)
+        for shard in range(config.message_shards):
+            self.channel.queue_declare(queue=shard_queue(shard), durable=True,
+                                       exclusive=False, auto_delete=False)
+        self.channel.exchange_declare(exchange=NODES_EXCHANGE,
+                                      exchange_type='fanout')
+        result = self.channel.queue_declare(exclusive=True, auto_delete=True)
+        self.channel.queue_bind(queue=result.method.queue,
+                                exchange=NODES_EXCHANGE)
+        self.channel.basic_consume(self.handle_heartbeat,
+                                   queue=result.method.queue, no_ack=True)
+        self.send_heartbeat()
+        self.connection.add_timeout(config.heartbeat_interval,
+                                    self._on_heartbeat_timeout)
+
+    def send_heartbeat(self, leaving=False):
+        """Announce the node to other nodes."""
+
+        self.channel.basic_publish(exchange=NODES_EXCHANGE, routing_key='',
+                                   body=json.dumps({
+                                       "node": self.membership.node,
+                                       "leaving": leaving
+                                   }))
+
+    def handle_heartbeat(self, channel, method, header, body):
+        """Handle heartbeat of a node."""
+
+        heartbeat = json.loads(body)
+        if self.membership.heartbeat(heartbeat["node"],
+                                     heartbeat.get("leaving", False)):
+            self.rebalance()
+
+    def _on_heartbeat_timeout(self):
+        """Send heartbeat and forget nodes gone silent."""
+
+        self.send_heartbeat()
+        self.membership.expire()
+        self.rebalance()
+        self.connection.add_timeout(self.membership.interval,
+                                    self._on_heartbeat_timeout)
+
+    def rebalance(self):
+        """Consume message shards assigned to the node and only them."""
+
+        shards = assigned_shards(self.membership.node, self.membership.nodes,
+                                 Configs.instance().message_shards)
+        lost = set(self.shard_consumers.keys()) - shards
+        gained = shards - set(self.shard_consumers.keys())
+        if not lost and not gained:
+            return
+
+        LOG.info("Node %s takes shards %s and gives up shards %s",
+                 self.membership.node, sorted(gained), sorted(lost))
+        for shard in lost:
+            self.channel.basic_cancel(self.shard_consumers.pop(shard))
+        if lost and self.instances is not None:
+            # the new owners must see the latest state
+            self.instances.flush()
+            if self.held:
+                self.release_held(self.channel)
+        for shard in gained:
+            self.shard_consumers[shard] = self.channel.basic_consume(
+                self.handle_message, queue=shard_queue(shard))
+
+    def finish(self, deliveries):
+        """Acknowledge deliveries finished by workers, requeue failed ones.
+
+        :param deliveries: list of (delivery_tag, handled) pairs
+        """
+
+        handled_tags = []
+        for delivery_tag, handled in deliveries:
+            if handled:
+                handled_tags.append(delivery_tag)
+            else:
+                self.channel.basic_nack(delivery_tag)
+        if not handled_tags:
+            return
+        if not self.batch_acks:
+            for delivery_tag in handled_tags:
+                self.channel.basic_ack(delivery_tag)
+            return
+        # the deliveries aren't tracked by workers any more, they must all
+        # be unsynced before a commit computes what one ack may cover
+        self.unsynced.extend(handled_tags)
+        self._unsynced_added()
+
+    def flush(self):
+        """Save cached instances and acknowledge handled deliveries."""
+
+        if self.instances is not None:
+            self.instances.flush()
+        self.commit()
+        LOG.info("Storage: %s", Storage.instance().metrics)
 
     def run(self):
         """Event cycle."""
 
         config = Configs.instance()
+        self.setup(config)
+        if config.engine_loop == 'async':
+            self.loop = AsyncLoop(self)
+            self.loop.run()
+            return
+
+        if self.workers > 0:
+            # fork before the connection is open
+            self.pool = WorkerPool(self.workers, type(self))
+            self.pool.start()
         LOG.debug("create connection")
         self.connection = pika.BlockingConnection(config.amqp_params)
         LOG.debug("Bureaucrat connected")
         self.channel = self.connection.channel()
-        self.schedule = Schedule(ChannelWrapper(self.channel))
+        if config.publisher_transactions:
+            self.publisher = TransactionalChannel(self.connection.channel())
+        self.schedule = Schedule(self.wrap(self.channel))
         self.channel.queue_declare(queue="bureaucrat", durable=True,
                                    exclusive=False, auto_delete=False)
         self.channel.queue_declare(queue=config.message_queue, durable=True,
@@ -203,7 +580,8 @@ class Bureaucrat(object):
                                    exclusive=False, auto_delete=False)
         self.channel.queue_declare(queue="bureaucrat_schedule", durable=True,
                                    exclusive=False, auto_delete=False)
-        self.channel.basic_qos(prefetch_count=1)
+        self.channel.basic_qos(prefetch_count=self.prefetch_count(config))
+        republish_outboxes(self.wrap(self.channel))
         self.channel.basic_consume(self.launch_process, queue="bureaucrat")
         self.channel.basic_consume(self.handle_message,
                                    queue=config.message_queue)
@@ -211,15 +589,32 @@ class Bureaucrat(object):
                                    queue=config.event_queue)
         self.channel.basic_consume(self.add_schedule,
                                    queue="bureaucrat_schedule")
+        if config.message_shards > 0:
+            self.join_cluster(config)
         signal.signal(signal.SIGALRM, self.handle_alarm)
         signal.setitimer(signal.ITIMER_REAL, 60, 60)
-        self.channel.start_consuming()
+        if self.pool is None:
+            self.channel.start_consuming()
+            return
+        while True:
+            self.connection.process_data_events(time_limit=POLL_INTERVAL)
+            self.finish(self.pool.collect())
 
     def cleanup(self, signum, frame):
         """Handler for termination signals."""
 
         LOG.debug("cleanup")
+        if self.loop is not None:
+            # the loop exits once queued deliveries are handled
+            self.loop.stop()
+            return
+        if self.membership is not None:
+            # let the other nodes take the shards over right away
+            self.send_heartbeat(leaving=True)
         self.channel.stop_consuming()
+        if self.pool is not None:
+            self.finish(self.pool.stop())
+        self.flush()
         self.connection.close()
         sys.exit(0)
 
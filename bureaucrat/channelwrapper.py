@@ -5,13 +5,55 @@ import pika
 import json
 import uuid
 
+from collections import deque
+
 from bureaucrat.configs import Configs
+from bureaucrat.message import Message
+from bureaucrat.sharding import message_queue
 
 LOG = logging.getLogger(__name__)
 
+# properties are the same for all messages of a kind
+MESSAGE_PROPERTIES = pika.BasicProperties(delivery_mode=2,
+                                          content_type=Message.content_type,
+                                          content_encoding='utf-8')
+TASK_PROPERTIES = pika.BasicProperties(delivery_mode=2,
+                                       content_type=Message.content_type)
+JSON_PROPERTIES = pika.BasicProperties(delivery_mode=2,
+                                       content_type='application/json',
+                                       content_encoding='utf-8')
+LAUNCH_PROPERTIES = pika.BasicProperties(delivery_mode=2)
+
 class ChannelWrapperError(Exception):
     """ChannelWrapper error."""
 
+class TransactionalChannel(object):
+    """AMQP channel publishing messages in transactions.
+
+    The broker confirms all messages published since the last commit()
+    with a single round trip.
+    """
+
+    def __init__(self, channel):
+        """Initialize channel."""
+
+        self._ch = channel
+        self._ch.tx_select()
+        self._uncommitted = 0
+
+    def basic_publish(self, *args, **kwargs):
+        """Publish message."""
+
+        self._ch.basic_publish(*args, **kwargs)
+        self._uncommitted += 1
+
+    def commit(self):
+        """Wait until the broker has taken messages published so far."""
+
+        if self._uncommitted > 0:
+            self._ch.tx_commit()
+            self._uncommitted = 0
+
 class ChannelWrapper(object):
     """Wrapper around AMQP channel used to send messages."""
 
@@ -19,31 +61,42 @@ class ChannelWrapper(object):
         """Initialize wrapper."""
 
         self._ch = channel
+        self._config = None
+
+    @property
+    def config(self):
+        """Return configs looked up once per wrapper."""
+
+        if self._config is None:
+            self._config = Configs.instance()
+        return self._config
+
+    def commit(self):
+        """Make sure the broker has taken messages sent so far.
+
+        It's up to channels with own commit(), like TransactionalChannel
+        or the channel of worker processes.
+        """
+
+        commit = getattr(self._ch, "commit", None)
+        if commit is not None:
+            commit()
 
     def send(self, message):
         """Send a message to the target with payload attached."""
 
-        body = {
-            "name": message.name,
-            "target": message.target,
-            "origin": message.origin,
-            "payload": message.payload
-        }
         self._ch.basic_publish(exchange='',
-                               routing_key=Configs.instance().message_queue,
-                               body=json.dumps(body),
-                               properties=pika.BasicProperties(
-                                   delivery_mode=2,
-                                   content_type=message.content_type,
-                                   content_encoding='utf-8'
-                               ))
+                               routing_key=message_queue(message.target_pid,
+                                                         self.config),
+                               body=message.dumps(),
+                               properties=MESSAGE_PROPERTIES)
 
     def elaborate(self, participant, origin, payload):
         """Elaborate the payload at a given participant."""
 
-        config = Configs.instance()
+        taskqueue_type = self.config.taskqueue_type
 
-        if config.taskqueue_type == 'taskqueue':
+        if taskqueue_type == 'taskqueue':
             body = {
                 "name": 'response',
                 "target": origin,
@@ -53,11 +106,8 @@ class ChannelWrapper(object):
             self._ch.basic_publish(exchange='',
                                    routing_key="worker_%s" % participant,
                                    body=json.dumps(body),
-                                   properties=pika.BasicProperties(
-                                       delivery_mode=2,
-                                       content_type='application/x-bureaucrat-message'
-                                   ))
-        elif config.taskqueue_type == 'celery':
+                                   properties=TASK_PROPERTIES)
+        elif taskqueue_type == 'celery':
             body = {
                 "name": 'response',
                 "target": origin,
@@ -86,14 +136,10 @@ class ChannelWrapper(object):
             self._ch.basic_publish(exchange=name,
                                    routing_key=name,
                                    body=json.dumps(celery_msg),
-                                   properties=pika.BasicProperties(
-                                       delivery_mode=2,
-                                       content_type='application/json',
-                                       content_encoding='utf-8'
-                                   ))
+                                   properties=JSON_PROPERTIES)
         else:
             raise ChannelWrapperError("Unknown task queue type: %s" % \
-                                      config.taskqueue_type)
+                                      taskqueue_type)
 
     def schedule_event(self, instant, code, target):
         """Schedule event for the context."""
@@ -105,9 +151,96 @@ class ChannelWrapper(object):
         self._ch.basic_publish(exchange='',
                                routing_key="bureaucrat_schedule",
                                body=json.dumps(body),
-                               properties=pika.BasicProperties(
-                                   delivery_mode=2,
-                                   content_type='application/json',
-                                   content_encoding='utf-8'
-                               ))
+                               properties=JSON_PROPERTIES)
+
+    def launch(self, pdef):
+        """Launch a new process instance from the given definition."""
+        self._ch.basic_publish(exchange='',
+                               routing_key='bureaucrat',
+                               body=pdef,
+                               properties=LAUNCH_PROPERTIES)
+
+class DeferredChannel(object):
+    """Channel wrapper holding messages back until flush() is called.
+
+    It's used to postpone publishing of messages emitted while handling
+    a message until the resulting state of the process is saved. The held
+    back messages can be serialized with dumps() and restored with loads()
+    to survive a crash.
+
+    If `local_pid` is given messages targeted at that process instance
+    aren't published at all but put to the `local` queue to be handled
+    in place.
+    """
+
+    def __init__(self, channel, local_pid=None):
+        """Initialize wrapper."""
+
+        self._channel = channel
+        self._calls = []
+        self.local_pid = local_pid
+        self.local = deque()
+
+    def __len__(self):
+        """Return number of held back messages."""
+        return len(self._calls)
+
+    def send(self, message):
+        """Send a message to the target with payload attached."""
+
+        if self.local_pid is not None and \
+           message.target_pid == self.local_pid:
+            self.local.append(message)
+        else:
+            self._calls.append(('send', (message, )))
+
+    def elaborate(self, participant, origin, payload):
+        """Elaborate the payload at a given participant."""
+        self._calls.append(('elaborate', (participant, origin, payload)))
+
+    def schedule_event(self, instant, code, target):
+        """Schedule event for the context."""
+        self._calls.append(('schedule_event', (instant, code, target)))
+
+    def launch(self, pdef):
+        """Launch a new process instance from the given definition."""
+        self._calls.append(('launch', (pdef, )))
+
+    def flush(self):
+        """Publish all the held back messages as one batch."""
+
+        calls = self._calls
+        self._calls = []
+        for name, args in calls:
+            getattr(self._channel, name)(*args)
+
+    def commit(self):
+        """Make sure the broker has taken messages flushed so far."""
+        self._channel.commit()
+
+    def discard(self):
+        """Drop all the held back messages."""
+        self._calls = []
+        self.local.clear()
+
+    def dumps(self):
+        """Return held back messages as string."""
+
+        calls = []
+        for name, args in self._calls:
+            if name == 'send':
+                args = (args[0].as_dictionary(), )
+            calls.append([name, args])
+        return json.dumps(calls)
+
+    @staticmethod
+    def loads(channel, doc):
+        """Return wrapper holding back messages restored from string."""
 
+        deferred = DeferredChannel(channel)
+        for name, args in json.loads(doc):
+            if name == 'send':
+                args = [Message(args[0]["name"], args[0]["target"],
+                                args[0]["origin"], args[0]["payload"])]
+            deferred._calls.append((name, tuple(args)))
+        return deferred
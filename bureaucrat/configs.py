@@ -11,10 +11,39 @@ DEFAULT_MESSAGE_QUEUE = 'bureaucrat_msgs'
 DEFAULT_EVENT_QUEUE = 'bureaucrat_events'
 DEFAULT_STORAGE_DIR = '/tmp/processes'
 DEFAULT_TASKQUEUE_TYPE = 'taskqueue'
+DEFAULT_STORAGE_BACKEND = 'filesystem'
+DEFAULT_STORAGE_LAYOUT = 'flat'
+DEFAULT_STORAGE_SYNC = 'none'
+DEFAULT_SYNC_WINDOW = 0.01
+DEFAULT_SYNC_BATCH = 64
+DEFAULT_BATCH_ACKS = 'no'
+DEFAULT_PREFETCH_COUNT = 0
+DEFAULT_COALESCE_MESSAGES = 'no'
+DEFAULT_COMPRESS_THRESHOLD = 0
+DEFAULT_BLOB_THRESHOLD = 0
+DEFAULT_JOURNAL_HISTORY = 'no'
+DEFAULT_LOCAL_EXECUTION = 'no'
+DEFAULT_PERSIST_OUTBOX = 'no'
+DEFAULT_DEFINITION_CACHE_SIZE = 128
+DEFAULT_COMPACTION_INTERVAL = 0
+DEFAULT_SNAPSHOT_FORMAT = 'json'
+DEFAULT_INSTANCE_CACHE_SIZE = 0
+DEFAULT_INSTANCE_FLUSH = 'ack'
+DEFAULT_MAX_UNSAVED = 100
+DEFAULT_ENGINE_LOOP = 'blocking'
+DEFAULT_WORKERS = 0
+DEFAULT_MESSAGE_SHARDS = 0
+DEFAULT_HEARTBEAT_INTERVAL = 5.0
+DEFAULT_PUBLISHER_CONFIRMS = 'no'
+DEFAULT_PUBLISHER_TRANSACTIONS = 'no'
 
 class ConfigsError(Exception):
     """Configs error."""
 
+def _getboolean(items, key, default):
+    """Return boolean value of config item."""
+    return items.get(key, default).lower() in ('1', 'yes', 'true', 'on')
+
 class Configs(object):
     """Global configs."""
 
@@ -25,16 +54,60 @@ class Configs(object):
 
         try:
             items = dict(config.items("bureaucrat"))
-            self._message_queue = items.get("message_queue",
-                                            DEFAULT_MESSAGE_QUEUE)
-            self._event_queue = items.get("event_queue", DEFAULT_EVENT_QUEUE)
-            self._storage_dir = items.get("storage_dir", DEFAULT_STORAGE_DIR)
-            self._taskqueue_type = items.get("taskqueue_type",
-                                             DEFAULT_TASKQUEUE_TYPE)
         except NoSectionError:
-            self._message_queue = DEFAULT_MESSAGE_QUEUE
-            self._storage_dir = DEFAULT_STORAGE_DIR
-            self._taskqueue_type = DEFAULT_TASKQUEUE_TYPE
+            items = {}
+
+        self._message_queue = items.get("message_queue", DEFAULT_MESSAGE_QUEUE)
+        self._event_queue = items.get("event_queue", DEFAULT_EVENT_QUEUE)
+        self._storage_dir = items.get("storage_dir", DEFAULT_STORAGE_DIR)
+        self._taskqueue_type = items.get("taskqueue_type",
+                                         DEFAULT_TASKQUEUE_TYPE)
+        self._storage_backend = items.get("storage_backend",
+                                          DEFAULT_STORAGE_BACKEND)
+        self._storage_layout = items.get("storage_layout",
+                                         DEFAULT_STORAGE_LAYOUT)
+        self._storage_sync = items.get("storage_sync", DEFAULT_STORAGE_SYNC)
+        self._sync_window = float(items.get("sync_window",
+                                            DEFAULT_SYNC_WINDOW))
+        self._sync_batch = int(items.get("sync_batch", DEFAULT_SYNC_BATCH))
+        self._batch_acks = _getboolean(items, "batch_acks", DEFAULT_BATCH_ACKS)
+        self._prefetch_count = int(items.get("prefetch_count",
+                                             DEFAULT_PREFETCH_COUNT))
+        self._coalesce_messages = _getboolean(items, "coalesce_messages",
+                                              DEFAULT_COALESCE_MESSAGES)
+        self._compress_threshold = int(items.get(
+            "compress_threshold", DEFAULT_COMPRESS_THRESHOLD))
+        self._blob_threshold = int(items.get("blob_threshold",
+                                             DEFAULT_BLOB_THRESHOLD))
+        self._journal_history = _getboolean(items, "journal_history",
+                                            DEFAULT_JOURNAL_HISTORY)
+        self._local_execution = _getboolean(items, "local_execution",
+                                            DEFAULT_LOCAL_EXECUTION)
+        self._persist_outbox = _getboolean(items, "persist_outbox",
+                                           DEFAULT_PERSIST_OUTBOX)
+        self._sqlite_path = items.get("sqlite_path")
+        self._definition_cache_size = int(items.get(
+            "definition_cache_size", DEFAULT_DEFINITION_CACHE_SIZE))
+        self._compaction_interval = int(items.get(
+            "compaction_interval", DEFAULT_COMPACTION_INTERVAL))
+        self._snapshot_format = items.get("snapshot_format",
+                                          DEFAULT_SNAPSHOT_FORMAT)
+        self._instance_cache_size = int(items.get(
+            "instance_cache_size", DEFAULT_INSTANCE_CACHE_SIZE))
+        self._instance_flush = items.get("instance_flush",
+                                         DEFAULT_INSTANCE_FLUSH)
+        self._max_unsaved = int(items.get("max_unsaved", DEFAULT_MAX_UNSAVED))
+        self._engine_loop = items.get("engine_loop", DEFAULT_ENGINE_LOOP)
+        self._workers = int(items.get("workers", DEFAULT_WORKERS))
+        self._message_shards = int(items.get("message_shards",
+                                             DEFAULT_MESSAGE_SHARDS))
+        self._node_id = items.get("node_id")
+        self._heartbeat_interval = float(items.get(
+            "heartbeat_interval", DEFAULT_HEARTBEAT_INTERVAL))
+        self._publisher_confirms = _getboolean(items, "publisher_confirms",
+                                               DEFAULT_PUBLISHER_CONFIRMS)
+        self._publisher_transactions = _getboolean(
+            items, "publisher_transactions", DEFAULT_PUBLISHER_TRANSACTIONS)
 
         try:
             amqp_items  = dict(config.items("amqp"))
@@ -79,6 +152,106 @@ class Configs(object):
         """Return storage_dir config parameter."""
         return self._storage_dir
 
+    @property
+    def storage_backend(self):
+        """Return storage_backend config parameter."""
+        return self._storage_backend
+
+    @property
+    def storage_layout(self):
+        """Return storage_layout config parameter."""
+        return self._storage_layout
+
+    @property
+    def storage_sync(self):
+        """Return storage_sync config parameter."""
+        return self._storage_sync
+
+    @property
+    def sync_window(self):
+        """Return sync_window config parameter."""
+        return self._sync_window
+
+    @property
+    def sync_batch(self):
+        """Return sync_batch config parameter."""
+        return self._sync_batch
+
+    @property
+    def batch_acks(self):
+        """Return batch_acks config parameter."""
+        return self._batch_acks
+
+    @property
+    def prefetch_count(self):
+        """Return prefetch_count config parameter."""
+        return self._prefetch_count
+
+    @property
+    def coalesce_messages(self):
+        """Return coalesce_messages config parameter."""
+        return self._coalesce_messages
+
+    @property
+    def compress_threshold(self):
+        """Return compress_threshold config parameter."""
+        return self._compress_threshold
+
+    @property
+    def blob_threshold(self):
+        """Return blob_threshold config parameter."""
+        return self._blob_threshold
+
+    @property
+    def journal_history(self):
+        """Return journal_history config parameter."""
+        return self._journal_history
+
+    @property
+    def local_execution(self):
+        """Return local_execution config parameter."""
+        return self._local_execution
+
+    @property
+    def persist_outbox(self):
+        """Return persist_outbox config parameter."""
+        return self._persist_outbox
+
+    @property
+    def sqlite_path(self):
+        """Return sqlite_path config parameter."""
+        return self._sqlite_path
+
+    @property
+    def definition_cache_size(self):
+        """Return definition_cache_size config parameter."""
+        return self._definition_cache_size
+
+    @property
+    def compaction_interval(self):
+        """Return compaction_interval config parameter."""
+        return self._compaction_interval
+
+    @property
+    def snapshot_format(self):
+        """Return snapshot_format config parameter."""
+        return self._snapshot_format
+
+    @property
+    def instance_cache_size(self):
+        """Return instance_cache_size config parameter."""
+        return self._instance_cache_size
+
+    @property
+    def instance_flush(self):
+        """Return instance_flush config parameter."""
+        return self._instance_flush
+
+    @property
+    def max_unsaved(self):
+        """Return max_unsaved config parameter."""
+        return self._max_unsaved
+
     @property
     def taskqueue_type(self):
         """Return taskqueue_type config parameter."""
@@ -88,3 +261,38 @@ class Configs(object):
     def amqp_params(self):
         """Return AMQP parameters."""
         return self._amqp_params
+
+    @property
+    def engine_loop(self):
+        """Return engine_loop config parameter."""
+        return self._engine_loop
+
+    @property
+    def workers(self):
+        """Return workers config parameter."""
+        return self._workers
+
+    @property
+    def message_shards(self):
+        """Return message_shards config parameter."""
+        return self._message_shards
+
+    @property
+    def node_id(self):
+        """Return node_id config parameter."""
+        return self._node_id
+
+    @property
+    def heartbeat_interval(self):
+        """Return heartbeat_interval config parameter."""
+        return self._heartbeat_interval
+
+    @property
+    def publisher_confirms(self):
+        """Return publisher_confirms config parameter."""
+        return self._publisher_confirms
+
+    @property
+    def publisher_transactions(self):
+        """Return publisher_transactions config parameter."""
+        return self._publisher_transactions
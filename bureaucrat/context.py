@@ -3,6 +3,11 @@ from __future__ import absolute_import
 import logging
 import json
 
+from bureaucrat.blobstore import BLOB_REF
+from bureaucrat.blobstore import is_blob_ref
+from bureaucrat.blobstore import dump_blob
+from bureaucrat.blobstore import resolve
+
 LOG = logging.getLogger(__name__)
 
 _RESERVED_KEYWORDS = ('inst:fault', )
@@ -12,6 +17,18 @@ class ContextError(Exception):
     """Context error."""
 
 
+class _ResolvingDict(dict):
+    """Dictionary of properties loading referred blobs on access."""
+
+    def __getitem__(self, key):
+        return resolve(dict.__getitem__(self, key))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
 # TODO: consider merging with FlowExpression (localprops smell like private to FlowExpression)
 class Context(object):
     """Represents execution context."""
@@ -22,6 +39,8 @@ class Context(object):
         self._parent = parent
         self._props = {}
         self.faults = []
+        # True if local properties have changed since last save
+        self.dirty = True
 
     def parse(self, element):
         """Parse context XML element.
@@ -31,6 +50,7 @@ class Context(object):
         """
 
         self._props = {}
+        self.dirty = True
         for child in element:
             if child.tag == 'property':
                 proptype = child.attrib["type"]
@@ -53,6 +73,10 @@ class Context(object):
 
     def get(self, key):
         """Return property's value in the current context."""
+        return resolve(self._lookup(key))
+
+    def _lookup(self, key):
+        """Return property's value without loading referred blob."""
 
         try:
             value = self._props[key]
@@ -61,7 +85,7 @@ class Context(object):
                 raise ContextError("No such property defined in the global" + \
                                    " context: %s" % key)
             else:
-                value = self._parent.get(key)
+                value = self._parent._lookup(key)
 
         return value
 
@@ -73,11 +97,13 @@ class Context(object):
 
         if key in self._props.keys():
             self._props[key] = value
+            self.dirty = True
         else:
             try:
-                self._parent.get(key)
+                self._parent._lookup(key)
             except (ContextError, AttributeError):
                 self._props[key] = value
+                self.dirty = True
             else:
                 self._parent.set(key, value)
 
@@ -88,6 +114,14 @@ class Context(object):
             "code": code,
             "message": message
         }
+        self.dirty = True
+
+    def discard(self, key):
+        """Remove property from the current context if it's defined there."""
+
+        if key in self._props:
+            del self._props[key]
+            self.dirty = True
 
     def update(self, props):
         """Update context with the given property values."""
@@ -99,15 +133,51 @@ class Context(object):
     def as_dictionary(self):
         """Return current context as dictionary."""
 
+        props = self._raw_dictionary()
+        for key, value in props.items():
+            if is_blob_ref(value):
+                props[key] = resolve(value)
+        return props
+
+    def as_lazy_dictionary(self):
+        """Return current context as dictionary loading blobs on access."""
+        return _ResolvingDict(self._raw_dictionary())
+
+    def _raw_dictionary(self):
+        """Return current context as dictionary with blob references."""
+
         props = {}
 
         if self._parent is not None:
-            props = self._parent.as_dictionary()
+            props = self._parent._raw_dictionary()
 
         props.update(self._props)
 
         return props
 
+    def externalize(self, threshold, blobs):
+        """Replace large local values with references to blobs.
+
+        :param threshold: minimal size of values moved to blobs
+        :param blobs: dictionary new blobs are added to, content hashes
+                      mapped to the documents to be stored
+        """
+
+        for key, value in self._props.items():
+            if key in _RESERVED_KEYWORDS or is_blob_ref(value) or \
+               not isinstance(value, (basestring, list, dict)):
+                continue
+            doc, digest = dump_blob(value)
+            if len(doc) >= threshold:
+                blobs[digest] = doc
+                self._props[key] = {BLOB_REF: digest}
+
+    def blob_refs(self):
+        """Return set of blobs referred by local properties."""
+
+        return set(value[BLOB_REF] for value in self._props.values()
+                   if is_blob_ref(value))
+
     @property
     def localprops(self):
         return self._props
@@ -115,3 +185,4 @@ class Context(object):
     @localprops.setter
     def localprops(self, props):
         self._props = props
+        self.dirty = True
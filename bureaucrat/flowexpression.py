@@ -1,8 +1,8 @@
 from __future__ import absolute_import
 
 import logging
-import pika
 import time
+import copy
 import json
 from HTMLParser import HTMLParser
 import xml.etree.ElementTree as ET
@@ -14,6 +14,16 @@ from bureaucrat.storage import lock_storage
 
 LOG = logging.getLogger(__name__)
 
+# Codes of states and types in compact snapshots. The codes are persisted,
+# so new names must be appended only.
+STATE_CODES = ('ready', 'active', 'completed', 'aborting', 'aborted',
+               'canceling', 'canceled')
+TYPE_CODES = ('process', 'sequence', 'faults', 'faultcase', 'action',
+              'delay', 'await', 'case', 'switch', 'while', 'all', 'call',
+              'fault', 'assign', 'foreach')
+_STATE_INDEX = dict((name, code) for code, name in enumerate(STATE_CODES))
+_TYPE_INDEX = dict((name, code) for code, name in enumerate(TYPE_CODES))
+
 def is_state_final(state):
     """Check if state is final."""
     return state in ('completed', 'aborted', 'canceled')
@@ -60,7 +70,7 @@ def _create_fe_from_element(parent_id, element, fei, context):
     return expr
 
 
-@lock_storage
+@lock_storage("subscriptions")
 def _subscribe(event, target):
     """Subscribe given target to event."""
     storage = Storage.instance()
@@ -84,6 +94,8 @@ class FlowExpression(object):
     is_ctx_allowed = True # TODO: refactor to introduce simple and complex activities
     is_cond_allowed = False
     is_handler = False
+    # True if the expression waits for an external message when active
+    is_wait_state = False
 
     def __init__(self, parent_id, element, fei, context):
         """Constructor."""
@@ -112,6 +124,17 @@ class FlowExpression(object):
             else:
                 self._parse_non_child(child)
 
+    @property
+    def state(self):
+        """Return state of the flow expression."""
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        """Set state of the flow expression and mark it as changed."""
+        self._state = value
+        self._dirty = True
+
     def __str__(self):
         """String representation."""
         return "%s" % self.id
@@ -170,6 +193,158 @@ class FlowExpression(object):
         for child, childstate in zip(self.children, state["children"]):
             child.reset_state(childstate)
 
+    def compact_snapshot(self):
+        """Return flow expression snapshot in compact form.
+
+        The snapshot is a tuple (state, type, context, faults, children)
+        where state and type are codes from STATE_CODES and TYPE_CODES.
+        IDs are not stored as they follow from positions of children.
+        """
+
+        context = None
+        faults = None
+        if self.is_ctx_allowed:
+            context = self.context.localprops
+            if self.faults:
+                faults = self.faults.compact_snapshot()
+        return (_STATE_INDEX[self.state], _TYPE_INDEX[self.fe_name],
+                context, faults,
+                tuple(child.compact_snapshot() for child in self.children))
+
+    def reset_compact_state(self, state):
+        """Reset activity's state from compact snapshot."""
+
+        code, type_code, context, faults, children = state
+        assert TYPE_CODES[type_code] == self.fe_name
+        self.state = STATE_CODES[code]
+        if self.is_ctx_allowed:
+            self.context.localprops = context
+            if self.faults:
+                self.faults.reset_compact_state(faults)
+        for child, childstate in zip(self.children, children):
+            child.reset_compact_state(childstate)
+
+    def delta(self):
+        """Return states of flow expressions changed since mark_clean().
+
+        :return: dictionary mapping IDs of changed expressions to their
+                 states and local contexts
+        """
+
+        delta = {}
+        self._collect_delta(delta)
+        return delta
+
+    def _collect_delta(self, delta):
+        """Add state of the expression and its children to delta if changed."""
+
+        if self._dirty or (self.is_ctx_allowed and self.context.dirty):
+            node = {
+                "state": self.state
+            }
+            if self.is_ctx_allowed:
+                node["context"] = self.context.localprops
+            delta[self.id] = node
+        for child in self.children:
+            child._collect_delta(delta)
+        if self.faults:
+            self.faults._collect_delta(delta)
+
+    def apply_delta(self, delta):
+        """Apply changes recorded with delta()."""
+
+        if self.id in delta:
+            node = delta[self.id]
+            self.state = node["state"]
+            if self.is_ctx_allowed:
+                self.context.localprops = node["context"]
+        for child in self.children:
+            child.apply_delta(delta)
+        if self.faults:
+            self.faults.apply_delta(delta)
+
+    def externalize(self, threshold, blobs):
+        """Move large values of changed contexts to blobs.
+
+        See Context.externalize().
+        """
+
+        if self.is_ctx_allowed and self.context.dirty:
+            self.context.externalize(threshold, blobs)
+        for child in self.children:
+            child.externalize(threshold, blobs)
+        if self.faults:
+            self.faults.externalize(threshold, blobs)
+
+    def blob_refs(self):
+        """Return set of blobs referred by the expression and its children."""
+
+        refs = set()
+        if self.is_ctx_allowed:
+            refs.update(self.context.blob_refs())
+        for child in self.children:
+            refs.update(child.blob_refs())
+        if self.faults:
+            refs.update(self.faults.blob_refs())
+        return refs
+
+    def mark_clean(self):
+        """Mark the expression and its children as saved."""
+
+        self._dirty = False
+        if self.is_ctx_allowed:
+            self.context.dirty = False
+        for child in self.children:
+            child.mark_clean()
+        if self.faults:
+            self.faults.mark_clean()
+
+    def is_waiting(self):
+        """Return True if only an external message can move it forward.
+
+        Complex expressions are waiting when all their running children,
+        the fault handler included, are waiting. Expressions being aborted
+        or canceled are still running.
+        """
+
+        if self.state not in ('active', 'aborting', 'canceling'):
+            return False
+        if self.is_wait_state:
+            return self.state == 'active'
+        children = self.children
+        if self.faults:
+            children = children + [self.faults]
+        running = [child for child in children
+                   if child.state != 'ready' and \
+                   not is_state_final(child.state)]
+        return len(running) > 0 and \
+                all(child.is_waiting() for child in running)
+
+    def instantiate(self, parent_id, fei, context):
+        """Return copy of the expression bound to new ID and context.
+
+        It's used to create flow expressions from a compiled template
+        without parsing the process definition again. The template itself
+        is left intact.
+        """
+
+        expr = copy.copy(self)
+        expr.id = fei
+        expr.parent_id = parent_id
+        if self.is_ctx_allowed:
+            expr.context = Context(context)
+            expr.context.localprops = copy.deepcopy(self.context.localprops)
+        else:
+            expr.context = context
+        expr.children = [child.instantiate(fei,
+                                           fei + child.id[len(self.id):],
+                                           expr.context)
+                         for child in self.children]
+        if self.faults:
+            expr.faults = self.faults.instantiate(
+                fei, fei + self.faults.id[len(self.id):], expr.context)
+        return expr
+
     def handle_message(self, channel, msg):
         """Handle message.
 
@@ -225,7 +400,7 @@ class FlowExpression(object):
                 msg.target == self.id:
             if msg.name == 'completed' and msg.origin.endswith("faults"):
                 self.state = 'completed'
-                del self.context._props['inst:fault']
+                self.context.discard('inst:fault')
                 channel.send(Message(name='completed', target=self.parent_id,
                                      origin=self.id))
             elif sum([int(is_state_final(child.state))
@@ -360,6 +535,10 @@ class Process(FlowExpression):
 
     allowed_child_types = _get_supported_activities()
 
+    def is_waiting(self):
+        """Return True if only an external message can move it forward."""
+        return is_state_final(self.state) or FlowExpression.is_waiting(self)
+
     def handle_message(self, channel, msg):
         """Handle message in process instance."""
         LOG.debug("Handling %r in %r", msg, self)
@@ -481,6 +660,7 @@ class Action(FlowExpression):
     """An action activity."""
 
     is_ctx_allowed = False
+    is_wait_state = True
 
     def __init__(self, parent_id, element, fei, context):
         """Constructor."""
@@ -547,6 +727,7 @@ class Delay(FlowExpression):
     """A delay activity."""
 
     is_ctx_allowed = False
+    is_wait_state = True
 
     def __init__(self, parent_id, element, fei, context):
         """Constructor."""
@@ -589,6 +770,7 @@ class Await(FlowExpression):
     """A await activity."""
 
     is_ctx_allowed = False
+    is_wait_state = True
     is_cond_allowed = True
 
     def __init__(self, parent_id, element, fei, context):
@@ -609,7 +791,7 @@ class Await(FlowExpression):
             return True
 
         for cond in self.conditions:
-            if eval(cond, {"context": self.context.as_dictionary()}):
+            if eval(cond, {"context": self.context.as_lazy_dictionary()}):
                 LOG.debug("Condition %s evaluated to True", cond)
                 return True
             else:
@@ -663,7 +845,7 @@ class Case(FlowExpression):
         """Check if conditions are met."""
 
         for cond in self.conditions:
-            if eval(cond, {"context": self.context.as_dictionary()}):
+            if eval(cond, {"context": self.context.as_lazy_dictionary()}):
                 LOG.debug("Condition %s evaluated to True", cond)
                 return True
             else:
@@ -738,11 +920,18 @@ class While(FlowExpression):
         self._parent_ctx = context
         self._element = element
 
+    def instantiate(self, parent_id, fei, context):
+        """Return copy of the expression bound to new ID and context."""
+
+        expr = FlowExpression.instantiate(self, parent_id, fei, context)
+        expr._parent_ctx = context
+        return expr
+
     def evaluate(self):
         """Check if conditions are met."""
 
         for cond in self.conditions:
-            if eval(cond, {"context": self.context.as_dictionary()}):
+            if eval(cond, {"context": self.context.as_lazy_dictionary()}):
                 LOG.debug("Condition %s evaluated to True", cond)
                 return True
             else:
@@ -814,6 +1003,7 @@ class Call(FlowExpression):
     """Call activity."""
 
     is_ctx_allowed = False
+    is_wait_state = True
 
     def __init__(self, parent_id, element, fei, context):
         """Constructor."""
@@ -839,13 +1029,7 @@ class Call(FlowExpression):
             root = ET.fromstring(self.context.get(ref))
             assert root.tag == 'process'
             root.set('parent', self.id)
-            pdef = ET.tostring(root)
-            channel._ch.basic_publish(exchange='', # TODO: refactor to avoid private attribute
-                                      routing_key='bureaucrat',
-                                      body=pdef,
-                                      properties=pika.BasicProperties(
-                                          delivery_mode=2
-                                      ))
+            channel.launch(ET.tostring(root))
         elif self._is_complete_message(msg):
             LOG.debug("Subprocess initiated in %s has completed", self.id)
             self.state = 'completed'
@@ -917,7 +1101,7 @@ class Assign(FlowExpression):
         if self._is_start_message(msg):
             self.context.set(self.propname,
                              eval(self.expr, {
-                                 "context": self.context.as_dictionary()
+                                 "context": self.context.as_lazy_dictionary()
                              }))
             self.state = 'completed'
             channel.send(Message(name='completed', origin=self.id,
@@ -940,6 +1124,13 @@ class Foreach(FlowExpression):
         self._parent_ctx = context
         self._element = element
 
+    def instantiate(self, parent_id, fei, context):
+        """Return copy of the expression bound to new ID and context."""
+
+        expr = FlowExpression.instantiate(self, parent_id, fei, context)
+        expr._parent_ctx = context
+        return expr
+
     def _activate(self, msg):
         if self._is_start_message(msg):
             selection = self._parent_ctx
@@ -1,13 +1,23 @@
 from __future__ import absolute_import
 
+import os
 import json
 import pika
 import xml.etree.ElementTree as ET
 
 from bureaucrat.utils import context2dict
+from bureaucrat.channelwrapper import LAUNCH_PROPERTIES
+from bureaucrat.channelwrapper import TransactionalChannel
+
+DEFAULT_BATCH_SIZE = 500
 
 class Launcher(object):
-    """Launches workflow processes."""
+    """Launches workflow processes.
+
+    The connection to the broker is opened on first launch and kept open
+    until close() is called. Parsed process definitions are cached until
+    their files change.
+    """
 
     def __init__(self, config):
         """Initialize launcher."""
@@ -23,9 +33,76 @@ class Launcher(object):
             virtual_host=amqp_vhost)
         self.launcher_key = config.get("launcher_routing_key", "bureaucrat")
         self.exchange = config.get("launcher_exchange", "")
+        self.transactions = config.get("launcher_transactions",
+                                       "no").lower() in \
+                ('1', 'yes', 'true', 'on')
+        self._connection = None
+        self._channel = None
+        # parsed definitions by path: (mtime, process element, context)
+        self._templates = {}
+
+    def __enter__(self):
+        """Enter context."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close connection on leaving context."""
+        self.close()
+
+    def close(self):
+        """Close connection to the broker."""
+
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+        self._connection = None
+        self._channel = None
 
     def launch(self, process_path, fields):
         """Launch process."""
+        self.launch_many([(process_path, fields)])
+
+    def launch_many(self, launches, batch_size=DEFAULT_BATCH_SIZE):
+        """Launch processes in bulk.
+
+        With transactions enabled every `batch_size` launches are
+        published in one AMQP transaction.
+
+        :param launches: iterable of (process_path, fields) pairs
+        :returns: number of launched processes
+        """
+
+        channel = self._get_channel()
+        count = 0
+        for process_path, fields in launches:
+            channel.basic_publish(exchange=self.exchange,
+                                  routing_key=self.launcher_key,
+                                  body=self._definition(process_path, fields),
+                                  properties=LAUNCH_PROPERTIES)
+            count += 1
+            if self.transactions and count % batch_size == 0:
+                channel.commit()
+        if self.transactions:
+            channel.commit()
+        return count
+
+    def _get_channel(self):
+        """Return channel of open connection."""
+
+        if self._connection is None or not self._connection.is_open:
+            self._connection = pika.BlockingConnection(self.amqp_params)
+            channel = self._connection.channel()
+            if self.transactions:
+                channel = TransactionalChannel(channel)
+            self._channel = channel
+        return self._channel
+
+    def _template(self, process_path):
+        """Return process element and its context from the file."""
+
+        mtime = os.stat(process_path).st_mtime
+        cached = self._templates.get(process_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1], cached[2]
 
         tree = ET.parse(process_path)
         proc_elem = tree.getroot()
@@ -37,6 +114,14 @@ class Launcher(object):
         if ctx is not None:
             context = context2dict(ctx)
             proc_elem.remove(ctx)
+        self._templates[process_path] = (mtime, proc_elem, context)
+        return proc_elem, context
+
+    def _definition(self, process_path, fields):
+        """Return definition of process with the fields in its context."""
+
+        template, context = self._template(process_path)
+        context = dict(context)
         context.update(fields)
 
         ctx = ET.Element('context')
@@ -59,15 +144,9 @@ class Launcher(object):
                 prop.text = json.dumps(value)
             ctx.append(prop)
 
-        proc_elem.insert(0, ctx)
-        pdef = ET.tostring(proc_elem)
-
-        connection = pika.BlockingConnection(self.amqp_params)
-        channel = connection.channel()
-        channel.basic_publish(exchange=self.exchange,
-                              routing_key=self.launcher_key,
-                              body=pdef,
-                              properties=pika.BasicProperties(
-                                  delivery_mode=2
-                              ))
-        connection.close()
+        # the template's activities are shared, they're only serialized
+        proc_elem = ET.Element(template.tag, template.attrib)
+        proc_elem.text = template.text
+        proc_elem.append(ctx)
+        proc_elem.extend(list(template))
+        return ET.tostring(proc_elem)
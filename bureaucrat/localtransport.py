@@ -0,0 +1,212 @@
+"""In-memory transport.
+
+Runs process instances in a single Python process without an AMQP broker.
+LocalChannel stands in for the AMQP channel behind ChannelWrapper and
+keeps published messages in a local queue. LocalEngine feeds them back to
+the engine's handlers one by one, in the order they have been published,
+so that runs are deterministic. It's meant for embedding the engine and
+for measuring its throughput without the broker.
+
+Participants are plain callables taking the payload of a work item and
+returning the resulting payload. Only the 'taskqueue' task queue type is
+supported.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import json
+
+from collections import deque
+from collections import namedtuple
+
+from bureaucrat.bureaucrat import Bureaucrat
+from bureaucrat.asyncloop import Timer
+from bureaucrat.channelwrapper import ChannelWrapper
+from bureaucrat.configs import Configs
+from bureaucrat.message import Message
+from bureaucrat.schedule import Schedule
+from bureaucrat.workflow import republish_outboxes
+
+LOG = logging.getLogger(__name__)
+
+PARTICIPANT_PREFIX = 'worker_'
+
+Delivery = namedtuple("Delivery", ["delivery_tag", "routing_key"])
+
+
+class LocalChannel(object):
+    """AMQP channel keeping published messages in memory."""
+
+    def __init__(self):
+        """Initialize channel."""
+
+        self.queue = deque()
+        # deliveries taken from the queue and not acknowledged yet
+        self.unacked = {}
+        self._last_tag = 0
+
+    def __len__(self):
+        """Return number of messages waiting in the queue."""
+        return len(self.queue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        """Publish message."""
+        self.queue.append((routing_key, body))
+
+    def get(self):
+        """Return next delivery and its body or None if there's none."""
+
+        if not self.queue:
+            return None
+        routing_key, body = self.queue.popleft()
+        self._last_tag += 1
+        self.unacked[self._last_tag] = (routing_key, body)
+        return Delivery(self._last_tag, routing_key), body
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        """Acknowledge delivery."""
+
+        if multiple:
+            for tag in [tag for tag in self.unacked if tag <= delivery_tag]:
+                del self.unacked[tag]
+        else:
+            del self.unacked[delivery_tag]
+
+    def basic_nack(self, delivery_tag):
+        """Requeue delivery."""
+        self.queue.appendleft(self.unacked.pop(delivery_tag))
+
+
+class LocalEngine(object):
+    """Engine running process instances without a broker."""
+
+    def __init__(self, participants=None):
+        """Initialize engine.
+
+        :param participants: callables handling work items by participant
+                             name
+        :type participants: dict
+        """
+
+        self.config = Configs.instance()
+        self.channel = LocalChannel()
+        if participants is None:
+            participants = {}
+        self.participants = participants
+        self.timers = []
+        # IDs of process instances that have completed, subprocesses too
+        self.finished = []
+        # deliveries no handler or participant has been found for
+        self.unhandled = []
+        self.app = Bureaucrat()
+        self.app.setup(self.config)
+        self.app.channel = self.channel
+        self.app.connection = self
+        self.app.schedule = Schedule(ChannelWrapper(self.channel))
+        republish_outboxes(ChannelWrapper(self.channel))
+
+    def launch(self, pdef):
+        """Launch process instance from the definition."""
+        ChannelWrapper(self.channel).launch(pdef)
+
+    def send(self, message):
+        """Send message to a process instance."""
+        ChannelWrapper(self.channel).send(message)
+
+    def trigger(self, event):
+        """Trigger event subscribed to by process instances."""
+        self.channel.basic_publish(exchange='',
+                                   routing_key=self.config.event_queue,
+                                   body=json.dumps({"event": event}))
+
+    def alarm(self):
+        """Send scheduled events which are due."""
+        self.app.schedule.handle_alarm()
+
+    def add_timeout(self, deadline, callback):
+        """Call the callback when the queue is drained."""
+
+        timer = Timer(callback)
+        self.timers.append(timer)
+        return timer
+
+    def remove_timeout(self, timer):
+        """Remove timer."""
+        timer.canceled = True
+
+    def step(self):
+        """Handle next delivery or fire timers if there's none.
+
+        :returns: False if there was nothing to do
+        """
+
+        delivery = self.channel.get()
+        if delivery is None:
+            if not self.timers:
+                return False
+            timers, self.timers = self.timers, []
+            for timer in timers:
+                timer.fire()
+            return True
+
+        method, body = delivery
+        handler = self._handler(method.routing_key)
+        if handler is None:
+            LOG.warning("No handler for %s", method.routing_key)
+            self.unhandled.append((method.routing_key, body))
+            self.channel.basic_ack(method.delivery_tag)
+        else:
+            handler(self.channel, method, None, body)
+        return True
+
+    def run(self, max_steps=None):
+        """Handle deliveries until there are none left.
+
+        :returns: number of steps done
+        """
+
+        steps = 0
+        while (max_steps is None or steps < max_steps) and self.step():
+            steps += 1
+        return steps
+
+    def _handler(self, routing_key):
+        """Return handler of deliveries routed with the key."""
+
+        queue = self.config.message_queue
+        if routing_key == queue or routing_key.startswith(queue + '.'):
+            return self._handle_message
+        elif routing_key == 'bureaucrat':
+            return self.app.launch_process
+        elif routing_key == self.config.event_queue:
+            return self.app.handle_event
+        elif routing_key == 'bureaucrat_schedule':
+            return self.app.add_schedule
+        elif routing_key.startswith(PARTICIPANT_PREFIX) and \
+             routing_key[len(PARTICIPANT_PREFIX):] in self.participants:
+            return self._elaborate
+        return None
+
+    def _handle_message(self, channel, method, header, body):
+        """Handle message and keep track of completed processes."""
+
+        self.app.handle_message(channel, method, header, body)
+        try:
+            msg = Message.loads(body)
+        except (ValueError, KeyError):
+            return
+        if msg.name == 'completed' and msg.origin == msg.origin_pid:
+            self.finished.append(msg.origin)
+
+    def _elaborate(self, channel, method, header, body):
+        """Pass work item to the participant and send back the response."""
+
+        participant = method.routing_key[len(PARTICIPANT_PREFIX):]
+        task = Message.loads(body)
+        payload = self.participants[participant](task.payload)
+        if payload is None:
+            payload = task.payload
+        self.send(Message(name='response', target=task.target,
+                          origin=task.origin, payload=payload))
+        channel.basic_ack(method.delivery_tag)
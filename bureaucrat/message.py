@@ -34,12 +34,16 @@ class Message(object):
     # needed for taskqueue
     def dumps(self):
         """Return message as string."""
-        return json.dumps({
+        return json.dumps(self.as_dictionary())
+
+    def as_dictionary(self):
+        """Return message as dictionary."""
+        return {
             "name": self._name,
             "target": self._target,
             "origin": self._origin,
             "payload": self._payload
-        })
+        }
 
     @property
     def name(self):
@@ -18,7 +18,7 @@ class Schedule(object):
 
         self.channel = channel
 
-    @lock_storage
+    @lock_storage("schedule")
     def register(self, code, instant, target):
         """Register new schedule."""
         LOG.debug("Register '%s' for %s at %d", code, target, instant)
@@ -35,7 +35,7 @@ class Schedule(object):
         })
         storage.save("schedule", str(instant), json.dumps(schedules))
 
-    @lock_storage
+    @lock_storage("schedule")
     def handle_alarm(self):
         """Load schedule."""
 
@@ -50,4 +50,5 @@ class Schedule(object):
                                               origin="", target=sch["target"]))
                     LOG.debug("Sent '%s' to %s", sch["code"],
                               sch["target"])
+                self.channel.commit()
                 storage.delete("schedule", key)
@@ -0,0 +1,124 @@
+"""Sharded message queues.
+
+Messages are spread over `message_shards` queues named
+<message_queue>.<shard>. The shard of a process instance is picked by
+jump consistent hash of its ID, so only a small part of the instances move
+if the number of shards changes. Every engine node consumes the shards
+assigned to it by rendezvous hashing over the live nodes: when a node
+joins or leaves only the shards it takes or gives up change hands.
+
+Nodes learn about each other from heartbeats broadcast over the
+'bureaucrat_nodes' fanout exchange.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import hashlib
+import time
+
+from bureaucrat.configs import Configs
+
+LOG = logging.getLogger(__name__)
+
+NODES_EXCHANGE = 'bureaucrat_nodes'
+
+# a node is considered gone after missing this many heartbeats
+MISSED_HEARTBEATS = 3
+
+
+def _digest64(key):
+    """Return 64 bit hash of the string."""
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+def jump_hash(key, buckets):
+    """Return bucket of the 64 bit key (Lamping & Veach jump hash)."""
+
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def shard_of(process_id, shards):
+    """Return shard of the process instance."""
+    return jump_hash(_digest64(process_id), shards)
+
+
+def shard_queue(shard, config=None):
+    """Return name of the shard's queue."""
+
+    config = config or Configs.instance()
+    return "%s.%d" % (config.message_queue, shard)
+
+
+def message_queue(process_id, config=None):
+    """Return queue for messages targeted at the process instance."""
+
+    config = config or Configs.instance()
+    if config.message_shards > 0:
+        return shard_queue(shard_of(process_id, config.message_shards),
+                           config)
+    return config.message_queue
+
+
+def owner(shard, nodes):
+    """Return the node the shard is assigned to."""
+    return max(nodes, key=lambda node: _digest64("%s:%d" % (node, shard)))
+
+
+def assigned_shards(node, nodes, shards):
+    """Return set of shards assigned to the node."""
+    return set(shard for shard in range(shards) if owner(shard, nodes) == node)
+
+
+class Membership(object):
+    """Live engine nodes as seen from one of them."""
+
+    def __init__(self, node, interval):
+        """Initialize membership.
+
+        :param node: ID of the local node
+        :param interval: heartbeat interval in seconds
+        """
+
+        self.node = node
+        self.interval = interval
+        self.last_seen = {}
+
+    @property
+    def nodes(self):
+        """Return IDs of live nodes including the local one."""
+        return sorted(set(self.last_seen.keys()) | set([self.node]))
+
+    def heartbeat(self, node, leaving=False, instant=None):
+        """Register heartbeat of the node.
+
+        :returns: True if the set of live nodes has changed
+        """
+
+        if node == self.node:
+            return False
+        if leaving:
+            return self.last_seen.pop(node, None) is not None
+        known = node in self.last_seen
+        self.last_seen[node] = instant or time.time()
+        return not known
+
+    def expire(self, instant=None):
+        """Forget nodes missing heartbeats.
+
+        :returns: True if the set of live nodes has changed
+        """
+
+        deadline = (instant or time.time()) - \
+                MISSED_HEARTBEATS * self.interval
+        gone = [node for node, seen in self.last_seen.items()
+                if seen < deadline]
+        for node in gone:
+            LOG.warning("Node %s is gone", node)
+            del self.last_seen[node]
+        return len(gone) > 0
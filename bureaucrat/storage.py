@@ -2,33 +2,554 @@
 
 from __future__ import absolute_import
 
+import errno
 import logging
 import os
 import os.path
 import fcntl
+import hashlib
+import shutil
+import sqlite3
+import thread
+import threading
+import time
+import zlib
 
 from bureaucrat.configs import Configs
 
 LOG = logging.getLogger(__name__)
-LOCK_FILE = '/tmp/bureaucrat-schedule.lock'
+LOCK_DIR = '/tmp/bureaucrat-locks'
+# Number of lock files the keys of each resource type are spread over
+LOCK_STRIPES = 1024
+# Header of compressed documents
+COMPRESSED_MAGIC = '\x00ZLB'
+# Header of documents starting with a small uncompressed header
+HEADER_MAGIC = '\x00HDR'
+# Maximal length of the header
+MAX_HEADER = 255
 
 class StorageError(Exception):
     """Storage error."""
 
-def lock_storage(func):
-    """Decorator to lock storage."""
+class _LockState(object):
+    """State of a named lock held by the current process."""
+    # pylint: disable=R0903
 
-    def new_func(*args, **kwargs):
-        """Wrapper function."""
-        with open(LOCK_FILE, 'w') as fhdl:
-            fcntl.lockf(fhdl, fcntl.LOCK_EX)
-            result = func(*args, **kwargs)
-            fcntl.lockf(fhdl, fcntl.LOCK_UN)
-            return result
-    return new_func
+    def __init__(self):
+        self.mutex = threading.RLock()
+        self.fhdl = None
+        self.depth = 0
+
+class StorageLock(object):
+    """Context manager holding an exclusive lock on a storage resource.
+
+    Resources are identified by name, every name has its own lock file in
+    LOCK_DIR. The lock is reentrant: nested sections locking the same
+    resource don't release the file lock prematurely.
+    """
+
+    _states = {}
+    _guard = threading.Lock()
+
+    def __init__(self, name):
+        """Initialize the lock."""
+
+        self.name = name
+
+    def __enter__(self):
+        with self._guard:
+            state = self._states.setdefault(self.name, _LockState())
+        state.mutex.acquire()
+        if state.depth == 0:
+            if not os.path.isdir(LOCK_DIR):
+                try:
+                    os.makedirs(LOCK_DIR)
+                except OSError:
+                    if not os.path.isdir(LOCK_DIR):
+                        raise
+            state.fhdl = open(os.path.join(LOCK_DIR,
+                                           "%s.lock" % self.name), 'w')
+            fcntl.lockf(state.fhdl, fcntl.LOCK_EX)
+        state.depth += 1
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, exc_tb=None):
+        state = self._states[self.name]
+        state.depth -= 1
+        if state.depth == 0:
+            fcntl.lockf(state.fhdl, fcntl.LOCK_UN)
+            state.fhdl.close()
+            state.fhdl = None
+        state.mutex.release()
+
+def striped_lock(resource, key):
+    """Return lock protecting the resource identified by the key.
+
+    Keys are spread over LOCK_STRIPES lock files per resource type, so
+    the number of lock files stays fixed however many keys there are and
+    unrelated keys rarely contend with each other.
+    """
+
+    stripe = (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % LOCK_STRIPES
+    return StorageLock("%s-%04d" % (resource, stripe))
+
+def instance_lock(process_id):
+    """Return lock protecting documents of the given process instance."""
+    return striped_lock("process", process_id)
+
+def _fsync_dir(path):
+    """Fsync directory so that changes of its entries are durable."""
+
+    fdesc = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fdesc)
+    finally:
+        os.close(fdesc)
+
+def lock_storage(resource):
+    """Decorator to lock the given storage resource."""
+
+    def decorator(func):
+        """Actual decorator."""
+
+        def new_func(*args, **kwargs):
+            """Wrapper function."""
+            with StorageLock(resource):
+                return func(*args, **kwargs)
+        return new_func
+    return decorator
+
+class StorageBackend(object):
+    """Interface of storage backends.
+
+    A backend keeps documents (strings) identified by a bucket name and
+    a key unique within the bucket.
+    """
+
+    def save(self, bucket, key, doc):
+        """Save document in storage."""
+        raise NotImplementedError
+
+    def append(self, bucket, key, doc):
+        """Append string to document, create the document if needed."""
+        raise NotImplementedError
+
+    def load(self, bucket, key):
+        """Load document from storage."""
+        raise NotImplementedError
+
+    def load_prefix(self, bucket, key, size):
+        """Load at most `size` first bytes of document from storage."""
+        return self.load(bucket, key)[:size]
+
+    def delete(self, bucket, key):
+        """Delete document from storage."""
+        raise NotImplementedError
+
+    def keys(self, bucket):
+        """Return iterable over keys in the bucket."""
+        raise NotImplementedError
+
+    def exists(self, bucket, key):
+        """Retrun true if key exists in bucket."""
+        raise NotImplementedError
+
+    def sync(self):
+        """Make documents written so far durable."""
+
+class FilesystemBackend(StorageBackend):
+    """Backend storing every document in its own file.
+
+    With the 'flat' layout documents are kept in `storage_dir/<bucket>/<key>`.
+    The 'sharded' layout spreads them over subdirectories named after the
+    hash of the key, e.g. `storage_dir/<bucket>/ab/cd/<key>`, so that
+    directories stay small.
+
+    Documents are saved to a temporary file which then replaces the
+    document, so readers never see a partially written one. The `sync`
+    mode tells when files are flushed to disk: 'none' leaves it to the OS,
+    'always' fsyncs on every write and 'group' postpones fsyncs until
+    sync() is called.
+    """
+
+    def __init__(self, storage_dir, layout='flat', sync='none'):
+        """Initialize the backend."""
+
+        if layout not in ('flat', 'sharded'):
+            raise StorageError("Unknown storage layout: %s" % layout)
+        if sync not in ('none', 'always', 'group'):
+            raise StorageError("Unknown storage sync mode: %s" % sync)
+
+        self._dir_cache = set()
+        self.storage_dir = storage_dir
+        self.layout = layout
+        self.sync_mode = sync
+        self._pending_files = set()
+        self._pending_dirs = set()
+        self._pending_lock = threading.Lock()
+
+        if not os.path.isdir(self.storage_dir):
+            os.makedirs(self.storage_dir)
+
+    def _doc_dir(self, bucket, key):
+        """Return path to directory holding the document."""
+
+        bucket_path = os.path.join(self.storage_dir, bucket)
+        if self.layout == 'flat':
+            return bucket_path
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return os.path.join(bucket_path, digest[:2], digest[2:4])
+
+    def _doc_path(self, bucket, key):
+        """Return path to document."""
+        return os.path.join(self._doc_dir(bucket, key), key)
+
+    def _make_doc_dir(self, bucket, key):
+        """Create directory for the document if needed and return its path."""
+
+        doc_dir = self._doc_dir(bucket, key)
+        if doc_dir not in self._dir_cache:
+            if not os.path.isdir(doc_dir):
+                try:
+                    os.makedirs(doc_dir)
+                except OSError:
+                    if not os.path.isdir(doc_dir):
+                        raise
+            self._dir_cache.add(doc_dir)
+        return doc_dir
+
+    def _written(self, fhdl):
+        """Flush written file according to the sync mode."""
+
+        if self.sync_mode == 'always':
+            fhdl.flush()
+            os.fsync(fhdl.fileno())
+        elif self.sync_mode == 'group':
+            with self._pending_lock:
+                self._pending_files.add(fhdl.name)
+
+    def _dir_changed(self, doc_dir):
+        """Flush changed directory according to the sync mode."""
+
+        if self.sync_mode == 'always':
+            _fsync_dir(doc_dir)
+        elif self.sync_mode == 'group':
+            with self._pending_lock:
+                self._pending_dirs.add(doc_dir)
+
+    def save(self, bucket, key, doc):
+        """Save document in storage."""
+
+        doc_dir = self._make_doc_dir(bucket, key)
+        doc_path = os.path.join(doc_dir, key)
+        # temporary files are hidden from keys()
+        tmp_path = os.path.join(doc_dir, ".%s.%d.%d.tmp" % \
+                                (key, os.getpid(), thread.get_ident()))
+        with open(tmp_path, 'w') as fhdl:
+            fhdl.write(doc)
+            if self.sync_mode == 'always':
+                fhdl.flush()
+                os.fsync(fhdl.fileno())
+        os.rename(tmp_path, doc_path)
+        if self.sync_mode == 'group':
+            with self._pending_lock:
+                self._pending_files.add(doc_path)
+        self._dir_changed(doc_dir)
+
+    def append(self, bucket, key, doc):
+        """Append string to document, create the document if needed."""
+
+        doc_dir = self._make_doc_dir(bucket, key)
+        with open(os.path.join(doc_dir, key), 'a') as fhdl:
+            fhdl.write(doc)
+            self._written(fhdl)
+        self._dir_changed(doc_dir)
+
+    def load(self, bucket, key):
+        """Load document from storage."""
+
+        with open(self._doc_path(bucket, key)) as fhdl:
+            return fhdl.read()
+
+    def load_prefix(self, bucket, key, size):
+        """Load at most `size` first bytes of document from storage."""
+
+        with open(self._doc_path(bucket, key)) as fhdl:
+            return fhdl.read(size)
+
+    def delete(self, bucket, key):
+        """Delete document from storage."""
+
+        doc_path = self._doc_path(bucket, key)
+        os.unlink(doc_path)
+        self._dir_changed(os.path.dirname(doc_path))
+
+    def keys(self, bucket):
+        """Return iterator over keys in the bucket.
+
+        With the sharded layout one shard directory is listed at a time.
+        """
+
+        bucket_path = os.path.join(self.storage_dir, bucket)
+        if not os.path.isdir(bucket_path):
+            return
+        if self.layout == 'flat':
+            for key in os.listdir(bucket_path):
+                if not key.startswith('.'):
+                    yield key
+            return
+        for level1 in sorted(os.listdir(bucket_path)):
+            level1_path = os.path.join(bucket_path, level1)
+            if len(level1) != 2 or not os.path.isdir(level1_path):
+                continue
+            for level2 in sorted(os.listdir(level1_path)):
+                level2_path = os.path.join(level1_path, level2)
+                if len(level2) != 2 or not os.path.isdir(level2_path):
+                    continue
+                for key in os.listdir(level2_path):
+                    if not key.startswith('.'):
+                        yield key
+
+    def exists(self, bucket, key):
+        """Retrun true if key exists in bucket."""
+        return os.path.exists(self._doc_path(bucket, key))
+
+    def sync(self):
+        """Fsync files and directories changed since the last sync."""
+
+        with self._pending_lock:
+            files = self._pending_files
+            dirs = self._pending_dirs
+            self._pending_files = set()
+            self._pending_dirs = set()
+        for path in files:
+            try:
+                fdesc = os.open(path, os.O_RDONLY)
+            except OSError as err:
+                # the file has been deleted since it was written
+                if err.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                os.fsync(fdesc)
+            finally:
+                os.close(fdesc)
+        for path in dirs:
+            _fsync_dir(path)
+
+    def buckets(self):
+        """Return list of existing buckets."""
+
+        return [name for name in os.listdir(self.storage_dir)
+                if os.path.isdir(os.path.join(self.storage_dir, name))]
+
+    def convert_layout(self, bucket):
+        """Move documents stored in the other layout to the current one.
+
+        It must not run concurrently with the engine.
+
+        :return: number of moved documents
+        """
+
+        bucket_path = os.path.join(self.storage_dir, bucket)
+        moved = 0
+        if self.layout == 'sharded':
+            for key in os.listdir(bucket_path):
+                path = os.path.join(bucket_path, key)
+                if os.path.isfile(path) and not key.startswith('.'):
+                    shutil.move(path, os.path.join(
+                        self._make_doc_dir(bucket, key), key))
+                    moved += 1
+        else:
+            for level1 in os.listdir(bucket_path):
+                level1_path = os.path.join(bucket_path, level1)
+                if len(level1) != 2 or not os.path.isdir(level1_path):
+                    continue
+                for level2 in os.listdir(level1_path):
+                    level2_path = os.path.join(level1_path, level2)
+                    for key in os.listdir(level2_path):
+                        shutil.move(os.path.join(level2_path, key),
+                                    os.path.join(bucket_path, key))
+                        moved += 1
+                    os.rmdir(level2_path)
+                os.rmdir(level1_path)
+        return moved
+
+class SqliteBackend(StorageBackend):
+    """Backend keeping all documents in one SQLite database file.
+
+    The database runs in WAL mode so that readers don't block the writer.
+    In the 'always' sync mode every transaction is synced, in the 'group'
+    mode the log is synced on sync() only.
+    """
+
+    def __init__(self, path, sync='none'):
+        """Initialize the backend."""
+
+        if sync not in ('none', 'always', 'group'):
+            raise StorageError("Unknown storage sync mode: %s" % sync)
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.path = path
+        self.sync_mode = sync
+        self._local = threading.local()
+        with self._conn as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS documents ("
+                         "bucket TEXT NOT NULL, "
+                         "key TEXT NOT NULL, "
+                         "doc BLOB NOT NULL, "
+                         "PRIMARY KEY (bucket, key))")
+
+    @property
+    def _conn(self):
+        """Return database connection of the current thread."""
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            if self.sync_mode == 'always':
+                conn.execute("PRAGMA synchronous=FULL")
+            else:
+                conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def save(self, bucket, key, doc):
+        """Save document in storage."""
+
+        with self._conn as conn:
+            conn.execute("INSERT OR REPLACE INTO documents (bucket, key, doc) "
+                         "VALUES (?, ?, ?)", (bucket, key, sqlite3.Binary(doc)))
+
+    def append(self, bucket, key, doc):
+        """Append string to document, create the document if needed."""
+
+        with self._conn as conn:
+            cursor = conn.execute("UPDATE documents "
+                                  "SET doc = CAST(doc || ? AS BLOB) "
+                                  "WHERE bucket = ? AND key = ?",
+                                  (sqlite3.Binary(doc), bucket, key))
+            if cursor.rowcount == 0:
+                conn.execute("INSERT INTO documents (bucket, key, doc) "
+                             "VALUES (?, ?, ?)",
+                             (bucket, key, sqlite3.Binary(doc)))
+
+    def load(self, bucket, key):
+        """Load document from storage."""
+
+        row = self._conn.execute("SELECT doc FROM documents "
+                                 "WHERE bucket = ? AND key = ?",
+                                 (bucket, key)).fetchone()
+        if row is None:
+            raise StorageError("No document '%s' in bucket '%s'" % (key,
+                                                                    bucket))
+        return str(row[0])
+
+    def load_prefix(self, bucket, key, size):
+        """Load at most `size` first bytes of document from storage."""
+
+        row = self._conn.execute("SELECT substr(doc, 1, ?) FROM documents "
+                                 "WHERE bucket = ? AND key = ?",
+                                 (size, bucket, key)).fetchone()
+        if row is None:
+            raise StorageError("No document '%s' in bucket '%s'" % (key,
+                                                                    bucket))
+        return str(row[0])
+
+    def delete(self, bucket, key):
+        """Delete document from storage."""
+
+        with self._conn as conn:
+            cursor = conn.execute("DELETE FROM documents "
+                                  "WHERE bucket = ? AND key = ?", (bucket, key))
+        if cursor.rowcount == 0:
+            raise StorageError("No document '%s' in bucket '%s'" % (key,
+                                                                    bucket))
+
+    def keys(self, bucket):
+        """Return list of keys in the bucket."""
+
+        return [row[0] for row in
+                self._conn.execute("SELECT key FROM documents "
+                                   "WHERE bucket = ?", (bucket, ))]
+
+    def exists(self, bucket, key):
+        """Retrun true if key exists in bucket."""
+
+        row = self._conn.execute("SELECT 1 FROM documents "
+                                 "WHERE bucket = ? AND key = ?",
+                                 (bucket, key)).fetchone()
+        return row is not None
+
+    def sync(self):
+        """Sync transactions committed since the last sync."""
+
+        if self.sync_mode == 'group':
+            # checkpointing syncs the log before copying it to the database
+            self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+def create_backend(config):
+    """Return storage backend selected in the given configs."""
+
+    if config.storage_backend == 'filesystem':
+        return FilesystemBackend(config.storage_dir, config.storage_layout,
+                                 config.storage_sync)
+    elif config.storage_backend == 'sqlite':
+        path = config.sqlite_path or os.path.join(config.storage_dir,
+                                                  "bureaucrat.db")
+        return SqliteBackend(path, config.storage_sync)
+    else:
+        raise StorageError("Unknown storage backend: %s" % \
+                           config.storage_backend)
+
+class StorageMetrics(object):
+    """Statistics of document compression."""
+    # pylint: disable=R0903
+
+    def __init__(self):
+        """Initialize metrics."""
+
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_time = 0.0
+        self.decompressed = 0
+        self.decompress_time = 0.0
+
+    @property
+    def ratio(self):
+        """Return ratio of compressed size to original size."""
+
+        if self.raw_bytes == 0:
+            return 1.0
+        return float(self.compressed_bytes) / self.raw_bytes
+
+    def __str__(self):
+        """String representation."""
+        return "compressed %d docs (ratio %.2f, %.3fs CPU), " \
+                "decompressed %d docs (%.3fs CPU)" % \
+                (self.compressed, self.ratio, self.compress_time,
+                 self.decompressed, self.decompress_time)
 
 class Storage(object):
-    """Singletone class representing file storage."""
+    """Singletone class representing document storage.
+
+    The actual work is delegated to a backend selected with the
+    `storage_backend` config parameter.
+
+    Saved documents not shorter than `compress_threshold` bytes are
+    compressed and prefixed with COMPRESSED_MAGIC, loaded documents with
+    the prefix are decompressed. Appended strings are never compressed,
+    so documents being appended to must not be saved.
+
+    A document can be saved with a short header which is kept in front of
+    it uncompressed, prefixed with HEADER_MAGIC and the header's length.
+    load_header() reads just the header, load() drops it.
+    """
 
     _instance = None
     _is_instantiated = False
@@ -51,51 +572,75 @@ class Storage(object):
             raise StorageError("Storage.instance() should be " + \
                                "used to get an instance")
 
-        self._bucket_cache = []
-        self.storage_dir = Configs.instance().storage_dir
+        config = Configs.instance()
+        self.backend = create_backend(config)
+        self.compress_threshold = config.compress_threshold
+        self.metrics = StorageMetrics()
 
-        if not os.path.isdir(self.storage_dir):
-            os.makedirs(self.storage_dir)
+    def save(self, bucket, key, doc, header=None):
+        """Save document in storage.
 
-    def save(self, bucket, key, doc):
-        """Save document in storage."""
+        :param header: string of at most MAX_HEADER bytes readable
+                       with load_header()
+        """
 
-        bucket_path = os.path.join(self.storage_dir, bucket)
-        if not bucket in self._bucket_cache:
-            if not os.path.exists(bucket_path):
-                os.makedirs(bucket_path)
-            self._bucket_cache.append(bucket)
+        if self.compress_threshold > 0 and \
+           len(doc) >= self.compress_threshold:
+            started = time.clock()
+            compressed = zlib.compress(doc)
+            self.metrics.compress_time += time.clock() - started
+            if len(compressed) + len(COMPRESSED_MAGIC) < len(doc):
+                self.metrics.compressed += 1
+                self.metrics.raw_bytes += len(doc)
+                self.metrics.compressed_bytes += len(compressed)
+                doc = COMPRESSED_MAGIC + compressed
+        if header is not None:
+            if len(header) > MAX_HEADER:
+                raise StorageError("Too long header of '%s' in bucket '%s'" % \
+                                   (key, bucket))
+            doc = HEADER_MAGIC + chr(len(header)) + header + doc
+        self.backend.save(bucket, key, doc)
 
-        with open(os.path.join(bucket_path, key), 'w') as fhdl:
-            fhdl.write(doc)
+    def append(self, bucket, key, doc):
+        """Append string to document, create the document if needed."""
+        self.backend.append(bucket, key, doc)
 
     def load(self, bucket, key):
         """Load document from storage."""
 
-        bucket_path = os.path.join(self.storage_dir, bucket)
-        doc_path = os.path.join(bucket_path, key)
-        with open(doc_path) as fhdl:
-            return fhdl.read()
+        doc = self.backend.load(bucket, key)
+        if doc.startswith(HEADER_MAGIC):
+            doc = doc[len(HEADER_MAGIC) + 1 + ord(doc[len(HEADER_MAGIC)]):]
+        if doc.startswith(COMPRESSED_MAGIC):
+            started = time.clock()
+            doc = zlib.decompress(doc[len(COMPRESSED_MAGIC):])
+            self.metrics.decompress_time += time.clock() - started
+            self.metrics.decompressed += 1
+        return doc
+
+    def load_header(self, bucket, key):
+        """Load header of document, return None if it has none."""
+
+        prefix = self.backend.load_prefix(bucket, key, len(HEADER_MAGIC) + 1 +
+                                          MAX_HEADER)
+        if not prefix.startswith(HEADER_MAGIC) or \
+           len(prefix) <= len(HEADER_MAGIC):
+            return None
+        start = len(HEADER_MAGIC) + 1
+        return prefix[start:start + ord(prefix[len(HEADER_MAGIC)])]
 
     def delete(self, bucket, key):
         """Delete document from storage."""
-
-        bucket_path = os.path.join(self.storage_dir, bucket)
-        doc_path = os.path.join(bucket_path, key)
-        os.unlink(doc_path)
+        self.backend.delete(bucket, key)
 
     def keys(self, bucket):
-        """Return list of keys in the bucket."""
-
-        bucket_path = os.path.join(self.storage_dir, bucket)
-        if os.path.isdir(bucket_path):
-            return os.listdir(bucket_path)
-        else:
-            return []
+        """Return iterable over keys in the bucket."""
+        return self.backend.keys(bucket)
 
     def exists(self, bucket, key):
         """Retrun true if key exists in bucket."""
+        return self.backend.exists(bucket, key)
 
-        bucket_path = os.path.join(self.storage_dir, bucket)
-        doc_path = os.path.join(bucket_path, key)
-        return os.path.exists(doc_path)
+    def sync(self):
+        """Make documents written so far durable."""
+        self.backend.sync()
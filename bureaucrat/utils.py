@@ -8,6 +8,8 @@ from __future__ import absolute_import
 
 import json
 
+from collections import OrderedDict
+
 def context2dict(element):
     """Convert context from a given element to dictionary.
 
@@ -39,3 +41,53 @@ def context2dict(element):
             context[key] = value
 
     return context
+
+class LRUCache(object):
+    """Mapping of limited size discarding least recently used items."""
+
+    def __init__(self, size):
+        """Initialize cache.
+
+        :param size: maximum number of items kept in the cache
+        :type size: int
+        """
+
+        self.size = size
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Return cached value and mark it as recently used."""
+
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            return default
+        self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        """Put value to the cache.
+
+        :return: list of (key, value) pairs evicted from the cache
+        """
+
+        self._items.pop(key, None)
+        self._items[key] = value
+        evicted = []
+        while len(self._items) > self.size:
+            evicted.append(self._items.popitem(last=False))
+        return evicted
+
+    def pop(self, key, default=None):
+        """Remove item from the cache and return its value."""
+        return self._items.pop(key, default)
+
+    def clear(self):
+        """Remove all items from the cache."""
+        self._items.clear()
@@ -0,0 +1,224 @@
+"""Pool of worker processes handling messages.
+
+Messages for the same process instance always go to the same worker, so
+they are handled in order while unrelated instances are handled in
+parallel on all cores. The dispatcher acknowledges a delivery only after
+the worker has saved the changes made by it. Deliveries taken by a worker
+that has crashed are requeued.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import multiprocessing
+import signal
+import time
+import zlib
+import Queue
+
+import pika
+
+from bureaucrat.configs import Configs
+from bureaucrat.storage import Storage
+from bureaucrat.message import Message
+from bureaucrat.workflow import InstanceCache
+from bureaucrat.channelwrapper import TransactionalChannel
+
+LOG = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.01
+
+
+class WorkerChannel(object):
+    """Channel given to the engine in a worker process.
+
+    Messages are published directly. Acknowledgements are reported to the
+    dispatcher on commit(), once the changes are synced to storage and
+    the published messages are committed.
+    """
+
+    def __init__(self, channel, index, results):
+        """Initialize channel."""
+
+        self._ch = channel
+        self._index = index
+        self._results = results
+        self._acked = []
+
+    def basic_publish(self, *args, **kwargs):
+        """Publish message."""
+        self._ch.basic_publish(*args, **kwargs)
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        """Report delivery as handled on next commit."""
+        self._acked.append(delivery_tag)
+
+    def commit(self):
+        """Report deliveries acknowledged since the last commit."""
+
+        if isinstance(self._ch, TransactionalChannel):
+            self._ch.commit()
+        Storage.instance().sync()
+        for delivery_tag in self._acked:
+            self._results.put((self._index, delivery_tag, True))
+        self._acked = []
+
+    def basic_nack(self, delivery_tag):
+        """Report delivery as to be requeued."""
+        self._results.put((self._index, delivery_tag, False))
+
+
+class Worker(object):
+    """Worker process handling messages of a subset of instances."""
+
+    def __init__(self, index, results, factory):
+        """Initialize worker.
+
+        :param results: queue to report finished deliveries to
+        :param factory: callable returning engine to handle deliveries with
+        """
+
+        self.index = index
+        self.results = results
+        self.factory = factory
+        self.tasks = multiprocessing.Queue()
+        # tags of deliveries dispatched to the worker and not finished yet
+        self.inflight = []
+        self.process = multiprocessing.Process(
+            target=self._run, name="bureaucrat-worker-%d" % index)
+        self.process.daemon = True
+
+    def start(self):
+        """Start worker process."""
+        self.process.start()
+
+    def is_alive(self):
+        """Return True if the worker process is running."""
+        return self.process.is_alive()
+
+    def _run(self):
+        """Handle deliveries until stopped."""
+
+        # the dispatcher takes care of termination
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        # storage connections must not be shared with the dispatcher
+        Storage._instance = None
+        config = Configs.instance()
+        connection = pika.BlockingConnection(config.amqp_params)
+        publisher = connection.channel()
+        if config.publisher_transactions:
+            publisher = TransactionalChannel(publisher)
+        channel = WorkerChannel(publisher, self.index, self.results)
+        app = self.factory()
+        app.local_execution = config.local_execution
+        if config.instance_cache_size > 0:
+            # acks of unsaved instances can't be held back in workers
+            app.instances = InstanceCache(config.instance_cache_size)
+        stopped = False
+        while not stopped:
+            # deliveries queued up meanwhile are committed together
+            tasks = [self.tasks.get()]
+            while len(tasks) < config.sync_batch:
+                try:
+                    tasks.append(self.tasks.get_nowait())
+                except Queue.Empty:
+                    break
+            for task in tasks:
+                if task is None:
+                    stopped = True
+                    break
+                delivery_tag, body = task
+                try:
+                    app.handle_deliveries(
+                        channel, [(delivery_tag, Message.loads(body))])
+                except:
+                    LOG.exception("Worker %d failed to handle %r",
+                                  self.index, body)
+                    raise
+            channel.commit()
+        connection.close()
+
+
+class WorkerPool(object):
+    """Worker processes with process ID affinity."""
+
+    def __init__(self, size, factory):
+        """Initialize pool.
+
+        :param size: number of worker processes
+        :param factory: callable returning engine to handle deliveries with
+        """
+
+        self.factory = factory
+        self.results = multiprocessing.Queue()
+        self.workers = [Worker(index, self.results, factory)
+                        for index in range(size)]
+        self.stopping = False
+
+    def start(self):
+        """Start worker processes."""
+
+        for worker in self.workers:
+            worker.start()
+
+    def dispatch(self, process_id, delivery_tag, body):
+        """Pass delivery to the worker serving the process instance."""
+
+        index = (zlib.crc32(process_id) & 0xffffffff) % len(self.workers)
+        worker = self.workers[index]
+        worker.inflight.append(delivery_tag)
+        worker.tasks.put((delivery_tag, body))
+
+    def collect(self):
+        """Return deliveries finished since last call.
+
+        Deliveries of crashed workers are returned as not handled and the
+        workers are restarted.
+
+        :returns: list of (delivery_tag, handled) pairs
+        """
+
+        # results of workers gone by now are all in the queue already
+        gone = [worker for worker in self.workers if not worker.is_alive()]
+        finished = []
+        while True:
+            try:
+                index, delivery_tag, handled = self.results.get_nowait()
+            except Queue.Empty:
+                break
+            worker = self.workers[index]
+            if delivery_tag in worker.inflight:
+                worker.inflight.remove(delivery_tag)
+                finished.append((delivery_tag, handled))
+
+        for worker in gone:
+            index = worker.index
+            if worker.inflight:
+                LOG.error("Worker %d is gone, requeueing %d deliveries",
+                          index, len(worker.inflight))
+                finished.extend((delivery_tag, False)
+                                for delivery_tag in worker.inflight)
+                worker.inflight = []
+            if not self.stopping:
+                self.workers[index] = Worker(index, self.results,
+                                             self.factory)
+                self.workers[index].start()
+        return finished
+
+    def stop(self):
+        """Stop workers once they have handled dispatched deliveries.
+
+        :returns: deliveries finished meanwhile, like collect() does
+        """
+
+        self.stopping = True
+        for worker in self.workers:
+            worker.tasks.put(None)
+        finished = []
+        # workers can't exit before their results are read
+        while any(worker.is_alive() for worker in self.workers):
+            finished.extend(self.collect())
+            time.sleep(POLL_INTERVAL)
+        finished.extend(self.collect())
+        return finished
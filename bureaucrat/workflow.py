@@ -1,25 +1,345 @@
+"""Workflow instances and their persistence.
+
+Every process instance is stored as one record in the 'process' bucket.
+The record is a JSON object with the keys
+
+ * `revision`   -- number incremented on every save,
+ * `definition` -- content hash of the process definition kept in
+                   DefinitionStore,
+ * `parent`     -- ID of the activity which launched the instance,
+ * `process`    -- snapshot of the process state.
+
+The record is saved with its revision as storage header, so that saves can
+check the stored revision without reading and decoding the whole record.
+A save of an instance costs one stat of `delta/<pid>`, one read of the
+record's header (or of the delta log when there is one) and one write of
+the record or delta, plus the outbox when it's persisted.
+
+When `compaction_interval` is configured most saves don't rewrite the
+record but append the changed part of the state to `delta/<pid>`, one
+JSON object with the keys `revision` and `delta` per line. Every
+`compaction_interval` saves the full record is written again and the
+deltas are dropped.
+
+With `journal_history` enabled the entries also list the messages handled
+since the previous save. Instead of being dropped on compaction they're
+moved to `history/<pid>`, so that the whole run of the instance can be
+replayed with Workflow.replay(). The history is removed together with the
+instance.
+
+With `persist_outbox` enabled the messages emitted while handling are saved
+to `outbox/<pid>` together with the revision of the state before the state
+itself is saved. The document is removed once the messages are published.
+Outboxes left by a crash are published again on start up with
+republish_outboxes().
+
+With `snapshot_format = binary` the record is written in compact binary
+form instead: the header _BINARY_MAGIC followed by the schema version byte
+and a marshalled tuple (revision, definition, parent, compact snapshot).
+Both forms are loaded regardless of the option.
+
+Instances created by earlier versions of the engine keep their own copy
+of the definition in `definition/<pid>` and a bare snapshot as the record.
+They are still loaded, and Workflow.migrate() converts them.
+"""
+
 from __future__ import absolute_import
 
 import logging
 import json
+import hashlib
+import marshal
 
 import xml.etree.ElementTree as ET
 
+from bureaucrat.configs import Configs
 from bureaucrat.storage import Storage
-from bureaucrat.storage import lock_storage
+from bureaucrat.storage import StorageError
+from bureaucrat.storage import instance_lock
+from bureaucrat.storage import striped_lock
 from bureaucrat.flowexpression import Process
 from bureaucrat.context import Context
+from bureaucrat.channelwrapper import DeferredChannel
+from bureaucrat.blobstore import BlobStore
+from bureaucrat.utils import LRUCache
 
 LOG = logging.getLogger(__name__)
 
+# How many times a unit of work is repeated before giving up
+MAX_RETRIES = 5
+# How many messages a unit of work handles locally before the rest is
+# published, it stops loops without wait states from running forever
+MAX_LOCAL_STEPS = 1000
+
+_BINARY_MAGIC = '\x00BCR'
+# Version of binary record schema, bump on incompatible changes
+_BINARY_VERSION = 1
+
+
+class WorkflowError(Exception):
+    """Workflow error."""
+
+
+class WorkflowConflictError(WorkflowError):
+    """Workflow instance has been modified by someone else."""
+
+
+def definition_digest(pdef):
+    """Return content hash of a process definition."""
+
+    if isinstance(pdef, unicode):
+        pdef = pdef.encode('utf-8')
+    return hashlib.sha1(pdef).hexdigest()
+
+
+def _parse_record(doc):
+    """Return process instance record stored in a document.
+
+    Binary records have the compact process snapshot under the key
+    'compact' instead of 'process'.
+    """
+
+    if doc.startswith(_BINARY_MAGIC):
+        version = ord(doc[len(_BINARY_MAGIC)])
+        if version != _BINARY_VERSION:
+            raise WorkflowError("Unsupported record version %d" % version)
+        try:
+            revision, digest, parent, compact = \
+                    marshal.loads(doc[len(_BINARY_MAGIC) + 1:])
+        except EOFError:
+            raise ValueError("Truncated record")
+        return {
+            "revision": revision,
+            "definition": digest,
+            "parent": parent,
+            "compact": compact
+        }
+
+    record = json.loads(doc)
+    if "revision" not in record:
+        # legacy record is a bare process snapshot
+        record = {
+            "revision": 0,
+            "process": record
+        }
+    return record
+
+
+def _dump_record(record):
+    """Return document storing process instance record."""
+
+    if "compact" in record:
+        return _BINARY_MAGIC + chr(_BINARY_VERSION) + \
+                marshal.dumps((record["revision"], record.get("definition"),
+                               record.get("parent"), record["compact"]), 2)
+    return json.dumps(record)
+
+
+def _parse_deltas(doc):
+    """Return entries of a delta log document.
+
+    Lines which can't be decoded are skipped. They are left by writers
+    which crashed or haven't finished appending yet.
+    """
+
+    entries = []
+    for line in doc.splitlines():
+        if line:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                LOG.warning("Skipping broken delta: %r", line)
+    return entries
+
+
+def _stored_revision(storage, pid):
+    """Return revision of stored instance and whether it has deltas.
+
+    The revision is taken from the delta log if there is one, otherwise
+    from the record's header. Only records saved by earlier versions of
+    the engine, which have no header, get parsed.
+    """
+
+    has_deltas = storage.exists("delta", pid)
+    if has_deltas:
+        entries = _parse_deltas(storage.load("delta", pid))
+        if entries:
+            return entries[-1]["revision"], True
+    try:
+        header = storage.load_header("process", pid)
+    except (IOError, StorageError):
+        return 0, has_deltas
+    if header is None:
+        return _parse_record(storage.load("process", pid))["revision"], \
+                has_deltas
+    return int(header), has_deltas
+
+
+def _split_definition(pdef):
+    """Split process definition into shared and instance specific parts.
+
+    The returned definition lacks the 'parent' attribute and the properties
+    of the root context as these differ from instance to instance.
+
+    :return: tuple of definition string, parent ID and root context element
+    """
+
+    xmlelement = ET.fromstring(pdef)
+    assert xmlelement.tag == 'process'
+
+    parent_id = ''
+    if "parent" in xmlelement.attrib:
+        parent_id = xmlelement.attrib.pop("parent")
+
+    props = ET.Element('context')
+    ctx = xmlelement.find('context')
+    if ctx is not None:
+        for child in ctx.findall('property'):
+            ctx.remove(child)
+            props.append(child)
+        if len(ctx) == 0:
+            xmlelement.remove(ctx)
+
+    # drop formatting so that it doesn't affect the content hash
+    for element in xmlelement.iter():
+        if element.text is not None and not element.text.strip():
+            element.text = None
+        if element.tail is not None and not element.tail.strip():
+            element.tail = None
+
+    return ET.tostring(xmlelement), parent_id, props
+
+
+class DefinitionStore(object):
+    """Process definitions shared by process instances.
+
+    Every definition is stored once in the 'definition' bucket under its
+    content hash. The number of instances referring to it is kept in the
+    'definition_refs' bucket and the definition is removed together with
+    the last instance.
+    """
+
+    @staticmethod
+    def acquire(pdef):
+        """Store definition if needed and add a reference to it.
+
+        :return: content hash of the definition
+        """
+
+        digest = definition_digest(pdef)
+        storage = Storage.instance()
+        with striped_lock("definition", digest):
+            refs = 0
+            if storage.exists("definition_refs", digest):
+                refs = int(storage.load("definition_refs", digest))
+            if refs == 0:
+                storage.save("definition", digest, pdef)
+            storage.save("definition_refs", digest, str(refs + 1))
+        return digest
+
+    @staticmethod
+    def release(digest):
+        """Remove a reference to the definition."""
+
+        storage = Storage.instance()
+        with striped_lock("definition", digest):
+            refs = int(storage.load("definition_refs", digest)) - 1
+            if refs > 0:
+                storage.save("definition_refs", digest, str(refs))
+            else:
+                LOG.debug("Removing unused process definition %s", digest)
+                storage.delete("definition_refs", digest)
+                storage.delete("definition", digest)
+
+    @staticmethod
+    def load(digest):
+        """Return definition with the given content hash."""
+        return Storage.instance().load("definition", digest)
+
+
+class DefinitionCache(object):
+    """Cache of compiled process definitions.
+
+    A definition is compiled to a template tree of flow expressions. The
+    template never handles messages, it's only instantiated for every
+    process instance using the definition, so parsing happens once per
+    definition rather than once per message.
+    """
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        """Return cache instance."""
+
+        if cls._instance is None:
+            cls._instance = DefinitionCache(
+                Configs.instance().definition_cache_size)
+        return cls._instance
+
+    def __init__(self, size):
+        """Initialize cache."""
+
+        self._templates = LRUCache(size)
+
+    def get(self, digest, pdef=None):
+        """Return compiled template of a process definition.
+
+        :param digest: content hash of the definition
+        :param pdef: definition, loaded from DefinitionStore if not given
+        """
+
+        template = self._templates.get(digest)
+        if template is None:
+            LOG.debug("Compiling process definition %s", digest)
+            if pdef is None:
+                pdef = DefinitionStore.load(digest)
+            xmlelement = ET.fromstring(pdef)
+            assert xmlelement.tag == 'process'
+
+            parent_id = ''
+            if "parent" in xmlelement.attrib:
+                parent_id = xmlelement.attrib["parent"]
+
+            template = Process(parent_id, xmlelement, '', Context())
+            self._templates.put(digest, template)
+        return template
+
+    def instantiate(self, digest, pid, parent_id=None, pdef=None):
+        """Return new process tree for the given definition.
+
+        :param parent_id: ID of parent activity, taken from the definition
+                          if not given
+        """
+
+        template = self.get(digest, pdef)
+        if parent_id is None:
+            parent_id = template.parent_id
+        return template.instantiate(parent_id, pid, Context())
+
 
 class Workflow(object):
     """Represnts workflow instance."""
 
-    def __init__(self, process):
-        """Initialize workflow instance."""
+    def __init__(self, process, definition=None, revision=0, deltas=0):
+        """Initialize workflow instance.
+
+        :param definition: content hash of the process definition, None
+                           for instances stored with own copy of definition
+        :param revision: revision of the stored state the instance is based on
+        :param deltas: number of deltas stored after the full record
+        """
 
         self.process = process
+        self.definition = definition
+        self.revision = revision
+        self.deltas = deltas
+        # blobs referred by the stored state
+        self.blobs = process.blob_refs()
+        # messages handled since the last save
+        self.handled = []
+        # channel holding messages emitted since the last save
+        self.unsent = None
 
     @staticmethod
     def create_from_string(pdef, pid):
@@ -27,50 +347,506 @@ class Workflow(object):
 
         LOG.debug("Creating workflow instance from string.")
 
-        xmlelement = ET.fromstring(pdef)
-        assert xmlelement.tag == 'process'
-
-        Storage.instance().save("definition", pid, pdef)
-
-        parent_id = ''
-        if "parent" in xmlelement.attrib:
-            parent_id = xmlelement.attrib["parent"]
-
-        process = Process(parent_id, xmlelement, pid, Context())
-        workflow = Workflow(process)
+        pdef, parent_id, props = _split_definition(pdef)
+        digest = DefinitionStore.acquire(pdef)
+        process = DefinitionCache.instance().instantiate(digest, pid,
+                                                         parent_id, pdef)
+        process.context.parse(props)
+        workflow = Workflow(process, digest)
         workflow.save()
         return workflow
 
     @staticmethod
-    @lock_storage
     def load(process_id):
-        """Return existing workflow instance loaded from storage."""
+        """Return existing workflow instance loaded from storage.
+
+        No lock is taken, the revision of the loaded state is checked
+        when the instance gets saved.
+        """
 
         LOG.debug("Load a process definition from %s", process_id)
         storage = Storage.instance()
-        pdef = storage.load("definition", process_id)
-        xmlelement = ET.fromstring(pdef)
-        assert xmlelement.tag == 'process'
+        try:
+            record = _parse_record(storage.load("process", process_id))
+        except ValueError:
+            raise WorkflowConflictError("State of %s is being written" % \
+                                        process_id)
+        digest = record.get("definition")
+        cache = DefinitionCache.instance()
+        if digest is None:
+            pdef = storage.load("definition", process_id)
+            process = cache.instantiate(definition_digest(pdef), process_id,
+                                        pdef=pdef)
+        else:
+            process = cache.instantiate(digest, process_id, record["parent"])
+        if "compact" in record:
+            process.reset_compact_state(record["compact"])
+        else:
+            process.reset_state(record["process"])
 
-        parent_id = ''
-        if "parent" in xmlelement.attrib:
-            parent_id = xmlelement.attrib["parent"]
+        revision = record["revision"]
+        deltas = 0
+        if storage.exists("delta", process_id):
+            try:
+                entries = _parse_deltas(storage.load("delta", process_id))
+            except (IOError, StorageError):
+                raise WorkflowConflictError("State of %s is being compacted" \
+                                            % process_id)
+            for entry in entries:
+                # entries older than the record are left by interrupted
+                # compaction
+                if entry["revision"] > revision:
+                    process.apply_delta(entry["delta"])
+                    revision = entry["revision"]
+                    deltas += 1
 
-        process = Process(parent_id, xmlelement, process_id, Context())
-        process.reset_state(json.loads(storage.load("process", process.id)))
-        return Workflow(process)
+        process.mark_clean()
+        return Workflow(process, digest, revision, deltas)
 
-    @lock_storage
-    def save(self):
-        """Save workflow state to storage."""
+    def save(self, outbox=None):
+        """Save workflow state to storage.
 
-        Storage.instance().save("process", self.process.id,
-                                json.dumps(self.process.snapshot()))
+        The state is saved only if the stored revision is still the one
+        the instance was loaded from. Otherwise WorkflowConflictError is
+        raised.
+
+        Depending on `compaction_interval` either the full record is
+        written or only the flow expressions changed since the last save
+        are appended to the delta log.
+
+        :param outbox: serialized messages to be published after the state
+                       is saved, see DeferredChannel.dumps()
+        """
+
+        revision = self.revision + 1
+        config = Configs.instance()
+        interval = config.compaction_interval
+        compact = self.revision == 0 or self.deltas + 1 >= interval
+
+        new_blobs = {}
+        if config.blob_threshold > 0:
+            self.process.externalize(config.blob_threshold, new_blobs)
+        blobs = self.process.blob_refs()
+        acquired = blobs - self.blobs
+        for digest in acquired:
+            BlobStore.acquire(digest, new_blobs.get(digest))
+        try:
+            self._write(revision, compact, outbox)
+        except:
+            for digest in acquired:
+                BlobStore.release(digest)
+            raise
+        for digest in self.blobs - blobs:
+            BlobStore.release(digest)
+
+        self.blobs = blobs
+        self.revision = revision
+        self.deltas = 0 if compact else self.deltas + 1
+        self.handled = []
+        self.process.mark_clean()
+
+    def checkpoint(self):
+        """Save the state and publish messages emitted since the last save.
+
+        With `persist_outbox` enabled the messages are saved together with
+        the state.
+        """
+
+        deferred = self.unsent
+        outbox = None
+        if deferred is not None and len(deferred) > 0 and \
+           Configs.instance().persist_outbox:
+            outbox = deferred.dumps()
+        self.save(outbox)
+        self.unsent = None
+        if deferred is not None:
+            deferred.flush()
+            if outbox is not None:
+                # the messages must be taken by the broker before the
+                # outbox is dropped
+                deferred.commit()
+                clear_outbox(self.process.id, self.revision)
+
+    def _write(self, revision, compact, outbox=None):
+        """Write new revision of the state to storage."""
+
+        pid = self.process.id
+
+        delta = None
+        if not compact:
+            delta = self._dump_delta(revision)
+        else:
+            record = {
+                "revision": revision
+            }
+            snapshot_format = Configs.instance().snapshot_format
+            if snapshot_format == 'binary':
+                record["compact"] = self.process.compact_snapshot()
+            elif snapshot_format == 'json':
+                record["process"] = self.process.snapshot()
+            else:
+                raise WorkflowError("Unknown snapshot format: %s" % \
+                                    snapshot_format)
+            if self.definition is not None:
+                record["definition"] = self.definition
+                record["parent"] = self.process.parent_id
+            doc = _dump_record(record)
+
+        storage = Storage.instance()
+        with instance_lock(pid):
+            stored, has_deltas = _stored_revision(storage, pid)
+            if stored != self.revision:
+                raise WorkflowConflictError("%s has revision %d, expected %d" \
+                                            % (pid, stored, self.revision))
+            if has_deltas and delta is None:
+                # Log the change first: should writing the record fail
+                # the log is still consistent with the revision.
+                delta = self._dump_delta(revision)
+            if outbox is not None:
+                storage.save("outbox", pid, json.dumps({
+                    "revision": revision,
+                    "calls": outbox
+                }))
+            if delta is not None:
+                storage.append("delta", pid, delta)
+            if compact:
+                storage.save("process", pid, doc, str(revision))
+                history = Configs.instance().journal_history
+                if delta is not None:
+                    if history:
+                        storage.append("history", pid,
+                                       storage.load("delta", pid))
+                    storage.delete("delta", pid)
+                elif history:
+                    storage.append("history", pid,
+                                   self._dump_delta(revision))
+
+    def _dump_delta(self, revision):
+        """Return delta log entry for changes since the last save."""
+
+        entry = {
+            "revision": revision,
+            "delta": self.process.delta()
+        }
+        if Configs.instance().journal_history:
+            entry["messages"] = [msg.as_dictionary() for msg in self.handled]
+        # the leading newline separates the entry from a broken one
+        return "\n" + json.dumps(entry)
+
+    @staticmethod
+    def journal(process_id):
+        """Return journal entries of the instance ordered by revision.
+
+        Only the entries not yet compacted are returned unless
+        `journal_history` is enabled.
+        """
+
+        storage = Storage.instance()
+        entries = {}
+        for bucket in ("history", "delta"):
+            if storage.exists(bucket, process_id):
+                for entry in _parse_deltas(storage.load(bucket, process_id)):
+                    # entries may repeat after interrupted compaction
+                    entries.setdefault(entry["revision"], entry)
+        return [entries[revision] for revision in sorted(entries)]
+
+    @staticmethod
+    def replay(process_id, revision=None):
+        """Return instance rebuilt from its journal.
+
+        The process tree is created from the definition and the journal
+        entries are applied to it one by one, so it's as complete as the
+        journal is.
+
+        :param revision: last revision to apply, all entries if None
+        """
+
+        storage = Storage.instance()
+        record = _parse_record(storage.load("process", process_id))
+        digest = record.get("definition")
+        cache = DefinitionCache.instance()
+        if digest is None:
+            pdef = storage.load("definition", process_id)
+            process = cache.instantiate(definition_digest(pdef), process_id,
+                                        pdef=pdef)
+        else:
+            process = cache.instantiate(digest, process_id, record["parent"])
+
+        replayed = 0
+        for entry in Workflow.journal(process_id):
+            if revision is not None and entry["revision"] > revision:
+                break
+            process.apply_delta(entry["delta"])
+            replayed = entry["revision"]
+        process.mark_clean()
+        return Workflow(process, digest, replayed)
+
+    @staticmethod
+    def migrate(process_id):
+        """Convert instance with own copy of definition to unified record.
+
+        :return: True if the instance has been converted
+        """
+
+        storage = Storage.instance()
+        with instance_lock(process_id):
+            record = _parse_record(storage.load("process", process_id))
+            if record.get("definition") is not None:
+                return False
+            pdef, parent_id, _ = _split_definition(
+                storage.load("definition", process_id))
+            record["definition"] = DefinitionStore.acquire(pdef)
+            record["parent"] = parent_id
+            # make writers holding the legacy state retry
+            record["revision"] += 1
+            storage.save("process", process_id, _dump_record(record),
+                         str(record["revision"]))
+            storage.delete("definition", process_id)
+        return True
 
-    @lock_storage
     def delete(self):
         """Delete workflow instance from storage."""
 
         storage = Storage.instance()
-        storage.delete("process", self.process.id)
-        storage.delete("definition", self.process.id)
+        with instance_lock(self.process.id):
+            storage.delete("process", self.process.id)
+            if storage.exists("delta", self.process.id):
+                storage.delete("delta", self.process.id)
+            if storage.exists("history", self.process.id):
+                storage.delete("history", self.process.id)
+            if self.definition is None:
+                storage.delete("definition", self.process.id)
+        if self.definition is not None:
+            DefinitionStore.release(self.definition)
+        for digest in self.blobs:
+            BlobStore.release(digest)
+
+
+def clear_outbox(process_id, revision):
+    """Remove outbox of the instance after its messages are published."""
+
+    storage = Storage.instance()
+    with instance_lock(process_id):
+        if storage.exists("outbox", process_id) and \
+           json.loads(storage.load("outbox", process_id))["revision"] == \
+                revision:
+            storage.delete("outbox", process_id)
+
+
+def republish_outboxes(channel):
+    """Publish messages left in outboxes by crashed engine.
+
+    Messages of states which failed to be saved are dropped.
+
+    :param channel: channel wrapper used to publish the messages
+    :type channel: bureaucrat.channelwrapper.ChannelWrapper
+    """
+
+    storage = Storage.instance()
+    for pid in storage.keys("outbox"):
+        with instance_lock(pid):
+            outbox = json.loads(storage.load("outbox", pid))
+            stored, _ = _stored_revision(storage, pid)
+            if outbox["revision"] <= stored:
+                LOG.info("Publishing outbox of %s", pid)
+                DeferredChannel.loads(channel, outbox["calls"]).flush()
+            else:
+                LOG.warning("Dropping outbox of unsaved state of %s", pid)
+            storage.delete("outbox", pid)
+
+
+class InstanceCache(object):
+    """Live workflow instances kept in memory between messages.
+
+    Cached instances are handled without loading their state from storage
+    and rebuilding the process tree. With the 'ack' flush policy the
+    instances are saved after every message as usual, with 'wait_state'
+    only when they reach a wait state and with 'evict' they are saved
+    only when dropped from the cache or flushed explicitly.
+    """
+
+    def __init__(self, size, flush='ack'):
+        """Initialize cache.
+
+        :param size: maximum number of cached instances
+        :param flush: flush policy, either 'ack', 'wait_state' or 'evict'
+        """
+
+        if flush not in ('ack', 'wait_state', 'evict'):
+            raise WorkflowError("Unknown flush policy: %s" % flush)
+
+        self.flush_policy = flush
+        self._workflows = LRUCache(size)
+        self._unsaved = set()
+        # instances which failed to be saved due to conflict
+        self._lost = set()
+
+    def needs_save(self, wflow):
+        """Return True if the handled instance should be saved right away."""
+
+        if self.flush_policy == 'wait_state':
+            return wflow.process.is_waiting()
+        return self.flush_policy == 'ack'
+
+    def is_unsaved(self, process_id):
+        """Return True if the instance has changes not saved yet."""
+        return process_id in self._unsaved
+
+    def was_lost(self, process_id):
+        """Return True once if changes of the instance failed to be saved.
+
+        It's tracked for the 'wait_state' policy only.
+        """
+
+        if process_id in self._lost:
+            self._lost.discard(process_id)
+            return True
+        return False
+
+    def get(self, process_id):
+        """Return cached instance or None."""
+        return self._workflows.get(process_id)
+
+    def put(self, wflow, saved=True):
+        """Put handled instance to the cache.
+
+        :param saved: False if the instance has unsaved changes
+        """
+
+        if saved:
+            self._unsaved.discard(wflow.process.id)
+        else:
+            self._unsaved.add(wflow.process.id)
+        for _, evicted in self._workflows.put(wflow.process.id, wflow):
+            self._save(evicted)
+
+    def discard(self, process_id, lost=False):
+        """Drop instance from the cache without saving it.
+
+        :param lost: True if unsaved changes of the instance are dropped
+                     because they can't be saved
+        """
+
+        self._workflows.pop(process_id)
+        if lost and process_id in self._unsaved and \
+           self.flush_policy == 'wait_state':
+            self._lost.add(process_id)
+        self._unsaved.discard(process_id)
+
+    def flush(self):
+        """Save all cached instances changed since they were saved."""
+
+        for process_id in list(self._unsaved):
+            self._save(self._workflows.get(process_id))
+
+    def _save(self, wflow):
+        """Save instance if it has unsaved changes."""
+
+        if wflow.process.id not in self._unsaved:
+            return
+        self._unsaved.discard(wflow.process.id)
+        try:
+            LOG.debug("Saving cached instance %s", wflow.process.id)
+            wflow.checkpoint()
+        except WorkflowConflictError as err:
+            LOG.error("Changes of %s are lost: %s", wflow.process.id, err)
+            self._workflows.pop(wflow.process.id)
+            if self.flush_policy == 'wait_state':
+                self._lost.add(wflow.process.id)
+
+
+class UnitOfWork(object):
+    """Load-handle-save cycle of a workflow instance.
+
+    Messages emitted while handling are held back until the new state is
+    saved. If the instance has been saved by someone else in the meantime
+    the whole cycle is repeated with fresh state instead of waiting for
+    a lock.
+
+    In local mode messages the instance sends to itself are handled right
+    away in the same cycle until there are none left, only messages for
+    other instances, participants and timers are published.
+    """
+
+    def __init__(self, process_id, channel, retries=MAX_RETRIES, cache=None,
+                 local=False):
+        """Initialize unit of work.
+
+        :param channel: channel wrapper used to publish emitted messages
+        :type channel: bureaucrat.channelwrapper.ChannelWrapper
+        :param cache: cache of live instances to take the instance from
+        :type cache: InstanceCache
+        :param local: True to handle messages within the instance locally
+        """
+
+        self.process_id = process_id
+        self.channel = channel
+        self.retries = retries
+        self.cache = cache
+        self.local = local
+
+    def handle_message(self, msg):
+        """Handle message in the process instance and save its new state."""
+        return self.handle_messages([msg])
+
+    def handle_messages(self, msgs):
+        """Handle messages in the process instance in order.
+
+        The instance is loaded and saved only once for all the messages.
+        """
+
+        for attempt in range(self.retries):
+            wflow = None
+            if self.cache is not None:
+                wflow = self.cache.get(self.process_id)
+            try:
+                if wflow is None:
+                    wflow = Workflow.load(self.process_id)
+                if wflow.unsent is None:
+                    wflow.unsent = DeferredChannel(
+                        self.channel, self.process_id if self.local else None)
+                # messages of unsaved instances wait for their checkpoint
+                deferred = wflow.unsent
+                for msg in msgs:
+                    wflow.process.handle_message(deferred, msg)
+                    wflow.handled.append(msg)
+                    self._run_local(wflow, deferred)
+                saved = self.cache is None or self.cache.needs_save(wflow)
+                if saved:
+                    wflow.checkpoint()
+            except WorkflowConflictError as err:
+                LOG.info("Attempt %d to handle %r failed: %s", attempt + 1,
+                         msgs, err)
+                if self.cache is not None:
+                    # held deliveries must rebuild the dropped changes
+                    self.cache.discard(self.process_id, lost=True)
+                continue
+            except:
+                # the state in memory may be half-way changed
+                if self.cache is not None:
+                    self.cache.discard(self.process_id)
+                raise
+            if self.cache is not None:
+                self.cache.put(wflow, saved)
+            return wflow
+
+        raise WorkflowConflictError("Gave up handling %r in %s" % \
+                                    (msgs, self.process_id))
+
+    def _run_local(self, wflow, deferred):
+        """Handle messages the instance has sent to itself."""
+
+        steps = 0
+        while deferred.local:
+            if steps == MAX_LOCAL_STEPS:
+                LOG.warning("%s is still busy after %d steps, publishing "
+                            "the rest of its messages", self.process_id, steps)
+                deferred.local_pid = None
+                for msg in deferred.local:
+                    deferred.send(msg)
+                deferred.local.clear()
+                break
+            msg = deferred.local.popleft()
+            wflow.process.handle_message(deferred, msg)
+            wflow.handled.append(msg)
+            steps += 1
@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+
+import unittest
+
+from mock import Mock
+from pika.spec import Basic
+
+from bureaucrat.asyncloop import AsyncLoop
+from bureaucrat.asyncloop import ThreadsafeChannel
+
+class TestAsyncLoop(unittest.TestCase):
+    """Tests for AsyncLoop."""
+
+    def setUp(self):
+        """Set up environment."""
+
+        self.app = Mock()
+        self.loop = AsyncLoop(self.app)
+        self.loop.connection = Mock()
+        self.loop.channel = Mock()
+        # run I/O loop callbacks right away
+        self.loop.connection.add_callback_threadsafe.side_effect = \
+                lambda callback: callback()
+
+    def run_tasks(self):
+        """Run the handler thread's tasks queued so far."""
+
+        self.loop.tasks.put(None)
+        self.loop._handle()
+
+    def test_threadsafe_channel(self):
+        """Test ThreadsafeChannel passes calls to the I/O loop."""
+
+        channel = ThreadsafeChannel(self.loop)
+        channel.basic_ack(1, multiple=True)
+        channel.basic_nack(2)
+        channel.basic_publish(exchange='', routing_key='fake', body='{}')
+        self.assertEqual(
+            self.loop.connection.add_callback_threadsafe.call_count, 3)
+        self.loop.channel.basic_ack.assert_called_once_with(1, multiple=True)
+        self.loop.channel.basic_nack.assert_called_once_with(2)
+        self.loop.channel.basic_publish.assert_called_once_with(
+            exchange='', routing_key='fake', body='{}')
+
+    def test_timeout(self):
+        """Test AsyncLoop.add_timeout() fires in the handler thread."""
+
+        callback = Mock()
+        self.loop.add_timeout(0.01, callback)
+        self.loop.remove_timeout(self.loop.add_timeout(0.01, callback))
+        self.assertEqual(self.loop.connection.add_timeout.call_count, 2)
+        for args in self.loop.connection.add_timeout.call_args_list:
+            self.assertEqual(args[0][0], 0.01)
+            args[0][1]()
+        callback.assert_not_called()
+        self.run_tasks()
+        callback.assert_called_once_with()
+
+    def test_handle_deliveries(self):
+        """Test AsyncLoop handles deliveries in order."""
+
+        handler = Mock()
+        on_delivery = self.loop._consumer(handler)
+        on_delivery(self.loop.channel, 1, 'header', 'body1')
+        on_delivery(self.loop.channel, 2, 'header', 'body2')
+        handler.assert_not_called()
+        self.run_tasks()
+        self.assertEqual(
+            [args[0] for args in handler.call_args_list],
+            [(self.app.channel, 1, 'header', 'body1'),
+             (self.app.channel, 2, 'header', 'body2')])
+        self.assertFalse(self.loop.failed)
+
+    def test_handler_failure(self):
+        """Test AsyncLoop closes connection when a handler fails."""
+
+        handler = Mock(side_effect=ValueError("fake error"))
+        self.loop._consumer(handler)(self.loop.channel, 1, 'header', 'body')
+        self.run_tasks()
+        self.assertTrue(self.loop.failed)
+        self.loop.connection.close.assert_called_once_with()
+
+    def test_stop(self):
+        """Test AsyncLoop.stop() commits before closing connection."""
+
+        self.loop.consumer_tags = ['tag1', 'tag2']
+        self.loop.stop()
+        self.assertEqual(self.loop.channel.basic_cancel.call_count, 2)
+        self.app.flush.assert_not_called()
+        self.run_tasks()
+        self.app.flush.assert_called_once_with()
+        self.loop.connection.close.assert_called_once_with()
+
+    def test_publisher_confirms(self):
+        """Test AsyncLoop acks deliveries after publishes are confirmed."""
+
+        self.loop.confirms = True
+        channel = ThreadsafeChannel(self.loop)
+        channel.basic_publish(exchange='', routing_key='fake', body='1')
+        channel.basic_publish(exchange='', routing_key='fake', body='2')
+        channel.basic_ack(1)
+        channel.basic_publish(exchange='', routing_key='fake', body='3')
+        channel.basic_ack(2)
+        self.loop.channel.basic_ack.assert_not_called()
+
+        self.loop._on_confirm(Mock(method=Basic.Ack(delivery_tag=2,
+                                                    multiple=True)))
+        self.loop.channel.basic_ack.assert_called_once_with(1)
+        self.loop._on_confirm(Mock(method=Basic.Ack(delivery_tag=3)))
+        self.loop.channel.basic_ack.assert_called_with(2)
+        channel.basic_ack(3)
+        self.loop.channel.basic_ack.assert_called_with(3)
+
+        channel.basic_publish(exchange='', routing_key='fake', body='4')
+        self.loop._on_confirm(Mock(method=Basic.Nack(delivery_tag=4)))
+        self.assertTrue(self.loop.failed)
+        self.loop.connection.close.assert_called_once_with()
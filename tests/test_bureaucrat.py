@@ -6,6 +6,12 @@ from mock import Mock
 from mock import patch
 
 from bureaucrat.bureaucrat import Bureaucrat
+from bureaucrat.workflow import WorkflowConflictError
+from bureaucrat.message import Message
+from bureaucrat.configs import ConfigsError
+from bureaucrat.sharding import Membership
+from bureaucrat.channelwrapper import TransactionalChannel
+from bureaucrat.sharding import assigned_shards
 
 class TestBureaucrat(unittest.TestCase):
     """Tests for Bureaucrat app class."""
@@ -42,9 +48,8 @@ class TestBureaucrat(unittest.TestCase):
         bc = Bureaucrat()
         channel = Mock()
 
-        with patch("bureaucrat.bureaucrat.Workflow") as MockWfl:
-            wflow = Mock()
-            MockWfl.load.return_value = wflow
+        with patch("bureaucrat.bureaucrat.UnitOfWork") as MockUoW, \
+                patch("bureaucrat.bureaucrat.Workflow") as MockWfl:
             body = """
                 {
                     "name": "completed",
@@ -54,9 +59,35 @@ class TestBureaucrat(unittest.TestCase):
                 }
             """
             bc.handle_message(channel, Mock(), Mock(), body)
-            MockWfl.load.assert_called_once()
-            wflow.process.handle_message.assert_called_once()
-            wflow.save.assert_called_once()
+            MockUoW.assert_called_once()
+            self.assertEqual(MockUoW.call_args[0][0], "fake-child")
+            MockUoW.return_value.handle_messages.assert_called_once()
+            MockWfl.load.assert_called_once_with("fake-origin")
+            MockWfl.load.return_value.delete.assert_called_once()
+
+        channel.basic_ack.assert_called_once()
+
+    def test_handle_message_completed_cached(self):
+        """Test Bureaucrat.handle_message() drops finished process from cache."""
+
+        bc = Bureaucrat()
+        bc.instances = Mock()
+        channel = Mock()
+
+        with patch("bureaucrat.bureaucrat.UnitOfWork") as MockUoW, \
+                patch("bureaucrat.bureaucrat.Workflow") as MockWfl:
+            body = """
+                {
+                    "name": "completed",
+                    "target": "fake-child",
+                    "origin": "fake-origin",
+                    "payload": null
+                }
+            """
+            bc.handle_message(channel, Mock(), Mock(), body)
+            self.assertTrue(MockUoW.call_args[1]["cache"] is bc.instances)
+            bc.instances.discard.assert_called_once_with("fake-origin")
+            MockWfl.load.return_value.delete.assert_called_once()
 
         channel.basic_ack.assert_called_once()
 
@@ -66,9 +97,8 @@ class TestBureaucrat(unittest.TestCase):
         bc = Bureaucrat()
         channel = Mock()
 
-        with patch("bureaucrat.bureaucrat.Workflow") as MockWfl:
-            wflow = Mock()
-            MockWfl.load.return_value = wflow
+        with patch("bureaucrat.bureaucrat.UnitOfWork") as MockUoW, \
+                patch("bureaucrat.bureaucrat.Workflow") as MockWfl:
             body = """
                 {
                     "name": "fault",
@@ -78,8 +108,290 @@ class TestBureaucrat(unittest.TestCase):
                 }
             """
             bc.handle_message(channel, Mock(), Mock(), body)
-            MockWfl.load.assert_called_once()
-            wflow.process.handle_message.assert_called_once()
-            wflow.save.assert_called_once()
+            MockUoW.assert_called_once()
+            self.assertEqual(MockUoW.call_args[0][0], "fake-child")
+            MockUoW.return_value.handle_messages.assert_called_once()
+            MockWfl.load.assert_not_called()
 
         channel.basic_ack.assert_called_once()
+
+    def test_handle_message_conflict(self):
+        """Test Bureaucrat.handle_message() when unit of work gives up."""
+
+        bc = Bureaucrat()
+        channel = Mock()
+        method = Mock()
+
+        with patch("bureaucrat.bureaucrat.UnitOfWork") as MockUoW:
+            MockUoW.return_value.handle_messages.side_effect = \
+                    WorkflowConflictError("fake conflict")
+            body = """
+                {
+                    "name": "completed",
+                    "target": "fake-child",
+                    "origin": "fake-origin",
+                    "payload": null
+                }
+            """
+            bc.handle_message(channel, method, Mock(), body)
+
+        channel.basic_nack.assert_called_once_with(method.delivery_tag)
+        channel.basic_ack.assert_not_called()
+
+    def test_ack_batch(self):
+        """Test Bureaucrat.ack() holds acks back until storage is synced."""
+
+        bc = Bureaucrat()
+        bc.batch_acks = True
+        bc.channel = Mock()
+        bc.connection = Mock()
+
+        with patch("bureaucrat.bureaucrat.Configs") as MockConfigs, \
+                patch("bureaucrat.bureaucrat.Storage") as MockStorage:
+            MockConfigs.instance.return_value.sync_batch = 3
+            bc.ack(bc.channel, 1)
+            bc.ack(bc.channel, 2)
+            bc.channel.basic_ack.assert_not_called()
+            bc.connection.add_timeout.assert_called_once()
+            bc.ack(bc.channel, 3)
+            MockStorage.instance.return_value.sync.assert_called_once()
+            bc.channel.basic_ack.assert_called_once_with(3, multiple=True)
+            bc.connection.remove_timeout.assert_called_once()
+
+            bc.ack(bc.channel, 4)
+            bc._on_sync_timeout()
+            bc.channel.basic_ack.assert_called_with(4, multiple=True)
+
+    def test_handle_message_coalesce(self):
+        """Test Bureaucrat.handle_message() groups buffered deliveries."""
+
+        bc = Bureaucrat()
+        bc.coalesce = True
+        bc.channel = Mock()
+        bc.connection = Mock()
+        body = """
+            {
+                "name": "completed",
+                "target": "%s",
+                "origin": "%s",
+                "payload": null
+            }
+        """
+
+        with patch("bureaucrat.bureaucrat.UnitOfWork") as MockUoW, \
+                patch("bureaucrat.bureaucrat.Configs") as MockConfigs:
+            MockConfigs.instance.return_value.sync_batch = 3
+            bc.handle_message(bc.channel, Mock(delivery_tag=1), Mock(),
+                              body % ("fake-id_0", "fake-id_0_1"))
+            bc.handle_message(bc.channel, Mock(delivery_tag=2), Mock(),
+                              body % ("other-id_0", "other-id_0_0"))
+            MockUoW.assert_not_called()
+            bc.connection.add_timeout.assert_called_once()
+            bc.handle_message(bc.channel, Mock(delivery_tag=3), Mock(),
+                              body % ("fake-id_0", "fake-id_0_0"))
+            bc.connection.remove_timeout.assert_called_once()
+            self.assertEqual([args[0][0] for args in MockUoW.call_args_list],
+                             ["fake-id", "other-id"])
+            msgs = MockUoW.return_value.handle_messages.call_args_list[0][0][0]
+            self.assertEqual([msg.origin for msg in msgs],
+                             ["fake-id_0_1", "fake-id_0_0"])
+            self.assertEqual([args[0][0] for args in
+                              bc.channel.basic_ack.call_args_list], [1, 3, 2])
+            self.assertEqual(bc.pending, [])
+
+    def test_handle_message_coalesce_batch_acks(self):
+        """Test Bureaucrat.commit() doesn't ack buffered deliveries."""
+
+        bc = Bureaucrat()
+        bc.coalesce = True
+        bc.batch_acks = True
+        bc.channel = Mock()
+        bc.connection = Mock()
+        body = """
+            {
+                "name": "response",
+                "target": "%s",
+                "origin": "",
+                "payload": null
+            }
+        """
+        calls = []
+
+        def handle_messages(msgs):
+            """Record handled instance."""
+            calls.append(('handle', msgs[0].target_pid))
+
+        bc.channel.basic_ack.side_effect = \
+                lambda tag, multiple=False: calls.append(('ack', tag,
+                                                          multiple))
+
+        with patch("bureaucrat.bureaucrat.UnitOfWork") as MockUoW, \
+                patch("bureaucrat.bureaucrat.Configs") as MockConfigs, \
+                patch("bureaucrat.bureaucrat.Storage"):
+            MockUoW.return_value.handle_messages.side_effect = handle_messages
+            MockConfigs.instance.return_value.sync_batch = 2
+            bc.pending = [(1, Message.loads(body % "fake-id")),
+                          (2, Message.loads(body % "other-id")),
+                          (3, Message.loads(body % "fake-id")),
+                          (4, Message.loads(body % "other-id"))]
+            bc.handle_pending()
+            bc.commit()
+            self.assertEqual(calls, [('handle', "fake-id"),
+                                     ('ack', 1, True), ('ack', 3, False),
+                                     ('handle', "other-id"),
+                                     ('ack', 4, True)])
+
+    def test_finish(self):
+        """Test Bureaucrat.finish() doesn't ack deliveries left in workers."""
+
+        bc = Bureaucrat()
+        bc.batch_acks = True
+        bc.channel = Mock()
+        bc.connection = Mock()
+        bc.pool = Mock(workers=[Mock(inflight=[1]), Mock(inflight=[])])
+
+        with patch("bureaucrat.bureaucrat.Configs") as MockConfigs, \
+                patch("bureaucrat.bureaucrat.Storage"):
+            MockConfigs.instance.return_value.sync_batch = 1
+            bc.finish([(3, True), (2, False)])
+            bc.channel.basic_nack.assert_called_once_with(2)
+            bc.channel.basic_ack.assert_called_once_with(3)
+
+            bc.pool.workers[0].inflight = []
+            bc.finish([(1, True)])
+            bc.channel.basic_ack.assert_called_with(1, multiple=True)
+
+    def test_setup_async_shards(self):
+        """Test Bureaucrat.setup() refuses shards with the async loop."""
+
+        config = Mock(engine_loop='async', message_shards=8,
+                      persist_outbox=False)
+        with self.assertRaises(ConfigsError):
+            Bureaucrat().setup(config)
+
+    def test_setup_async_outbox(self):
+        """Test Bureaucrat.setup() refuses outboxes with the async loop."""
+
+        config = Mock(engine_loop='async', message_shards=0,
+                      persist_outbox=True)
+        with self.assertRaises(ConfigsError):
+            Bureaucrat().setup(config)
+
+    def test_setup_publisher_confirms(self):
+        """Test Bureaucrat.setup() matches publisher options to the loop."""
+
+        config = Mock(engine_loop='async', message_shards=0,
+                      persist_outbox=False, publisher_transactions=True)
+        with self.assertRaises(ConfigsError):
+            Bureaucrat().setup(config)
+        config = Mock(engine_loop='blocking', publisher_confirms=True,
+                      publisher_transactions=False)
+        with self.assertRaises(ConfigsError):
+            Bureaucrat().setup(config)
+
+    def test_rebalance(self):
+        """Test Bureaucrat.rebalance() consumes shards of the node."""
+
+        bc = Bureaucrat()
+        bc.channel = Mock()
+        bc.instances = Mock()
+        bc.membership = Membership('node1', 5)
+
+        with patch("bureaucrat.bureaucrat.Configs") as MockConfigs, \
+                patch("bureaucrat.sharding.Configs", MockConfigs):
+            MockConfigs.instance.return_value.message_shards = 8
+            MockConfigs.instance.return_value.message_queue = 'fake_msgs'
+            bc.rebalance()
+            self.assertEqual(sorted(bc.shard_consumers.keys()), range(8))
+            self.assertEqual(bc.channel.basic_consume.call_count, 8)
+
+            bc.handle_heartbeat(bc.channel, Mock(), Mock(),
+                                '{"node": "node2"}')
+            owned = assigned_shards('node1', ['node1', 'node2'], 8)
+            self.assertEqual(set(bc.shard_consumers.keys()), owned)
+            self.assertEqual(bc.channel.basic_cancel.call_count,
+                             8 - len(owned))
+            bc.instances.flush.assert_called_once()
+
+    def test_launch_process_publisher(self):
+        """Test Bureaucrat.launch_process() commits published messages."""
+
+        bc = Bureaucrat()
+        bc.publisher = Mock(spec=TransactionalChannel)
+        channel = Mock()
+
+        with patch("bureaucrat.bureaucrat.Workflow") as MockWfl, \
+                patch("bureaucrat.channelwrapper.Configs") as MockConfigs:
+            MockWfl.create_from_string.return_value.process.id = 'fake-id'
+            MockConfigs.instance.return_value.message_shards = 0
+            bc.launch_process(channel, Mock(delivery_tag=1), Mock(), "")
+            channel.basic_publish.assert_not_called()
+            bc.publisher.basic_publish.assert_called_once()
+            bc.publisher.commit.assert_called_once_with()
+            channel.basic_ack.assert_called_once_with(1)
+
+    def test_commit_publisher(self):
+        """Test Bureaucrat.commit() commits published messages per batch."""
+
+        bc = Bureaucrat()
+        bc.batch_acks = True
+        bc.publisher = Mock(spec=TransactionalChannel)
+        bc.channel = Mock()
+        bc.connection = Mock()
+        manager = Mock()
+        manager.attach_mock(bc.publisher.commit, 'commit')
+        manager.attach_mock(bc.channel.basic_ack, 'basic_ack')
+
+        with patch("bureaucrat.bureaucrat.Configs") as MockConfigs, \
+                patch("bureaucrat.bureaucrat.Storage"):
+            MockConfigs.instance.return_value.sync_batch = 2
+            bc.ack(bc.channel, 1)
+            bc.publisher.commit.assert_not_called()
+            bc.ack(bc.channel, 2)
+            self.assertEqual([name for name, _, _ in manager.mock_calls],
+                             ['commit', 'basic_ack'])
+
+    def test_prefetch_count(self):
+        """Test Bureaucrat.prefetch_count()."""
+
+        bc = Bureaucrat()
+        config = Mock(prefetch_count=0, sync_batch=64, max_unsaved=100)
+        self.assertEqual(bc.prefetch_count(config), 1)
+        bc.batch_acks = True
+        self.assertEqual(bc.prefetch_count(config), 64)
+        bc.hold_unsaved = True
+        self.assertEqual(bc.prefetch_count(config), 164)
+        config.prefetch_count = 10
+        self.assertEqual(bc.prefetch_count(config), 10)
+
+    def test_handle_message_hold_unsaved(self):
+        """Test Bureaucrat.handle_message() holds acks of unsaved instances."""
+
+        bc = Bureaucrat()
+        bc.hold_unsaved = True
+        bc.instances = Mock()
+        channel = Mock()
+        body = """
+            {
+                "name": "start",
+                "target": "fake-id_0",
+                "origin": "fake-id",
+                "payload": null
+            }
+        """
+
+        with patch("bureaucrat.bureaucrat.UnitOfWork"), \
+                patch("bureaucrat.bureaucrat.Configs") as MockConfigs:
+            MockConfigs.instance.return_value.max_unsaved = 100
+            bc.instances.is_unsaved.return_value = True
+            bc.handle_message(channel, Mock(delivery_tag=1), Mock(), body)
+            bc.handle_message(channel, Mock(delivery_tag=2), Mock(), body)
+            channel.basic_ack.assert_not_called()
+            self.assertEqual(bc.held, {"fake-id": [1, 2]})
+
+            bc.instances.is_unsaved.return_value = False
+            bc.instances.was_lost.return_value = False
+            bc.handle_message(channel, Mock(delivery_tag=3), Mock(), body)
+            self.assertEqual([args[0][0] for args in
+                              channel.basic_ack.call_args_list], [3, 1, 2])
+            self.assertEqual(bc.held, {})
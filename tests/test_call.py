@@ -54,7 +54,7 @@ class TestCall(unittest.TestCase):
         result = self.fexpr.handle_message(self.ch, msg)
         self.assertEqual(result, 'consumed')
         self.assertEqual(self.fexpr.state, 'active')
-        self.ch._ch.basic_publish.assert_called_once()
+        self.ch.launch.assert_called_once()
 
     def test_handle_message_completed(self):
         """Test Call.handle_message() with 'completed' message."""
@@ -2,6 +2,8 @@ from __future__ import absolute_import
 import unittest
 import xml.etree.ElementTree as ET
 
+from mock import patch
+
 from bureaucrat.context import Context
 from bureaucrat.context import ContextError
 from bureaucrat.flowexpression import Process
@@ -87,3 +89,30 @@ class TestContext(unittest.TestCase):
         self.assertEqual(self.procexpr.context.get('prop1'), 5)
         with self.assertRaises(ContextError):
             self.assertEqual(self.procexpr.context.get('newprop'))
+
+    def test_externalize(self):
+        """Test Context.externalize() and reading of blob references."""
+
+        blobs = {}
+        self.whileexpr.context.set('prop5', ["item"] * 10)
+        self.whileexpr.context.externalize(50, blobs)
+        self.assertEqual(len(blobs), 1)
+        digest = blobs.keys()[0]
+        self.assertEqual(self.whileexpr.context.localprops['prop5'],
+                         {"inst:blob": digest})
+        self.assertEqual(self.whileexpr.context.localprops['prop4'],
+                         {"test": "test"})
+        self.assertEqual(self.allexpr.context.blob_refs(), set())
+        self.assertEqual(self.procexpr.blob_refs(), set([digest]))
+
+        with patch("bureaucrat.blobstore.BlobStore.load") as load:
+            load.return_value = ["item"] * 10
+            lazy = self.allexpr.context.as_lazy_dictionary()
+            load.assert_not_called()
+            self.assertEqual(lazy["prop5"], ["item"] * 10)
+            self.assertEqual(self.allexpr.context.get('prop5'), ["item"] * 10)
+            self.assertEqual(self.allexpr.context.as_dictionary()["prop5"],
+                             ["item"] * 10)
+            load.assert_called_with(digest)
+            self.allexpr.context.set('prop5', 1)
+            self.assertEqual(load.call_count, 3)
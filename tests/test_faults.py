@@ -148,6 +148,30 @@ class TestFaults(unittest.TestCase):
                                                   })
         self.assertEqual(self.seq.state, 'aborting')
 
+    def test_is_waiting_for_fault_handler(self):
+        """Test expression is waiting while its handler waits on participant."""
+
+        self.seq.state = 'aborting'
+        self.seq.children[0].state = 'aborted'
+        self.seq.children[1].state = 'canceled'
+        self.seq.context.throw(code='TestError', message='Some error message')
+        self.seq.handle_message(self.ch, Message(name='start',
+                                                 target='fake-id_0_faults',
+                                                 origin='fake-id_0'))
+        self.assertFalse(self.seq.is_waiting())
+        self.seq.handle_message(self.ch, Message(name='start',
+                                                 target='fake-id_0_faults_2',
+                                                 origin='fake-id_0_faults'))
+        self.assertFalse(self.seq.is_waiting())
+        self.seq.handle_message(self.ch,
+                                Message(name='start',
+                                        target='fake-id_0_faults_2_0',
+                                        origin='fake-id_0_faults_2'))
+        self.ch.elaborate.assert_called_once()
+        self.assertTrue(self.seq.is_waiting())
+        self.root.state = 'active'
+        self.assertTrue(self.root.is_waiting())
+
     def test_throwing_faults_in_case_hadler_faults_too(self):
         """Faulting handler should cause parent activity to throw fault.
 
@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+
+import unittest
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+
+from mock import patch
+
+from bureaucrat.launcher import Launcher
+from bureaucrat.utils import context2dict
+
+processdsc = """<?xml version="1.0"?>
+<process name="example">
+    <context>
+        <property name="prop1" type="int">1</property>
+    </context>
+    <action participant="participant1" />
+</process>
+"""
+
+class TestLauncher(unittest.TestCase):
+    """Tests for Launcher."""
+
+    def setUp(self):
+        """Set up environment."""
+
+        fdesc, self.path = tempfile.mkstemp(suffix=".xml")
+        os.write(fdesc, processdsc)
+        os.close(fdesc)
+
+    def tearDown(self):
+        """Clean up environment."""
+        os.remove(self.path)
+
+    def test_launch_many(self):
+        """Test Launcher.launch_many() reuses connection and definition."""
+
+        with patch("bureaucrat.launcher.pika.BlockingConnection") as MockConn:
+            launcher = Launcher({})
+            self.assertEqual(launcher.launch_many([(self.path, {"prop2": i})
+                                                   for i in range(3)]), 3)
+            launcher.launch(self.path, {"prop1": 5})
+            MockConn.assert_called_once()
+            channel = MockConn.return_value.channel.return_value
+            self.assertEqual(channel.basic_publish.call_count, 4)
+            channel.tx_select.assert_not_called()
+
+            bodies = [args[1]["body"] for args in
+                      channel.basic_publish.call_args_list]
+            root = ET.fromstring(bodies[2])
+            self.assertEqual([child.tag for child in root],
+                             ['context', 'action'])
+            self.assertEqual(context2dict(root[0]), {"prop1": 1, "prop2": 2})
+            root = ET.fromstring(bodies[3])
+            self.assertEqual(context2dict(root[0]), {"prop1": 5})
+
+            launcher.close()
+            MockConn.return_value.close.assert_called_once()
+
+    def test_launch_many_transactions(self):
+        """Test Launcher.launch_many() commits launches in batches."""
+
+        with patch("bureaucrat.launcher.pika.BlockingConnection") as MockConn:
+            launcher = Launcher({"launcher_transactions": "yes"})
+            launcher.launch_many([(self.path, {})] * 5, batch_size=2)
+            channel = MockConn.return_value.channel.return_value
+            channel.tx_select.assert_called_once()
+            self.assertEqual(channel.tx_commit.call_count, 3)
+
+    def test_template_cache(self):
+        """Test Launcher reparses definitions changed on disk."""
+
+        launcher = Launcher({})
+        template, _ = launcher._template(self.path)
+        self.assertTrue(launcher._template(self.path)[0] is template)
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertFalse(launcher._template(self.path)[0] is template)
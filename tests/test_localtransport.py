@@ -0,0 +1,116 @@
+from __future__ import absolute_import
+
+import unittest
+import shutil
+
+from ConfigParser import ConfigParser
+
+from bureaucrat.localtransport import LocalEngine
+from bureaucrat.localtransport import LocalChannel
+from bureaucrat.configs import Configs
+from bureaucrat.storage import Storage
+
+STORAGE_DIR = '/tmp/unittest-processes'
+
+processdsc = """<?xml version="1.0"?>
+<process name="e2e">
+    <context>
+        <property name="counter" type="int">0</property>
+        <property name="subprocess" type="str">
+            &lt;process&gt;&lt;action participant="sub" /&gt;&lt;/process&gt;
+        </property>
+    </context>
+    <sequence>
+        <action participant="inc" />
+        <all>
+            <action participant="inc" />
+            <action participant="inc" />
+        </all>
+        <while>
+            <condition>context["counter"] &lt; 5</condition>
+            <action participant="inc" />
+        </while>
+        <call process="$subprocess" />
+    </sequence>
+</process>
+"""
+
+class TestLocalChannel(unittest.TestCase):
+    """Tests for LocalChannel."""
+
+    def test_get(self):
+        """Test LocalChannel delivers messages in order."""
+
+        channel = LocalChannel()
+        channel.basic_publish(exchange='', routing_key='queue1', body='1')
+        channel.basic_publish(exchange='', routing_key='queue2', body='2')
+        method, body = channel.get()
+        self.assertEqual((method.routing_key, body), ('queue1', '1'))
+        channel.basic_nack(method.delivery_tag)
+        method, body = channel.get()
+        self.assertEqual((method.routing_key, body), ('queue1', '1'))
+        channel.get()
+        self.assertEqual(channel.get(), None)
+        channel.basic_ack(method.delivery_tag + 1, multiple=True)
+        self.assertEqual(channel.unacked, {})
+
+class TestLocalEngine(unittest.TestCase):
+    """Tests for LocalEngine."""
+
+    def setUp(self):
+        """Set up environment."""
+
+        confparser = ConfigParser()
+        confparser.add_section('bureaucrat')
+        confparser.set('bureaucrat', 'storage_dir', STORAGE_DIR)
+        Configs.instance(confparser)
+        self.calls = []
+
+    def tearDown(self):
+        """Clean up environment."""
+
+        Configs._instance = None
+        Storage._instance = None
+        shutil.rmtree(STORAGE_DIR)
+
+    def inc(self, payload):
+        """Participant incrementing counter."""
+
+        self.calls.append('inc')
+        payload["counter"] += 1
+        return payload
+
+    def sub(self, payload):
+        """Participant of subprocess."""
+        self.calls.append('sub')
+
+    def test_run(self):
+        """Test LocalEngine runs processes with subprocesses to the end."""
+
+        engine = LocalEngine({"inc": self.inc, "sub": self.sub})
+        engine.launch(processdsc)
+        self.assertTrue(engine.run() > 0)
+        self.assertEqual(self.calls, ['inc'] * 6 + ['sub'])
+        self.assertEqual(len(engine.finished), 2)
+        self.assertEqual(engine.unhandled, [])
+        self.assertEqual(engine.channel.unacked, {})
+        self.assertEqual(list(Storage.instance().keys("process")), [])
+
+    def test_run_unknown_participant(self):
+        """Test LocalEngine keeps work items of unknown participants."""
+
+        engine = LocalEngine({"inc": self.inc})
+        engine.launch(processdsc)
+        engine.run()
+        self.assertEqual(engine.finished, [])
+        self.assertEqual([key for key, _ in engine.unhandled], ['worker_sub'])
+
+    def test_run_batch_acks(self):
+        """Test LocalEngine fires timers of batched acknowledgements."""
+
+        engine = LocalEngine({"inc": self.inc, "sub": self.sub})
+        engine.app.batch_acks = True
+        engine.launch(processdsc)
+        engine.run()
+        self.assertEqual(len(engine.finished), 2)
+        self.assertEqual(engine.channel.unacked, {})
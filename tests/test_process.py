@@ -88,3 +88,16 @@ class TestProcess(unittest.TestCase):
                                                 target='fake-id',
                                                 origin='fake-id_0')
             self.ch.send.assert_called_once_with(newmsg)
+
+    def test_is_waiting(self):
+        """Test Process.is_waiting()."""
+
+        self.assertFalse(self.fexpr.is_waiting())
+        self.fexpr.state = 'active'
+        self.assertFalse(self.fexpr.is_waiting())
+        self.fexpr.children[0].state = 'active'
+        self.assertTrue(self.fexpr.is_waiting())
+        self.fexpr.children[0].state = 'completed'
+        self.assertFalse(self.fexpr.is_waiting())
+        self.fexpr.state = 'completed'
+        self.assertTrue(self.fexpr.is_waiting())
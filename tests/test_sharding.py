@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+
+import unittest
+
+from ConfigParser import ConfigParser
+
+from bureaucrat.sharding import jump_hash
+from bureaucrat.sharding import shard_of
+from bureaucrat.sharding import message_queue
+from bureaucrat.sharding import assigned_shards
+from bureaucrat.sharding import Membership
+from bureaucrat.configs import Configs
+
+class TestSharding(unittest.TestCase):
+    """Tests for sharding functions."""
+
+    def tearDown(self):
+        """Clean up environment."""
+        Configs._instance = None
+
+    def test_jump_hash(self):
+        """Test jump_hash() moves few keys when buckets are added."""
+
+        keys = range(0, 1000000, 997)
+        before = [jump_hash(key, 10) for key in keys]
+        after = [jump_hash(key, 11) for key in keys]
+        self.assertTrue(all(0 <= bucket < 10 for bucket in before))
+        moved = [b2 for b1, b2 in zip(before, after) if b1 != b2]
+        self.assertTrue(all(bucket == 10 for bucket in moved))
+        self.assertTrue(len(moved) < len(keys) / 5)
+
+    def test_message_queue(self):
+        """Test message_queue()."""
+
+        confparser = ConfigParser()
+        confparser.add_section('bureaucrat')
+        Configs.instance(confparser)
+        self.assertEqual(message_queue('fake-id'), 'bureaucrat_msgs')
+
+        Configs._instance = None
+        confparser.set('bureaucrat', 'message_shards', '8')
+        Configs.instance(confparser)
+        self.assertEqual(message_queue('fake-id'),
+                         'bureaucrat_msgs.%d' % shard_of('fake-id', 8))
+
+    def test_assigned_shards(self):
+        """Test assigned_shards() moves only shards of joining node."""
+
+        nodes = ['node1', 'node2', 'node3']
+        before = dict((node, assigned_shards(node, nodes, 64))
+                      for node in nodes)
+        self.assertEqual(sorted(shard for shards in before.values()
+                                for shard in shards), range(64))
+
+        nodes.append('node4')
+        after = dict((node, assigned_shards(node, nodes, 64))
+                     for node in nodes)
+        for node in ['node1', 'node2', 'node3']:
+            self.assertTrue(after[node] <= before[node])
+        self.assertEqual(after['node4'],
+                         set(range(64)) - after['node1'] - after['node2'] -
+                         after['node3'])
+
+    def test_membership(self):
+        """Test Membership tracks live nodes."""
+
+        members = Membership('node1', 5)
+        self.assertEqual(members.nodes, ['node1'])
+        self.assertFalse(members.heartbeat('node1'))
+        self.assertTrue(members.heartbeat('node2', instant=100))
+        self.assertFalse(members.heartbeat('node2', instant=105))
+        self.assertTrue(members.heartbeat('node3', instant=110))
+        self.assertEqual(members.nodes, ['node1', 'node2', 'node3'])
+        self.assertFalse(members.expire(instant=115))
+        self.assertTrue(members.expire(instant=121))
+        self.assertEqual(members.nodes, ['node1', 'node3'])
+        self.assertTrue(members.heartbeat('node3', leaving=True))
+        self.assertEqual(members.nodes, ['node1'])
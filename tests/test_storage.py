@@ -1,12 +1,21 @@
 import unittest
 import os
 import os.path
+import shutil
 
 from ConfigParser import ConfigParser
 
 from bureaucrat.configs import Configs
 from bureaucrat.storage import Storage
 from bureaucrat.storage import StorageError
+from bureaucrat.storage import SqliteBackend
+from bureaucrat.storage import FilesystemBackend
+from bureaucrat.storage import StorageLock
+from bureaucrat.storage import instance_lock
+from bureaucrat.storage import striped_lock
+from bureaucrat.storage import LOCK_STRIPES
+from bureaucrat.storage import LOCK_DIR
+from bureaucrat.storage import COMPRESSED_MAGIC
 
 STORAGE_DIR = '/tmp/unittest-processes'
 
@@ -78,7 +87,241 @@ class TestStorage(unittest.TestCase):
         file_path = os.path.join(STORAGE_DIR, "definition/fake-key")
         with open(file_path, 'w') as fd:
             fd.write(doc)
-        self.assertEqual(['fake-key'], self.storage.keys("definition"))
+        self.assertEqual(['fake-key'], list(self.storage.keys("definition")))
         os.unlink(file_path)
         os.rmdir(os.path.join(STORAGE_DIR, "definition"))
-        self.assertEqual(self.storage.keys("definition"), [])
+        self.assertEqual(list(self.storage.keys("definition")), [])
+
+class TestCompression(unittest.TestCase):
+    """Tests for Storage compression."""
+
+    def setUp(self):
+        """Set up SUT."""
+        confparser = ConfigParser()
+        confparser.add_section('bureaucrat')
+        confparser.set('bureaucrat', 'storage_dir', STORAGE_DIR)
+        confparser.set('bureaucrat', 'compress_threshold', '100')
+        Configs.instance(confparser)
+        Storage._instance = None
+        self.storage = Storage.instance()
+
+    def tearDown(self):
+        """Clean up environment."""
+        Configs._instance = None
+        Storage._instance = None
+        shutil.rmtree(os.path.join(STORAGE_DIR, "process"))
+
+    def test_save_load(self):
+        """Test large documents are compressed."""
+
+        large = '{"list": [%s]}' % ", ".join(["1"] * 100)
+        self.storage.save("process", "large-key", large)
+        self.storage.save("process", "small-key", "{}")
+        self.assertTrue(self.storage.backend.load(
+            "process", "large-key").startswith(COMPRESSED_MAGIC))
+        self.assertEqual(self.storage.backend.load("process", "small-key"),
+                         "{}")
+        self.assertEqual(self.storage.load("process", "large-key"), large)
+        self.assertEqual(self.storage.load("process", "small-key"), "{}")
+        self.assertEqual(self.storage.metrics.compressed, 1)
+        self.assertEqual(self.storage.metrics.decompressed, 1)
+        self.assertTrue(self.storage.metrics.ratio < 0.5)
+
+    def test_header(self):
+        """Test headers are kept uncompressed in front of documents."""
+
+        large = '{"list": [%s]}' % ", ".join(["1"] * 100)
+        self.storage.save("process", "large-key", large, "12")
+        self.storage.save("process", "small-key", "{}")
+        self.assertEqual(self.storage.load("process", "large-key"), large)
+        self.assertEqual(self.storage.load_header("process", "large-key"),
+                         "12")
+        self.assertIsNone(self.storage.load_header("process", "small-key"))
+        self.assertEqual(self.storage.metrics.decompressed, 1)
+
+class TestShardedLayout(unittest.TestCase):
+    """Tests for FilesystemBackend with sharded layout."""
+
+    def setUp(self):
+        """Set up SUT."""
+        self.backend = FilesystemBackend(STORAGE_DIR, 'sharded')
+
+    def tearDown(self):
+        """Clean up environment."""
+        shutil.rmtree(os.path.join(STORAGE_DIR, "process"))
+
+    def test_save_load(self):
+        """Test documents are saved to shard directories."""
+
+        self.backend.save("process", "fake-key", "{}")
+        self.backend.append("process", "fake-key", "[]")
+        self.assertEqual(self.backend.load("process", "fake-key"), "{}[]")
+        self.assertFalse(os.path.exists(os.path.join(STORAGE_DIR,
+                                                     "process/fake-key")))
+        self.assertTrue(self.backend.exists("process", "fake-key"))
+        self.backend.delete("process", "fake-key")
+        self.assertFalse(self.backend.exists("process", "fake-key"))
+
+    def test_keys(self):
+        """Test FilesystemBackend.keys() walks shard directories."""
+
+        keys = set(["fake-key-%d" % idx for idx in range(20)])
+        for key in keys:
+            self.backend.save("process", key, "{}")
+        self.assertEqual(set(self.backend.keys("process")), keys)
+
+    def test_convert_layout(self):
+        """Test FilesystemBackend.convert_layout()."""
+
+        flat = FilesystemBackend(STORAGE_DIR)
+        flat.save("process", "fake-key", "{}")
+        self.assertEqual(self.backend.convert_layout("process"), 1)
+        self.assertEqual(list(self.backend.keys("process")), ["fake-key"])
+        self.assertEqual(flat.convert_layout("process"), 1)
+        self.assertEqual(os.listdir(os.path.join(STORAGE_DIR, "process")),
+                         ["fake-key"])
+
+class TestFilesystemSync(unittest.TestCase):
+    """Tests for FilesystemBackend sync modes."""
+
+    def tearDown(self):
+        """Clean up environment."""
+        shutil.rmtree(os.path.join(STORAGE_DIR, "process"))
+
+    def test_save_atomic(self):
+        """Test FilesystemBackend.save() replaces document atomically."""
+
+        backend = FilesystemBackend(STORAGE_DIR, sync='always')
+        backend.save("process", "fake-key", "{}")
+        backend.save("process", "fake-key", "[]")
+        self.assertEqual(backend.load("process", "fake-key"), "[]")
+        self.assertEqual(os.listdir(os.path.join(STORAGE_DIR, "process")),
+                         ["fake-key"])
+
+    def test_keys_skip_temporary(self):
+        """Test FilesystemBackend.keys() skips unfinished writes."""
+
+        backend = FilesystemBackend(STORAGE_DIR)
+        backend.save("process", "fake-key", "{}")
+        with open(os.path.join(STORAGE_DIR, "process/.fake-key.1.2.tmp"),
+                  'w') as fd:
+            fd.write("{")
+        self.assertEqual(list(backend.keys("process")), ["fake-key"])
+
+    def test_group_sync(self):
+        """Test FilesystemBackend.sync() in group mode."""
+
+        backend = FilesystemBackend(STORAGE_DIR, sync='group')
+        backend.save("process", "fake-key", "{}")
+        backend.append("process", "other-key", "{}")
+        backend.save("process", "deleted-key", "{}")
+        backend.delete("process", "deleted-key")
+        self.assertEqual(len(backend._pending_files), 3)
+        self.assertEqual(backend._pending_dirs,
+                         set([os.path.join(STORAGE_DIR, "process")]))
+        backend.sync()
+        self.assertEqual(backend._pending_files, set())
+        self.assertEqual(backend._pending_dirs, set())
+
+class TestSqliteBackend(unittest.TestCase):
+    """Tests for SqliteBackend."""
+
+    def setUp(self):
+        """Set up SUT."""
+        self.path = os.path.join(STORAGE_DIR, "test.db")
+        self.backend = SqliteBackend(self.path)
+
+    def tearDown(self):
+        """Clean up environment."""
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+
+    def test_save_load(self):
+        """Test SqliteBackend.save() and SqliteBackend.load()."""
+
+        doc = "<process></process>"
+        self.backend.save("definition", "fake-key", doc)
+        self.assertEqual(doc, self.backend.load("definition", "fake-key"))
+        self.backend.save("definition", "fake-key", "{}")
+        self.assertEqual("{}", self.backend.load("definition", "fake-key"))
+        with self.assertRaises(StorageError):
+            self.backend.load("process", "fake-key")
+
+    def test_load_prefix(self):
+        """Test SqliteBackend.load_prefix()."""
+
+        self.backend.save("process", "fake-key", "\x00\x01\x02\x03")
+        self.assertEqual(self.backend.load_prefix("process", "fake-key", 2),
+                         "\x00\x01")
+        with self.assertRaises(StorageError):
+            self.backend.load_prefix("process", "other-key", 2)
+
+    def test_append(self):
+        """Test SqliteBackend.append()."""
+
+        self.backend.append("delta", "fake-key", "line1\n")
+        self.backend.append("delta", "fake-key", "line2\n")
+        self.assertEqual(self.backend.load("delta", "fake-key"),
+                         "line1\nline2\n")
+
+    def test_delete(self):
+        """Test SqliteBackend.delete()."""
+
+        self.backend.save("definition", "fake-key", "{}")
+        self.backend.delete("definition", "fake-key")
+        self.assertFalse(self.backend.exists("definition", "fake-key"))
+        with self.assertRaises(StorageError):
+            self.backend.delete("definition", "fake-key")
+
+    def test_group_sync(self):
+        """Test SqliteBackend.sync() in group mode."""
+
+        backend = SqliteBackend(self.path, 'group')
+        backend.save("definition", "fake-key", "{}")
+        backend.sync()
+        self.assertEqual(self.backend.load("definition", "fake-key"), "{}")
+
+    def test_keys(self):
+        """Test SqliteBackend.keys()."""
+
+        self.assertEqual(self.backend.keys("definition"), [])
+        self.backend.save("definition", "fake-key", "{}")
+        self.backend.save("process", "other-key", "{}")
+        self.assertEqual(self.backend.keys("definition"), ["fake-key"])
+        self.assertTrue(self.backend.exists("process", "other-key"))
+
+class TestStorageLock(unittest.TestCase):
+    """Tests for StorageLock."""
+
+    def test_reentrant(self):
+        """Test StorageLock is reentrant within a process."""
+
+        lock = StorageLock("unittest")
+        with lock:
+            with StorageLock("unittest"):
+                self.assertEqual(StorageLock._states["unittest"].depth, 2)
+            self.assertFalse(StorageLock._states["unittest"].fhdl.closed)
+        self.assertEqual(StorageLock._states["unittest"].depth, 0)
+        self.assertTrue(os.path.exists(os.path.join(LOCK_DIR,
+                                                    "unittest.lock")))
+
+    def test_instance_lock(self):
+        """Test instance_lock() spreads processes over stripes."""
+
+        self.assertEqual(instance_lock(u"fake-id").name,
+                         instance_lock("fake-id").name)
+        names = set([instance_lock("fake-id-%d" % idx).name
+                     for idx in range(100)])
+        self.assertTrue(len(names) > 1)
+
+    def test_striped_lock(self):
+        """Test striped_lock() keeps resource types apart."""
+
+        self.assertEqual(instance_lock("fake-id").name,
+                         striped_lock("process", "fake-id").name)
+        self.assertNotEqual(striped_lock("definition", "fake-id").name,
+                            instance_lock("fake-id").name)
+        names = set([striped_lock("definition", "%040x" % idx).name
+                     for idx in range(5000)])
+        self.assertTrue(1 < len(names) <= LOCK_STRIPES)
@@ -0,0 +1,162 @@
+from __future__ import absolute_import
+
+import unittest
+import os
+import os.path
+import json
+import time
+import shutil
+
+from mock import Mock
+from mock import patch
+from ConfigParser import ConfigParser
+
+from bureaucrat.workerpool import WorkerPool
+from bureaucrat.workerpool import WorkerChannel
+from bureaucrat.channelwrapper import TransactionalChannel
+from bureaucrat.channelwrapper import ChannelWrapper
+from bureaucrat.workflow import Workflow
+from bureaucrat.workflow import UnitOfWork
+from bureaucrat.message import Message
+from bureaucrat.configs import Configs
+from bureaucrat.storage import Storage
+
+STORAGE_DIR = '/tmp/unittest-processes'
+
+class FakeEngine(object):
+    """Engine handling deliveries according to message names."""
+
+    def handle_deliveries(self, channel, deliveries):
+        """Acknowledge deliveries, requeue conflicts or crash."""
+
+        for delivery_tag, msg in deliveries:
+            if msg.name == 'crash':
+                os._exit(1)
+            elif msg.name == 'conflict':
+                channel.basic_nack(delivery_tag)
+            else:
+                channel.basic_ack(delivery_tag)
+
+def body(name, target):
+    """Return message body."""
+    return json.dumps({"name": name, "target": target, "origin": "",
+                       "payload": None})
+
+class TestWorkerPool(unittest.TestCase):
+    """Tests for WorkerPool."""
+
+    def setUp(self):
+        """Set up environment."""
+
+        confparser = ConfigParser()
+        confparser.add_section('bureaucrat')
+        confparser.set('bureaucrat', 'storage_dir', STORAGE_DIR)
+        Configs.instance(confparser)
+        self.pool = WorkerPool(2, FakeEngine)
+
+    def tearDown(self):
+        """Clean up environment."""
+
+        Configs._instance = None
+        Storage._instance = None
+        if os.path.isdir(STORAGE_DIR):
+            os.removedirs(STORAGE_DIR)
+
+    def collect(self, count):
+        """Return the given number of finished deliveries."""
+
+        finished = []
+        deadline = time.time() + 5
+        while len(finished) < count and time.time() < deadline:
+            finished.extend(self.pool.collect())
+            time.sleep(0.01)
+        return finished
+
+    def test_dispatch(self):
+        """Test WorkerPool.dispatch() keeps instances on one worker."""
+
+        for delivery_tag, pid in enumerate(['pid-1', 'pid-2', 'pid-1',
+                                            'pid-3', 'pid-1']):
+            self.pool.dispatch(pid, delivery_tag, body('start', pid))
+        self.assertEqual(sum(len(worker.inflight)
+                             for worker in self.pool.workers), 5)
+        worker = [worker for worker in self.pool.workers
+                  if 0 in worker.inflight][0]
+        self.assertEqual([tag for tag in worker.inflight if tag in (0, 2, 4)],
+                         [0, 2, 4])
+
+    def test_collect(self):
+        """Test WorkerPool.collect() reports handled deliveries."""
+
+        with patch("bureaucrat.workerpool.pika"):
+            self.pool.start()
+        self.pool.dispatch('pid-1', 1, body('start', 'pid-1'))
+        self.pool.dispatch('pid-2', 2, body('conflict', 'pid-2'))
+        self.pool.dispatch('pid-1', 3, body('start', 'pid-1'))
+        self.assertEqual(sorted(self.collect(3)),
+                         [(1, True), (2, False), (3, True)])
+        self.assertEqual(self.pool.stop(), [])
+        self.assertFalse(any(worker.is_alive()
+                             for worker in self.pool.workers))
+
+    def test_collect_crash(self):
+        """Test WorkerPool.collect() requeues deliveries of crashed worker."""
+
+        with patch("bureaucrat.workerpool.pika"):
+            self.pool.start()
+            self.pool.dispatch('pid-1', 1, body('crash', 'pid-1'))
+            self.pool.dispatch('pid-1', 2, body('start', 'pid-1'))
+            self.assertEqual(self.collect(2), [(1, False), (2, False)])
+            self.assertTrue(all(worker.is_alive()
+                                for worker in self.pool.workers))
+        self.pool.dispatch('pid-1', 3, body('start', 'pid-1'))
+        self.assertEqual(self.collect(1), [(3, True)])
+        self.pool.stop()
+
+class TestWorkerChannel(unittest.TestCase):
+    """Tests for WorkerChannel."""
+
+    def test_commit(self):
+        """Test WorkerChannel.commit() reports acks after committing."""
+
+        publisher = Mock(spec=TransactionalChannel)
+        results = Mock()
+        channel = WorkerChannel(publisher, 1, results)
+        channel.basic_ack(10)
+        channel.basic_ack(11)
+        results.put.assert_not_called()
+        with patch("bureaucrat.workerpool.Storage") as MockStorage:
+            channel.commit()
+            MockStorage.instance.return_value.sync.assert_called_once()
+        publisher.commit.assert_called_once_with()
+        self.assertEqual([args[0][0] for args in results.put.call_args_list],
+                         [(1, 10, True), (1, 11, True)])
+        channel.basic_nack(12)
+        results.put.assert_called_with((1, 12, False))
+
+    def test_commit_outbox(self):
+        """Test outbox is kept until the worker's messages are committed."""
+
+        confparser = ConfigParser()
+        confparser.add_section('bureaucrat')
+        confparser.set('bureaucrat', 'storage_dir', STORAGE_DIR)
+        confparser.set('bureaucrat', 'persist_outbox', 'yes')
+        Configs.instance(confparser)
+        storage = Storage.instance()
+        try:
+            Workflow.create_from_string(
+                '<process><action participant="test" /></process>',
+                'fake-id')
+            publisher = Mock(spec=TransactionalChannel)
+            outbox_kept = []
+            publisher.commit.side_effect = lambda: outbox_kept.append(
+                storage.exists("outbox", 'fake-id'))
+            channel = WorkerChannel(publisher, 1, Mock())
+            UnitOfWork('fake-id', ChannelWrapper(channel)).handle_message(
+                Message(name='start', target='fake-id', origin=''))
+            self.assertEqual(outbox_kept, [True])
+            self.assertFalse(storage.exists("outbox", 'fake-id'))
+        finally:
+            Configs._instance = None
+            Storage._instance = None
+            shutil.rmtree(STORAGE_DIR)
@@ -1,13 +1,25 @@
 import unittest
 import os
 import os.path
+import json
+import xml.etree.ElementTree as ET
 
 from mock import Mock
+from mock import patch
 from ConfigParser import ConfigParser
 
 from bureaucrat.workflow import Workflow
+from bureaucrat.workflow import UnitOfWork
+from bureaucrat.workflow import WorkflowConflictError
+from bureaucrat.workflow import DefinitionCache
+from bureaucrat.workflow import InstanceCache
+from bureaucrat.workflow import republish_outboxes
+from bureaucrat.workflow import definition_digest
+from bureaucrat.flowexpression import Process
+from bureaucrat.context import Context
 from bureaucrat.configs import Configs
 from bureaucrat.storage import Storage
+from bureaucrat.message import Message
 
 processdsc = """<?xml version="1.0"?>
 <process name="example1">
@@ -56,12 +68,12 @@ class TestWorkflow(unittest.TestCase):
 
     def tearDown(self):
         """Clean up environment."""
+        Workflow.load('fake-id').delete()
         Configs._instance = None
         Storage._instance = None
-        os.unlink(os.path.join(STORAGE_DIR, "process/fake-id"))
         os.rmdir(os.path.join(STORAGE_DIR, "process"))
-        os.unlink(os.path.join(STORAGE_DIR, "definition/fake-id"))
         os.rmdir(os.path.join(STORAGE_DIR, "definition"))
+        os.rmdir(os.path.join(STORAGE_DIR, "definition_refs"))
         os.removedirs(STORAGE_DIR)
 
     def test_create_from_string(self):
@@ -75,3 +87,487 @@ class TestWorkflow(unittest.TestCase):
         self.wflow.save()
         wflow = Workflow.load(self.wflow.process.id)
         self.assertTrue(wflow.process.state == 'ready')
+        self.assertEqual(wflow.revision, 2)
+
+    def test_shared_definition(self):
+        """Test instances share one copy of definition."""
+
+        root = ET.fromstring(processdsc)
+        ctx = ET.fromstring(
+            '<context><property name="prop1" type="int">1</property></context>')
+        root.insert(0, ctx)
+        root.set('parent', 'parent-id')
+        wflow = Workflow.create_from_string(ET.tostring(root), 'other-id')
+        self.assertEqual(wflow.definition, self.wflow.definition)
+        self.assertEqual(list(Storage.instance().keys("definition")),
+                         [self.wflow.definition])
+        self.assertEqual(Storage.instance().load("definition_refs",
+                                                 wflow.definition), "2")
+
+        wflow = Workflow.load('other-id')
+        self.assertEqual(wflow.process.parent_id, 'parent-id')
+        self.assertEqual(wflow.process.context.get('prop1'), 1)
+        wflow.delete()
+        self.assertEqual(Storage.instance().load("definition_refs",
+                                                 wflow.definition), "1")
+
+    def test_load_legacy(self):
+        """Test Workflow.load() for instance with own copy of definition."""
+
+        storage = Storage.instance()
+        snapshot = Workflow.load('fake-id').process.snapshot()
+        snapshot["state"] = 'active'
+        storage.save("definition", "legacy-id", processdsc)
+        storage.save("process", "legacy-id",
+                     json.dumps(snapshot).replace('fake-id', 'legacy-id'))
+        wflow = Workflow.load('legacy-id')
+        self.assertEqual(wflow.process.state, 'active')
+        self.assertEqual(wflow.revision, 0)
+        self.assertTrue(wflow.definition is None)
+        wflow.save()
+        Workflow.load('legacy-id').delete()
+        self.assertFalse(storage.exists("definition", "legacy-id"))
+
+    def test_migrate(self):
+        """Test Workflow.migrate()."""
+
+        storage = Storage.instance()
+        snapshot = Workflow.load('fake-id').process.snapshot()
+        storage.save("definition", "legacy-id",
+                     processdsc.replace('<process', '<process parent="x"'))
+        storage.save("process", "legacy-id",
+                     json.dumps(snapshot).replace('fake-id', 'legacy-id'))
+        legacy = Workflow.load('legacy-id')
+        self.assertTrue(Workflow.migrate('legacy-id'))
+        self.assertFalse(Workflow.migrate('legacy-id'))
+        self.assertFalse(storage.exists("definition", "legacy-id"))
+        wflow = Workflow.load('legacy-id')
+        self.assertEqual(wflow.definition, self.wflow.definition)
+        self.assertEqual(wflow.process.parent_id, 'x')
+        self.assertEqual(wflow.revision, 1)
+        with self.assertRaises(WorkflowConflictError):
+            legacy.save()
+        wflow.delete()
+
+    def test_save_delta(self):
+        """Test Workflow.save() with delta log."""
+
+        confparser = ConfigParser()
+        confparser.add_section('bureaucrat')
+        confparser.set('bureaucrat', 'storage_dir', STORAGE_DIR)
+        confparser.set('bureaucrat', 'compaction_interval', '3')
+        Configs._instance = None
+        Configs.instance(confparser)
+        storage = Storage.instance()
+
+        wflow = Workflow.load('fake-id')
+        wflow.process.state = 'active'
+        wflow.save()
+        wflow.process.children[1].state = 'active'
+        wflow.process.children[1].context.set('counter', 1)
+        wflow.save()
+        self.assertTrue(storage.exists("delta", 'fake-id'))
+        record = json.loads(storage.load("process", 'fake-id'))
+        self.assertEqual(record["revision"], 1)
+        self.assertEqual(record["process"]["state"], 'ready')
+
+        loaded = Workflow.load('fake-id')
+        self.assertEqual(loaded.revision, 3)
+        self.assertEqual(loaded.deltas, 2)
+        self.assertEqual(loaded.process.snapshot(), wflow.process.snapshot())
+        self.assertEqual(loaded.process.delta(), {})
+
+        loaded.process.children[1].context.set('counter', 2)
+        loaded.save()
+        self.assertFalse(storage.exists("delta", 'fake-id'))
+        wflow = Workflow.load('fake-id')
+        self.assertEqual(wflow.revision, 4)
+        self.assertEqual(wflow.process.children[1].context.get('counter'), 2)
+        os.rmdir(os.path.join(STORAGE_DIR, "delta"))
+
+    def test_save_binary(self):
+        """Test Workflow.save() with binary snapshot format."""
+
+        confparser = ConfigParser()
+        confparser.add_section('bureaucrat')
+        confparser.set('bureaucrat', 'storage_dir', STORAGE_DIR)
+        confparser.set('bureaucrat', 'snapshot_format', 'binary')
+        Configs._instance = None
+        Configs.instance(confparser)
+        storage = Storage.instance()
+        json_size = len(storage.load("process", 'fake-id'))
+
+        wflow = Workflow.load('fake-id')
+        wflow.process.state = 'active'
+        wflow.process.children[1].context.set('counter', 1)
+        wflow.save()
+        doc = storage.load("process", 'fake-id')
+        self.assertTrue(doc.startswith('\x00BCR'))
+        self.assertTrue(len(doc) < json_size)
+
+        loaded = Workflow.load('fake-id')
+        self.assertEqual(loaded.revision, 2)
+        self.assertEqual(loaded.definition, wflow.definition)
+        self.assertEqual(loaded.process.snapshot(), wflow.process.snapshot())
+
+        storage.save("process", 'fake-id', doc[:-5])
+        with self.assertRaises(WorkflowConflictError):
+            Workflow.load('fake-id')
+        storage.save("process", 'fake-id', doc)
+
+    def test_save_blob(self):
+        """Test Workflow.save() moves large values to blobs."""
+
+        confparser = ConfigParser()
+        confparser.add_section('bureaucrat')
+        confparser.set('bureaucrat', 'storage_dir', STORAGE_DIR)
+        confparser.set('bureaucrat', 'blob_threshold', '100')
+        Configs._instance = None
+        Configs.instance(confparser)
+        storage = Storage.instance()
+
+        wflow = Workflow.load('fake-id')
+        wflow.process.context.set('large', range(100))
+        wflow.save()
+        self.assertEqual(len(wflow.blobs), 1)
+        digest = list(wflow.blobs)[0]
+        self.assertEqual(json.loads(storage.load("blob", digest)), range(100))
+        self.assertEqual(storage.load("blob_refs", digest), "1")
+
+        loaded = Workflow.load('fake-id')
+        self.assertEqual(loaded.blobs, set([digest]))
+        self.assertEqual(loaded.process.context.localprops["large"],
+                         {"inst:blob": digest})
+        self.assertEqual(loaded.process.context.get('large'), range(100))
+
+        loaded.process.context.set('large', 1)
+        loaded.save()
+        self.assertFalse(storage.exists("blob", digest))
+        self.assertFalse(storage.exists("blob_refs", digest))
+        os.rmdir(os.path.join(STORAGE_DIR, "blob"))
+        os.rmdir(os.path.join(STORAGE_DIR, "blob_refs"))
+
+    def test_journal_history(self):
+        """Test Workflow.journal() and Workflow.replay() with history."""
+
+        confparser = ConfigParser()
+        confparser.add_section('bureaucrat')
+        confparser.set('bureaucrat', 'storage_dir', STORAGE_DIR)
+        confparser.set('bureaucrat', 'compaction_interval', '2')
+        confparser.set('bureaucrat', 'journal_history', 'yes')
+        Configs._instance = None
+        Configs.instance(confparser)
+        storage = Storage.instance()
+
+        wflow = Workflow.create_from_string(processdsc, 'other-id')
+        wflow.process.context.set('counter', 1)
+        wflow.save()
+        channel = Mock()
+        for name in ('start', 'fake'):
+            UnitOfWork('other-id', channel).handle_message(
+                Message(name=name, target='other-id', origin=''))
+
+        entries = Workflow.journal('other-id')
+        self.assertEqual([entry["revision"] for entry in entries],
+                         [1, 2, 3, 4])
+        self.assertEqual(entries[0]["messages"], [])
+        self.assertEqual([msg["name"] for msg in entries[2]["messages"]],
+                         ['start'])
+        self.assertTrue(storage.exists("history", 'other-id'))
+        self.assertTrue(storage.exists("delta", 'other-id'))
+
+        replayed = Workflow.replay('other-id')
+        self.assertEqual(replayed.revision, 4)
+        self.assertEqual(replayed.process.snapshot(),
+                         Workflow.load('other-id').process.snapshot())
+        replayed = Workflow.replay('other-id', 2)
+        self.assertEqual(replayed.process.state, 'ready')
+        self.assertEqual(replayed.process.context.get('counter'), 1)
+
+        Workflow.load('other-id').delete()
+        self.assertFalse(storage.exists("history", 'other-id'))
+        self.assertFalse(storage.exists("delta", 'other-id'))
+        os.rmdir(os.path.join(STORAGE_DIR, "history"))
+        os.rmdir(os.path.join(STORAGE_DIR, "delta"))
+
+    def test_load_interrupted_compaction(self):
+        """Test Workflow.load() skips deltas already in the record."""
+
+        storage = Storage.instance()
+        wflow = Workflow.load('fake-id')
+        wflow.process.state = 'active'
+        entry = wflow._dump_delta(2)
+        wflow.save()
+        storage.append("delta", 'fake-id', entry + "\n{\"revis")
+        wflow = Workflow.load('fake-id')
+        self.assertEqual(wflow.revision, 2)
+        self.assertEqual(wflow.process.state, 'active')
+        wflow.save()
+        self.assertFalse(storage.exists("delta", 'fake-id'))
+        os.rmdir(os.path.join(STORAGE_DIR, "delta"))
+
+    def test_save_conflict(self):
+        """Test Workflow.save() when the state has been saved by other."""
+
+        wflow = Workflow.load(self.wflow.process.id)
+        self.wflow.save()
+        with self.assertRaises(WorkflowConflictError):
+            wflow.save()
+        self.assertEqual(wflow.revision, 1)
+
+    def test_save_revision(self):
+        """Test Workflow.save() checks revision without parsing the state."""
+
+        storage = Storage.instance()
+        wflow = Workflow.load('fake-id')
+        with patch("bureaucrat.workflow._parse_record") as parse:
+            wflow.save()
+            parse.assert_not_called()
+        self.assertEqual(storage.load_header("process", 'fake-id'), '2')
+
+        # another writer saved the instance meanwhile
+        storage.save("process", 'fake-id', storage.load("process", 'fake-id'),
+                     '3')
+        self.assertRaises(WorkflowConflictError, wflow.save)
+
+    def test_unit_of_work(self):
+        """Test UnitOfWork.handle_message()."""
+
+        channel = Mock()
+        msg = Mock()
+        msg.name = 'start'
+        msg.target = 'fake-id'
+        uow = UnitOfWork('fake-id', channel)
+        wflow = uow.handle_message(msg)
+        self.assertEqual(wflow.process.state, 'active')
+        self.assertEqual(Workflow.load('fake-id').revision, 2)
+        channel.send.assert_called_once()
+
+    def test_unit_of_work_retry(self):
+        """Test UnitOfWork.handle_message() retries on conflict."""
+
+        channel = Mock()
+        msg = Mock()
+        msg.name = 'start'
+        msg.target = 'fake-id'
+        original_save = Workflow.save
+        attempts = []
+
+        def racing_save(wflow, outbox=None):
+            """Let somebody else save the state before the first attempt."""
+            attempts.append(wflow)
+            if len(attempts) == 1:
+                original_save(Workflow.load('fake-id'))
+            original_save(wflow, outbox)
+
+        with patch.object(Workflow, 'save', racing_save):
+            UnitOfWork('fake-id', channel).handle_message(msg)
+
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(Workflow.load('fake-id').revision, 3)
+        channel.send.assert_called_once()
+
+    def test_unit_of_work_messages(self):
+        """Test UnitOfWork.handle_messages() saves the instance once."""
+
+        channel = Mock()
+        msgs = [Message(name='start', target='fake-id', origin=''),
+                Message(name='start', target='fake-id_0', origin='fake-id')]
+        wflow = UnitOfWork('fake-id', channel).handle_messages(msgs)
+        self.assertEqual(wflow.process.children[0].state, 'active')
+        self.assertEqual(Workflow.load('fake-id').revision, 2)
+        self.assertEqual([args[0][0].target for args in
+                          channel.send.call_args_list],
+                         ['fake-id_0', 'fake-id_0_0'])
+
+    def test_unit_of_work_local(self):
+        """Test UnitOfWork.handle_message() handles own messages locally."""
+
+        channel = Mock()
+        uow = UnitOfWork('fake-id', channel, local=True)
+        wflow = uow.handle_message(Message(name='start', target='fake-id',
+                                           origin=''))
+        self.assertEqual(wflow.process.children[0].children[0].state,
+                         'active')
+        channel.send.assert_not_called()
+        channel.elaborate.assert_called_once()
+        self.assertEqual(Workflow.load('fake-id').revision, 2)
+
+    def test_unit_of_work_local_limit(self):
+        """Test UnitOfWork.handle_message() publishes after too many steps."""
+
+        channel = Mock()
+        uow = UnitOfWork('fake-id', channel, local=True)
+        with patch("bureaucrat.workflow.MAX_LOCAL_STEPS", 1):
+            uow.handle_message(Message(name='start', target='fake-id',
+                                       origin=''))
+        channel.send.assert_called_once()
+        self.assertEqual(channel.send.call_args[0][0].target, 'fake-id_0_0')
+
+    def test_unit_of_work_outbox(self):
+        """Test UnitOfWork.handle_message() with persistent outbox."""
+
+        confparser = ConfigParser()
+        confparser.add_section('bureaucrat')
+        confparser.set('bureaucrat', 'storage_dir', STORAGE_DIR)
+        confparser.set('bureaucrat', 'persist_outbox', 'yes')
+        Configs._instance = None
+        Configs.instance(confparser)
+        storage = Storage.instance()
+
+        channel = Mock()
+        msg = Message(name='start', target='fake-id', origin='')
+        with patch("bureaucrat.workflow.clear_outbox") as clear:
+            UnitOfWork('fake-id', channel).handle_message(msg)
+            clear.assert_called_once_with('fake-id', 2)
+        outbox = json.loads(storage.load("outbox", 'fake-id'))
+        self.assertEqual(outbox["revision"], 2)
+        channel.send.assert_called_once()
+
+        # the engine crashed before the outbox was removed
+        channel = Mock()
+        republish_outboxes(channel)
+        channel.send.assert_called_once()
+        self.assertEqual(channel.send.call_args[0][0].target, 'fake-id_0')
+        self.assertFalse(storage.exists("outbox", 'fake-id'))
+
+        # the engine crashed before the state was saved
+        outbox["revision"] = 3
+        storage.save("outbox", 'fake-id', json.dumps(outbox))
+        channel = Mock()
+        republish_outboxes(channel)
+        channel.send.assert_not_called()
+        self.assertFalse(storage.exists("outbox", 'fake-id'))
+
+        UnitOfWork('fake-id', channel).handle_message(
+            Message(name='start', target='fake-id_0', origin='fake-id'))
+        self.assertFalse(storage.exists("outbox", 'fake-id'))
+        os.rmdir(os.path.join(STORAGE_DIR, "outbox"))
+
+    def test_unit_of_work_cached(self):
+        """Test UnitOfWork.handle_message() takes instance from cache."""
+
+        channel = Mock()
+        msg = Mock()
+        msg.name = 'start'
+        msg.target = 'fake-id'
+        cache = InstanceCache(10)
+        wflow = UnitOfWork('fake-id', channel,
+                           cache=cache).handle_message(msg)
+        self.assertTrue(cache.get('fake-id') is wflow)
+
+        msg.name = 'fake'
+        with patch.object(Workflow, 'load') as load:
+            self.assertTrue(UnitOfWork('fake-id', channel,
+                                       cache=cache).handle_message(msg) \
+                            is wflow)
+            load.assert_not_called()
+        self.assertEqual(Workflow.load('fake-id').revision, 3)
+
+    def test_unit_of_work_cached_conflict(self):
+        """Test UnitOfWork.handle_message() drops stale cached instance."""
+
+        channel = Mock()
+        msg = Mock()
+        msg.name = 'start'
+        msg.target = 'fake-id'
+        cache = InstanceCache(10)
+        cache.put(Workflow.load('fake-id'))
+        self.wflow.save()
+        wflow = UnitOfWork('fake-id', channel,
+                           cache=cache).handle_message(msg)
+        self.assertEqual(wflow.revision, 3)
+        self.assertTrue(cache.get('fake-id') is wflow)
+        channel.send.assert_called_once()
+
+    def test_instance_cache_write_back(self):
+        """Test InstanceCache saves instances on eviction and flush."""
+
+        Workflow.create_from_string(processdsc, 'other-id')
+        channel = Mock()
+        msg = Mock()
+        msg.name = 'start'
+        cache = InstanceCache(1, 'evict')
+        msg.target = 'fake-id'
+        UnitOfWork('fake-id', channel, cache=cache).handle_message(msg)
+        self.assertEqual(Workflow.load('fake-id').revision, 1)
+
+        msg.target = 'other-id'
+        UnitOfWork('other-id', channel, cache=cache).handle_message(msg)
+        self.assertEqual(Workflow.load('fake-id').process.state, 'active')
+        self.assertEqual(Workflow.load('other-id').revision, 1)
+
+        cache.flush()
+        self.assertEqual(Workflow.load('other-id').process.state, 'active')
+        cache.flush()
+        self.assertEqual(Workflow.load('other-id').revision, 2)
+        Workflow.load('other-id').delete()
+
+    def test_instance_cache_wait_state(self):
+        """Test InstanceCache saves instances only at wait states."""
+
+        channel = Mock()
+        cache = InstanceCache(10, 'wait_state')
+        UnitOfWork('fake-id', channel, cache=cache).handle_message(
+            Message(name='start', target='fake-id', origin=''))
+        self.assertTrue(cache.is_unsaved('fake-id'))
+        self.assertEqual(Workflow.load('fake-id').revision, 1)
+        channel.send.assert_not_called()
+
+        for target in ('fake-id_0', 'fake-id_0_0'):
+            UnitOfWork('fake-id', channel, cache=cache).handle_message(
+                Message(name='start', target=target, origin='fake-id'))
+        # the first action waits for a participant
+        self.assertFalse(cache.is_unsaved('fake-id'))
+        # messages are published once the state they come from is saved
+        self.assertEqual([args[0][0].target for args in
+                          channel.send.call_args_list],
+                         ['fake-id_0', 'fake-id_0_0'])
+        channel.elaborate.assert_called_once()
+        wflow = Workflow.load('fake-id')
+        self.assertEqual(wflow.revision, 2)
+        self.assertEqual(wflow.process.children[0].children[0].state, 'active')
+
+    def test_instance_cache_wait_state_conflict(self):
+        """Test InstanceCache reports unsaved instances lost on conflict."""
+
+        channel = Mock()
+        cache = InstanceCache(10, 'wait_state')
+        UnitOfWork('fake-id', channel, cache=cache).handle_message(
+            Message(name='start', target='fake-id', origin=''))
+        self.wflow.save()
+        for target in ('fake-id_0', 'fake-id_0_0'):
+            UnitOfWork('fake-id', channel, cache=cache).handle_message(
+                Message(name='start', target=target, origin='fake-id'))
+        self.assertTrue(cache.was_lost('fake-id'))
+        self.assertEqual(channel.send.call_count, 0)
+
+
+class TestDefinitionCache(unittest.TestCase):
+    """Tests for DefinitionCache."""
+
+    def test_get(self):
+        """Test DefinitionCache.get() compiles definition once."""
+
+        cache = DefinitionCache(2)
+        with patch('bureaucrat.workflow.ET.fromstring',
+                   wraps=ET.fromstring) as fromstring:
+            digest = definition_digest(processdsc)
+            template = cache.get(digest, processdsc)
+            self.assertTrue(cache.get(digest) is template)
+            fromstring.assert_called_once_with(processdsc)
+
+    def test_instantiate(self):
+        """Test DefinitionCache.instantiate()."""
+
+        cache = DefinitionCache(2)
+        digest = definition_digest(processdsc)
+        process1 = cache.instantiate(digest, 'fake-id', pdef=processdsc)
+        process2 = cache.instantiate(digest, 'other-id')
+        expected = Process('', ET.fromstring(processdsc), 'fake-id', Context())
+        self.assertEqual(process1.snapshot(), expected.snapshot())
+        self.assertEqual(process2.children[1].id, 'other-id_1')
+        self.assertEqual(process2.children[1].parent_id, 'other-id')
+        process1.children[1].context.set('counter', 1)
+        self.assertEqual(process2.children[1].context.localprops, {})
+        self.assertTrue(process2.children[1]._parent_ctx is process2.context)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import logging
+import sys
+import time
+import os.path
+
+from optparse import OptionParser
+from ConfigParser import ConfigParser
+
+from bureaucrat.configs import Configs
+from bureaucrat.storage import Storage
+from bureaucrat.localtransport import LocalEngine
+
+LOG = logging.getLogger(__name__)
+
+def parse_cmdline():
+    """Parse command line options."""
+
+    parser = OptionParser(usage="%prog [options] PROCESS_DEFINITION")
+    parser.add_option("-c", "--config", dest="config",
+                      help="path to engine's config file")
+    parser.add_option("-n", "--instances", dest="instances", type="int",
+                      default=100, help="number of instances to run")
+
+    (options, args) = parser.parse_args()
+
+    if options.config is None:
+        LOG.error("Mandatory option 'config' is missing")
+        sys.exit(1)
+
+    if len(args) != 1:
+        LOG.error("Process definition is missing")
+        sys.exit(1)
+
+    return options, args[0]
+
+class Participants(dict):
+    """Participants returning work items untouched."""
+
+    def __contains__(self, name):
+        """Return True for any participant."""
+        return True
+
+    def __getitem__(self, name):
+        """Return participant."""
+        return lambda payload: payload
+
+def main():
+    """Entry point."""
+
+    options, path = parse_cmdline()
+    for filename in (options.config, path):
+        if not os.path.isfile(filename):
+            LOG.error("File '%s' not found. Exiting..." % filename)
+            sys.exit(1)
+
+    config = ConfigParser()
+    config.read(options.config)
+    Configs.instance(config)
+    with open(path) as fhdl:
+        pdef = fhdl.read()
+
+    engine = LocalEngine(Participants())
+    for _ in range(options.instances):
+        engine.launch(pdef)
+    start = time.time()
+    steps = engine.run()
+    elapsed = time.time() - start
+    print "%d instances completed, %d deliveries in %.3f s (%.1f/s)" % \
+            (len(engine.finished), steps, elapsed, steps / elapsed)
+    print "Storage: %s" % Storage.instance().metrics
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
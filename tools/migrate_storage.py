@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import logging
+import sys
+import os.path
+
+from optparse import OptionParser
+from ConfigParser import ConfigParser
+
+from bureaucrat.configs import Configs
+from bureaucrat.storage import Storage
+from bureaucrat.storage import FilesystemBackend
+from bureaucrat.workflow import Workflow
+
+LOG = logging.getLogger(__name__)
+
+def parse_cmdline():
+    """Parse command line options."""
+
+    parser = OptionParser()
+    parser.add_option("-c", "--config", dest="config",
+                      help="path to engine's config file")
+
+    (options, args) = parser.parse_args()
+
+    if options.config is None:
+        LOG.error("Mandatory option 'config' is missing")
+        sys.exit(1)
+
+    return options
+
+def main():
+    """Entry point."""
+
+    options = parse_cmdline()
+    if not os.path.isfile(options.config):
+        LOG.error("File '%s' not found. Exiting..." % options.config)
+        sys.exit(1)
+
+    config = ConfigParser()
+    config.read(options.config)
+    Configs.instance(config)
+
+    storage = Storage.instance()
+    if isinstance(storage.backend, FilesystemBackend):
+        for bucket in storage.backend.buckets():
+            moved = storage.backend.convert_layout(bucket)
+            LOG.info("Moved %d documents of '%s' to %s layout", moved,
+                     bucket, storage.backend.layout)
+
+    converted = 0
+    for pid in storage.keys("process"):
+        if Workflow.migrate(pid):
+            LOG.debug("Converted %s", pid)
+            converted += 1
+    LOG.info("Converted %d process instances", converted)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    main()
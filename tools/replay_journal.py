@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import logging
+import sys
+import json
+import os.path
+
+from optparse import OptionParser
+from ConfigParser import ConfigParser
+
+from bureaucrat.configs import Configs
+from bureaucrat.workflow import Workflow
+
+LOG = logging.getLogger(__name__)
+
+def parse_cmdline():
+    """Parse command line options."""
+
+    parser = OptionParser(usage="%prog [options] PROCESS_ID")
+    parser.add_option("-c", "--config", dest="config",
+                      help="path to engine's config file")
+    parser.add_option("-r", "--revision", dest="revision", type="int",
+                      help="print process state at the given revision")
+
+    (options, args) = parser.parse_args()
+
+    if options.config is None:
+        LOG.error("Mandatory option 'config' is missing")
+        sys.exit(1)
+
+    if len(args) != 1:
+        LOG.error("Process ID is missing")
+        sys.exit(1)
+
+    return options, args[0]
+
+def main():
+    """Entry point."""
+
+    options, pid = parse_cmdline()
+    if not os.path.isfile(options.config):
+        LOG.error("File '%s' not found. Exiting..." % options.config)
+        sys.exit(1)
+
+    config = ConfigParser()
+    config.read(options.config)
+    Configs.instance(config)
+
+    if options.revision is not None:
+        wflow = Workflow.replay(pid, options.revision)
+        print json.dumps(wflow.process.snapshot(), indent=2)
+        return
+
+    for entry in Workflow.journal(pid):
+        print "Revision %d" % entry["revision"]
+        for msg in entry.get("messages", []):
+            print "  handled %s from %s to %s" % (msg["name"], msg["origin"],
+                                                  msg["target"])
+        for fei in sorted(entry["delta"]):
+            print "  %s is %s" % (fei, entry["delta"][fei]["state"])
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()